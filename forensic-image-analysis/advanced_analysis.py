@@ -8,6 +8,9 @@ import cv2
 from scipy import ndimage
 from scipy.stats import entropy
 import warnings
+from config import NOISE_BAND_PIXELS, NOISE_MAP_WINDOW, TEXTURE_GLCM_LEVELS, TEXTURE_PROFILE
+from block_stats import tiled_grid
+from image_context import ensure_context
 
 # Conditional imports dengan error handling
 try:
@@ -73,84 +76,135 @@ def safe_entropy(data):
     except Exception:
         return 0.0
 
+def block_reshape(plane, bh, bw):
+    """(H, W[, C]) plane as an (H/bh, bh, W/bw, bw[, C]) view of non-overlapping blocks"""
+    nh, nw = plane.shape[0] // bh, plane.shape[1] // bw
+    return plane[:nh * bh, :nw * bw].reshape(nh, bh, nw, bw, *plane.shape[2:])
+
+def block_mean(plane, bh, bw):
+    """Per-block mean of a float plane; INTER_AREA at an integer factor is an exact block average"""
+    nh, nw = plane.shape[0] // bh, plane.shape[1] // bw
+    return cv2.resize(plane[:nh * bh, :nw * bw], (nw, nh), interpolation=cv2.INTER_AREA).reshape(nh, nw, *plane.shape[2:])
+
+def block_moments(plane, bh, bw):
+    """Per-block mean, std, skewness and excess kurtosis from raw power sums (0 where std is 0)"""
+    data = plane.astype(np.float64)
+    sq = data * data
+    m1 = block_mean(data, bh, bw)
+    m2 = block_mean(sq, bh, bw)
+    m3 = block_mean(sq * data, bh, bw)
+    m4 = block_mean(sq * sq, bh, bw)
+    var = np.maximum(m2 - m1 ** 2, 0)
+    mu3 = m3 - 3 * m1 * m2 + 2 * m1 ** 3
+    mu4 = m4 - 4 * m1 * m3 + 6 * m1 ** 2 * m2 - 3 * m1 ** 4
+    flat = var <= 1e-9
+    safe_var = np.where(flat, 1, var)
+    skewness = np.where(flat, 0, mu3 / safe_var ** 1.5)
+    kurtosis = np.where(flat, 0, mu4 / safe_var ** 2 - 3)
+    return m1, np.sqrt(var), skewness, kurtosis
+
+# ======================= Block Records =======================
+
+NOISE_BLOCK_DTYPE = np.dtype([
+    ('position', np.int32, (2,)),
+    ('laplacian_var', np.float32),
+    ('high_freq_energy', np.float32),
+    ('rgb_std', np.float32, (3,)),
+    ('lab_std', np.float32, (3,)),
+    ('mean_intensity', np.float32),
+    ('std_intensity', np.float32),
+    ('skewness', np.float32),
+    ('kurtosis', np.float32)
+])
+
+class BlockTable:
+    """Per-block records in one NumPy structured array, with a lazy dict view per block (picklable)"""
+
+    def __init__(self, records):
+        self.records = records
+
+    def __len__(self):
+        return len(self.records)
+
+    def __repr__(self):
+        return f"BlockTable(n={len(self)}, fields={list(self.records.dtype.names)})"
+
+    def __getitem__(self, key):
+        # 'field' -> column array, int -> dict (old list-of-dicts layout), mask/indices -> BlockTable
+        if isinstance(key, str):
+            return self.records[key]
+        if isinstance(key, (int, np.integer)):
+            record = self.records[key]
+            return {name: (tuple(record[name].tolist()) if name == 'position' else record[name].tolist())
+                    for name in self.records.dtype.names}
+        return BlockTable(self.records[key])
+
+    def __iter__(self):
+        return (self[k] for k in range(len(self)))
+
+    def subset(self, index):
+        """Return a new BlockTable restricted to index (mask or indices)"""
+        return BlockTable(self.records[index])
+
 # ======================= Noise Analysis =======================
 
-def analyze_noise_consistency(image_pil, block_size=32):
+def analyze_noise_consistency(image_pil, block_size=32, context=None):
     """Advanced noise consistency analysis"""
     print("  - Advanced noise consistency analysis...")
     
     try:
-        image_array = np.array(image_pil.convert('RGB'))
-        
-        # Convert to different color spaces for comprehensive analysis
-        lab = cv2.cvtColor(image_array, cv2.COLOR_RGB2LAB)
-        
-        h, w, c = image_array.shape
-        blocks_h = max(1, h // block_size)
-        blocks_w = max(1, w // block_size)
-        
-        noise_characteristics = []
-        
-        for i in range(blocks_h):
-            for j in range(blocks_w):
-                # Safe block extraction
-                y_start, y_end = i*block_size, min((i+1)*block_size, h)
-                x_start, x_end = j*block_size, min((j+1)*block_size, w)
-                
-                rgb_block = image_array[y_start:y_end, x_start:x_end]
-                lab_block = lab[y_start:y_end, x_start:x_end]
-                
-                # Noise estimation using Laplacian variance
-                gray_block = cv2.cvtColor(rgb_block, cv2.COLOR_RGB2GRAY)
-                laplacian_var = cv2.Laplacian(gray_block, cv2.CV_64F).var()
-                
-                # High frequency content analysis with safe indexing
-                try:
-                    f_transform = np.fft.fft2(gray_block)
-                    f_shift = np.fft.fftshift(f_transform)
-                    magnitude_spectrum = np.log(np.abs(f_shift) + 1)
-                    
-                    # Safe frequency range calculation
-                    h_block, w_block = magnitude_spectrum.shape
-                    quarter_h, quarter_w = max(1, h_block//4), max(1, w_block//4)
-                    three_quarter_h = min(h_block, 3*h_block//4)
-                    three_quarter_w = min(w_block, 3*w_block//4)
-                    
-                    if three_quarter_h > quarter_h and three_quarter_w > quarter_w:
-                        high_freq_energy = np.sum(magnitude_spectrum[quarter_h:three_quarter_h, 
-                                                                   quarter_w:three_quarter_w])
-                    else:
-                        high_freq_energy = np.sum(magnitude_spectrum)
-                except Exception:
-                    high_freq_energy = 0.0
-                
-                # Color noise analysis
-                rgb_std = np.std(rgb_block, axis=(0, 1))
-                lab_std = np.std(lab_block, axis=(0, 1))
-                
-                # Statistical moments
-                mean_intensity = np.mean(gray_block)
-                std_intensity = np.std(gray_block)
-                skewness = calculate_skewness(gray_block.flatten())
-                kurtosis = calculate_kurtosis(gray_block.flatten())
-                
-                noise_characteristics.append({
-                    'position': (i, j),
-                    'laplacian_var': float(laplacian_var),
-                    'high_freq_energy': float(high_freq_energy),
-                    'rgb_std': rgb_std.tolist(),
-                    'lab_std': lab_std.tolist(),
-                    'mean_intensity': float(mean_intensity),
-                    'std_intensity': float(std_intensity),
-                    'skewness': float(skewness),
-                    'kurtosis': float(kurtosis)
-                })
-        
-        # Analyze consistency across blocks
-        if noise_characteristics:
-            laplacian_vars = [block['laplacian_var'] for block in noise_characteristics]
-            high_freq_energies = [block['high_freq_energy'] for block in noise_characteristics]
-            std_intensities = [block['std_intensity'] for block in noise_characteristics]
+        context = ensure_context(image_pil, context)
+        gray = context.gray
+        
+        h, w = gray.shape
+        blocks_h, blocks_w = tiled_grid((h, w), block_size)
+        bh, bw = min(block_size, h), min(block_size, w)
+        
+        # Noise estimation (Laplacian variance) and colour noise (RGB/LAB std) from the shared integrals
+        block_count = blocks_h * blocks_w
+        laplacian_var = context.var('laplacian', block_size).reshape(block_count)
+        rgb_std = context.std('rgb', block_size).reshape(block_count, 3)
+        lab_std = context.std('lab', block_size).reshape(block_count, 3)
+        
+        # FFT and higher moments on (blocks_h, bh, blocks_w, bw) views, processed in bands of block rows
+        rows_per_band = max(1, NOISE_BAND_PIXELS // (bh * w))
+        stats = {key: [] for key in ('high_freq_energy', 'mean_intensity', 'std_intensity', 'skewness', 'kurtosis')}
+        for band_start in range(0, blocks_h, rows_per_band):
+            band_rows = min(rows_per_band, blocks_h - band_start)
+            y0, y1 = band_start * bh, (band_start + band_rows) * bh
+            band_gray = gray[y0:y1, :blocks_w * bw]
+            
+            # High frequency content analysis: one batched FFT over the block axes
+            gray_blocks = block_reshape(band_gray.astype(np.float32), bh, bw)
+            magnitude = np.log(np.abs(np.fft.fftshift(np.fft.fft2(gray_blocks, axes=(1, 3)), axes=(1, 3))) + 1)
+            q_h, q_w = max(1, bh // 4), max(1, bw // 4)
+            tq_h, tq_w = min(bh, 3 * bh // 4), min(bw, 3 * bw // 4)
+            if tq_h > q_h and tq_w > q_w:
+                stats['high_freq_energy'].append(magnitude[:, q_h:tq_h, :, q_w:tq_w].sum(axis=(1, 3)))
+            else:
+                stats['high_freq_energy'].append(magnitude.sum(axis=(1, 3)))
+            
+            # Statistical moments as array expressions (fourth-power sums stay band-local)
+            mean, std, skewness, kurtosis = block_moments(band_gray, bh, bw)
+            stats['mean_intensity'].append(mean)
+            stats['std_intensity'].append(std)
+            stats['skewness'].append(skewness)
+            stats['kurtosis'].append(kurtosis)
+        
+        stats = {key: np.concatenate(values).reshape(block_count) for key, values in stats.items()}
+        stats.update(laplacian_var=laplacian_var, rgb_std=rgb_std, lab_std=lab_std)
+        
+        noise_characteristics = BlockTable(np.zeros(blocks_h * blocks_w, dtype=NOISE_BLOCK_DTYPE))
+        rows, cols = np.divmod(np.arange(blocks_h * blocks_w), blocks_w)
+        noise_characteristics.records['position'] = np.stack([rows, cols], axis=1)
+        for key, values in stats.items():
+            noise_characteristics.records[key] = values
+        
+        # Analyze consistency across blocks (full-precision columns)
+        if len(noise_characteristics):
+            laplacian_vars = stats['laplacian_var']
+            high_freq_energies = stats['high_freq_energy']
+            std_intensities = stats['std_intensity']
             
             # Calculate consistency metrics
             laplacian_consistency = np.std(laplacian_vars) / (np.mean(laplacian_vars) + 1e-6)
@@ -160,21 +214,17 @@ def analyze_noise_consistency(image_pil, block_size=32):
             # Overall inconsistency score
             overall_inconsistency = (laplacian_consistency + freq_consistency + intensity_consistency) / 3
             
-            # Detect outlier blocks with error handling
-            outliers = []
+            # Detect outlier blocks - indices into noise_characteristics
             try:
-                outlier_indices = detect_outliers_iqr(np.array(laplacian_vars))
-                for idx in outlier_indices:
-                    if idx < len(noise_characteristics):
-                        outliers.append(noise_characteristics[idx])
+                outliers = np.asarray(detect_outliers_iqr(laplacian_vars), dtype=np.int32)
             except Exception:
-                pass
+                outliers = np.zeros(0, dtype=np.int32)
         else:
             laplacian_consistency = 0.0
             freq_consistency = 0.0
             intensity_consistency = 0.0
             overall_inconsistency = 0.0
-            outliers = []
+            outliers = np.zeros(0, dtype=np.int32)
         
         return {
             'noise_characteristics': noise_characteristics,
@@ -189,21 +239,44 @@ def analyze_noise_consistency(image_pil, block_size=32):
     except Exception as e:
         print(f"  Warning: Noise analysis failed: {e}")
         return {
-            'noise_characteristics': [],
+            'noise_characteristics': BlockTable(np.zeros(0, dtype=NOISE_BLOCK_DTYPE)),
             'laplacian_consistency': 0.0,
             'frequency_consistency': 0.0,
             'intensity_consistency': 0.0,
             'overall_inconsistency': 0.0,
-            'outlier_blocks': [],
+            'outlier_blocks': np.zeros(0, dtype=np.int32),
             'outlier_count': 0
         }
 
+def estimate_noise_level_map(image_pil, window=NOISE_MAP_WINDOW, context=None):
+    """Dense float32 per-pixel noise sigma map
+    
+    High-pass residual with the Immerkaer Laplacian-of-3x3 kernel, then a box-filtered
+    local mean absolute residual: sigma = sqrt(pi/2) * E|r| / 6. Both passes are single
+    linear filters; boxFilter uses running sums, so its cost does not grow with window.
+    """
+    gray = ensure_context(image_pil, context).plane('gray_float32')
+    kernel = np.array([[1, -2, 1], [-2, 4, -2], [1, -2, 1]], dtype=np.float32)
+    residual = cv2.filter2D(gray, cv2.CV_32F, kernel, borderType=cv2.BORDER_REFLECT)
+    np.abs(residual, out=residual)
+    local_mad = cv2.boxFilter(residual, cv2.CV_32F, (window, window), borderType=cv2.BORDER_REFLECT)
+    return local_mad * np.float32(np.sqrt(np.pi / 2) / 6)
+
 # ======================= Frequency Domain Analysis =======================
 
-def analyze_frequency_domain(image_pil):
+def block_dct_energy(image_gray, block_size=8):
+    """Sum of |DCT-II| (orthonormal, as cv2.dct) of every non-overlapping block as one tensor product"""
+    n = np.arange(block_size)
+    basis = np.sqrt(2.0 / block_size) * np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * block_size))
+    basis[0] /= np.sqrt(2.0)
+    blocks = block_reshape(image_gray.astype(np.float64), block_size, block_size)
+    coeffs = np.einsum('ui,aibj,vj->aubv', basis, blocks, basis, optimize=True)
+    return np.abs(coeffs).sum(axis=(1, 3))
+
+def analyze_frequency_domain(image_pil, context=None):
     """Analyze DCT coefficients for manipulation detection"""
     try:
-        image_array = np.array(image_pil.convert('L'))
+        image_array = ensure_context(image_pil, context).gray
         
         # DCT Analysis dengan multiple fallback methods
         dct_coeffs = None
@@ -244,25 +317,14 @@ def analyze_frequency_domain(image_pil):
         
         # Block-wise DCT analysis
         block_size = 8
-        blocks_h = max(1, h // block_size)
-        blocks_w = max(1, w // block_size)
-        
-        block_freq_variations = []
-        
-        for i in range(blocks_h):
-            for j in range(blocks_w):
-                y_start, y_end = i*block_size, min((i+1)*block_size, h)
-                x_start, x_end = j*block_size, min((j+1)*block_size, w)
-                
-                block = image_array[y_start:y_end, x_start:x_end]
-                
-                try:
-                    block_dct = cv2.dct(block.astype(np.float32))
-                    block_energy = np.sum(np.abs(block_dct))
-                except Exception:
-                    block_energy = np.sum(np.abs(block))
-                
-                block_freq_variations.append(float(block_energy))
+        if h >= block_size and w >= block_size:
+            block_freq_variations = block_dct_energy(image_array, block_size).ravel().tolist()
+        else:
+            # Image smaller than one block: a single partial block
+            try:
+                block_freq_variations = [float(np.sum(np.abs(cv2.dct(image_array.astype(np.float32)))))]
+            except Exception:
+                block_freq_variations = [float(np.sum(np.abs(image_array.astype(np.float64))))]
         
         # Calculate frequency inconsistency
         if len(block_freq_variations) > 0:
@@ -289,75 +351,104 @@ def analyze_frequency_domain(image_pil):
             'block_variations': 0.0
         }
 
+# ======================= Texture Engine =======================
+
+def glcm_block_features(image_gray, block_size, levels=TEXTURE_GLCM_LEVELS):
+    """GLCM contrast, dissimilarity, homogeneity and energy for every block at once
+    
+    Same definition as skimage graycomatrix(distances=[1], angles=[0], symmetric=True,
+    normed=True) + graycoprops, on gray levels quantized to `levels`. The first three
+    properties only depend on the neighbour difference i - j, so they are block means of
+    the difference image. Energy needs the co-occurrence counts: one np.bincount over
+    (block_id, i, j), or np.unique over the occupied pairs when the dense table is too big.
+    Returns (n_blocks, 4) float64 in row-major block order.
+    """
+    h, w = image_gray.shape
+    bh, bw = min(block_size, h), min(block_size, w)
+    quantized = image_gray.astype(np.int32)
+    if levels != 256:
+        quantized = quantized * levels // 256
+    blocks = block_reshape(quantized, bh, bw)
+    nh, nw = blocks.shape[0], blocks.shape[2]
+    n_blocks = nh * nw
+    
+    left, right = blocks[..., :-1], blocks[..., 1:]
+    diff = left - right
+    sq = diff * diff
+    contrast = sq.mean(axis=(1, 3), dtype=np.float64)
+    dissimilarity = np.abs(diff).mean(axis=(1, 3), dtype=np.float64)
+    homogeneity = (1.0 / (1.0 + sq.astype(np.float32))).mean(axis=(1, 3), dtype=np.float64)
+    
+    # Symmetric counts S = C + C^T on unordered pairs {a, b}: off-diagonal cells hold n_ab twice,
+    # diagonal cells hold 2 * n_aa, so sum(S^2) = sum(2 n_ab^2) + sum(4 n_aa^2)
+    block_id = (np.arange(nh, dtype=np.int64)[:, None, None, None] * nw +
+                np.arange(nw, dtype=np.int64)[None, None, :, None])
+    low, high = np.minimum(left, right), np.maximum(left, right)
+    keys = block_id * (levels * levels) + (low * levels + high)
+    if n_blocks * levels * levels <= 1 << 24:
+        counts = np.bincount(keys.ravel(), minlength=n_blocks * levels * levels)
+        cells = np.flatnonzero(counts)
+        counts = counts[cells]
+    else:
+        cells, counts = np.unique(keys.ravel(), return_counts=True)
+    cell_low = (cells // levels) % levels
+    cell_high = cells % levels
+    weight = np.where(cell_low == cell_high, 4.0, 2.0) * counts.astype(np.float64) ** 2
+    n_pairs = 2.0 * bh * (bw - 1)
+    asm = np.bincount(cells // (levels * levels), weights=weight, minlength=n_blocks) / n_pairs ** 2
+    energy = np.sqrt(asm)
+    
+    return np.stack([contrast.ravel(), dissimilarity.ravel(), homogeneity.ravel(), energy], axis=1)
+
+def block_entropy(image_gray, block_size):
+    """Shannon entropy (bits) of the gray-level histogram of every block, via one bincount"""
+    h, w = image_gray.shape
+    bh, bw = min(block_size, h), min(block_size, w)
+    blocks = block_reshape(image_gray, bh, bw)
+    nh, nw = blocks.shape[0], blocks.shape[2]
+    block_id = np.arange(nh)[:, None, None, None] * nw + np.arange(nw)[None, None, :, None]
+    keys = (block_id * 256 + blocks.astype(np.int64)).ravel()
+    hist = np.bincount(keys, minlength=nh * nw * 256).reshape(nh * nw, 256) / float(bh * bw)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return -np.sum(np.where(hist > 0, hist * np.log2(hist), 0), axis=1)
+
+def lbp_block_chi2(image_gray, block_size, radius=3):
+    """Chi-square distance of each block's uniform-LBP histogram to the global histogram"""
+    n_points = 8 * radius
+    n_bins = n_points + 2
+    h, w = image_gray.shape
+    bh, bw = min(block_size, h), min(block_size, w)
+    codes = block_reshape(local_binary_pattern(image_gray, n_points, radius, method='uniform').astype(np.int64), bh, bw)
+    nh, nw = codes.shape[0], codes.shape[2]
+    block_id = np.arange(nh)[:, None, None, None] * nw + np.arange(nw)[None, None, :, None]
+    hist = np.bincount((block_id * n_bins + codes).ravel(), minlength=nh * nw * n_bins)
+    hist = hist.reshape(nh * nw, n_bins) / float(bh * bw)
+    global_hist = hist.mean(axis=0)
+    denom = hist + global_hist
+    return 0.5 * np.sum(np.where(denom > 0, (hist - global_hist) ** 2 / np.where(denom > 0, denom, 1), 0), axis=1)
+
 # ======================= Texture Analysis =======================
 
-def analyze_texture_consistency(image_pil, block_size=64):
-    """Analyze texture consistency using GLCM and LBP"""
+def analyze_texture_consistency(image_pil, block_size=64, profile=TEXTURE_PROFILE, context=None):
+    """Analyze texture consistency using GLCM and (profile 'glcm_lbp') per-block LBP histograms"""
     try:
-        image_gray = np.array(image_pil.convert('L'))
+        image_gray = ensure_context(image_pil, context).gray
         
-        # Local Binary Pattern analysis dengan fallback
-        if SKIMAGE_AVAILABLE:
-            try:
-                radius = 3
-                n_points = 8 * radius
-                lbp = local_binary_pattern(image_gray, n_points, radius, method='uniform')
-            except Exception:
-                lbp = np.zeros_like(image_gray)
-        else:
-            lbp = np.zeros_like(image_gray)
-        
-        # Block-wise texture analysis
-        h, w = image_gray.shape
-        blocks_h = max(1, h // block_size)
-        blocks_w = max(1, w // block_size)
-        
-        texture_features = []
-        
-        for i in range(blocks_h):
-            for j in range(blocks_w):
-                y_start, y_end = i*block_size, min((i+1)*block_size, h)
-                x_start, x_end = j*block_size, min((j+1)*block_size, w)
-                
-                block = image_gray[y_start:y_end, x_start:x_end]
-                
-                # GLCM analysis dengan fallback
-                if SKIMAGE_AVAILABLE:
-                    try:
-                        glcm = graycomatrix(block, distances=[1], angles=[0, 45, 90, 135],
-                                          levels=256, symmetric=True, normed=True)
-                        
-                        contrast = graycoprops(glcm, 'contrast')[0, 0]
-                        dissimilarity = graycoprops(glcm, 'dissimilarity')[0, 0]
-                        homogeneity = graycoprops(glcm, 'homogeneity')[0, 0]
-                        energy = graycoprops(glcm, 'energy')[0, 0]
-                    except Exception:
-                        # Fallback measures
-                        contrast = float(np.var(block))
-                        dissimilarity = float(np.std(block))
-                        homogeneity = 1.0 / (1.0 + np.var(block))
-                        energy = float(np.mean(block ** 2) / 255**2)
-                else:
-                    # Fallback measures
-                    contrast = float(np.var(block))
-                    dissimilarity = float(np.std(block))
-                    homogeneity = 1.0 / (1.0 + np.var(block))
-                    energy = float(np.mean(block ** 2) / 255**2)
-                
-                # LBP calculation
-                lbp_uniformity = safe_entropy(block)
-                
-                texture_features.append([
-                    float(contrast), 
-                    float(dissimilarity), 
-                    float(homogeneity), 
-                    float(energy), 
-                    float(lbp_uniformity)
-                ])
+        # Block-wise texture analysis - all blocks at once
+        glcm_features = glcm_block_features(image_gray, block_size)
+        lbp_uniformity = block_entropy(image_gray, block_size)
+        texture_features = np.column_stack([glcm_features, lbp_uniformity])
+        feature_names = ['contrast', 'dissimilarity', 'homogeneity', 'energy', 'lbp_uniformity']
+        
+        # Local Binary Pattern hanya dihitung jika profile memintanya
+        lbp_chi2 = None
+        if profile == 'glcm_lbp' and SKIMAGE_AVAILABLE:
+            lbp_chi2 = lbp_block_chi2(image_gray, block_size)
+            texture_features = np.column_stack([texture_features, lbp_chi2])
+            feature_names.append('lbp_chi2')
         
         # Analyze consistency
         texture_consistency = {}
-        feature_names = ['contrast', 'dissimilarity', 'homogeneity', 'energy', 'lbp_uniformity']
         
         if len(texture_features) > 0:
             texture_features = np.array(texture_features)
@@ -375,7 +466,8 @@ def analyze_texture_consistency(image_pil, block_size=64):
         return {
             'texture_consistency': texture_consistency,
             'overall_inconsistency': float(overall_texture_inconsistency),
-            'texture_features': texture_features.tolist() if len(texture_features) > 0 else []
+            'texture_features': texture_features.tolist() if len(texture_features) > 0 else [],
+            'lbp_chi2_distances': lbp_chi2
         }
         
     except Exception as e:
@@ -386,52 +478,46 @@ def analyze_texture_consistency(image_pil, block_size=64):
         return {
             'texture_consistency': texture_consistency,
             'overall_inconsistency': 0.0,
-            'texture_features': []
+            'texture_features': [],
+            'lbp_chi2_distances': None
         }
 
 # ======================= Edge Analysis =======================
 
-def analyze_edge_consistency(image_pil):
+def compute_edge_map(image_gray):
+    """Mean of Sobel, Prewitt and Roberts magnitudes (skimage scaling) in float32
+    
+    The horizontal/vertical derivative [1, 0, -1] is shared by Sobel and Prewitt and only
+    the cross smoothing differs, so all six responses come from separable/2x2 float32
+    filters on one [0, 1] copy of the image.
+    """
+    gray = image_gray.astype(np.float32) * np.float32(1.0 / 255)
+    derivative = np.float32([1, 0, -1])
+    border = cv2.BORDER_REFLECT
+    
+    magnitude = np.zeros_like(gray)
+    for smooth in (np.float32([1, 2, 1]) / 4, np.float32([1, 1, 1]) / 3):
+        gx = cv2.sepFilter2D(gray, cv2.CV_32F, derivative, smooth, borderType=border)
+        gy = cv2.sepFilter2D(gray, cv2.CV_32F, smooth, derivative, borderType=border)
+        magnitude += np.sqrt((gx * gx + gy * gy) * np.float32(0.5))
+    
+    r1 = cv2.filter2D(gray, cv2.CV_32F, np.float32([[1, 0], [0, -1]]), anchor=(0, 0), borderType=border)
+    r2 = cv2.filter2D(gray, cv2.CV_32F, np.float32([[0, 1], [-1, 0]]), anchor=(0, 0), borderType=border)
+    magnitude += np.sqrt((r1 * r1 + r2 * r2) * np.float32(0.5))
+    return magnitude * np.float32(1.0 / 3)
+
+def analyze_edge_consistency(image_pil, block_size=32, context=None):
     """Analyze edge density consistency"""
     try:
-        image_gray = np.array(image_pil.convert('L'))
+        context = ensure_context(image_pil, context)
         
-        # Multiple edge detectors dengan fallback
-        if SKIMAGE_AVAILABLE:
-            try:
-                edges_sobel = sobel(image_gray)
-                edges_prewitt = prewitt(image_gray)
-                edges_roberts = roberts(image_gray)
-                combined_edges = (edges_sobel + edges_prewitt + edges_roberts) / 3
-            except Exception:
-                # Fallback to OpenCV Sobel
-                grad_x = cv2.Sobel(image_gray, cv2.CV_64F, 1, 0, ksize=3)
-                grad_y = cv2.Sobel(image_gray, cv2.CV_64F, 0, 1, ksize=3)
-                combined_edges = np.sqrt(grad_x**2 + grad_y**2)
-        else:
-            # Fallback to OpenCV Sobel
-            grad_x = cv2.Sobel(image_gray, cv2.CV_64F, 1, 0, ksize=3)
-            grad_y = cv2.Sobel(image_gray, cv2.CV_64F, 0, 1, ksize=3)
-            combined_edges = np.sqrt(grad_x**2 + grad_y**2)
-        
-        # Block-wise edge density
-        block_size = 32
-        h, w = image_gray.shape
-        blocks_h = max(1, h // block_size)
-        blocks_w = max(1, w // block_size)
-        
-        edge_densities = []
-        
-        for i in range(blocks_h):
-            for j in range(blocks_w):
-                y_start, y_end = i*block_size, min((i+1)*block_size, h)
-                x_start, x_end = j*block_size, min((j+1)*block_size, w)
-                
-                block_edges = combined_edges[y_start:y_end, x_start:x_end]
-                edge_density = np.mean(block_edges)
-                edge_densities.append(float(edge_density))
-        
-        edge_densities = np.array(edge_densities)
+        # Sobel + Prewitt + Roberts in one float32 pass
+        if 'edge' not in context:
+            context.add_plane('edge', lambda: compute_edge_map(context.gray))
+        combined_edges = context.plane('edge')
+        
+        # Block-wise edge density from the edge-map integral
+        edge_densities = context.mean('edge', block_size).ravel()
         
         if len(edge_densities) > 0:
             edge_inconsistency = np.std(edge_densities) / (np.mean(edge_densities) + 1e-6)
@@ -443,7 +529,8 @@ def analyze_edge_consistency(image_pil):
         return {
             'edge_inconsistency': float(edge_inconsistency),
             'edge_densities': edge_densities.tolist(),
-            'edge_variance': float(edge_variance)
+            'edge_variance': float(edge_variance),
+            'edge_map': combined_edges
         }
         
     except Exception as e:
@@ -451,48 +538,90 @@ def analyze_edge_consistency(image_pil):
         return {
             'edge_inconsistency': 0.0,
             'edge_densities': [],
-            'edge_variance': 0.0
+            'edge_variance': 0.0,
+            'edge_map': None
         }
 
 # ======================= Illumination Analysis =======================
 
-def analyze_illumination_consistency(image_pil):
+def block_label_map(shape, bh, bw, nh, nw):
+    """Region labels for an (nh, nw) block grid; leftover border pixels join the last row/column"""
+    rows = np.minimum(np.arange(shape[0]) // bh, nh - 1)
+    cols = np.minimum(np.arange(shape[1]) // bw, nw - 1)
+    return (rows[:, None] * nw + cols[None, :]).astype(np.int32)
+
+def estimate_region_illuminants(image_array, labels, n_regions):
+    """Gray-world, max-RGB and gray-edge illuminant per region (blocks or superpixels)
+    
+    Returns {estimator: (n_regions, 3) unit-norm RGB illuminant} plus their mean
+    'combined' estimate. One np.bincount over (region, value) per channel gives a
+    per-region histogram, from which both the gray-world mean and the max are read;
+    gray-edge sums gradient magnitudes with a weighted bincount.
+    """
+    flat_labels = labels.ravel().astype(np.int64)
+    counts = np.maximum(np.bincount(flat_labels, minlength=n_regions), 1).astype(np.float64)
+    values = np.arange(256, dtype=np.float64)
+    
+    # First-order gray-edge: gradient magnitude per channel (Sobel on all channels at once)
+    image_float = image_array.astype(np.float32)
+    gx = cv2.Sobel(image_float, cv2.CV_32F, 1, 0, ksize=3)
+    gy = cv2.Sobel(image_float, cv2.CV_32F, 0, 1, ksize=3)
+    edge = cv2.magnitude(gx.reshape(-1), gy.reshape(-1)).reshape(-1, 3)
+    
+    gray_world, max_rgb, gray_edge = [], [], []
+    for ch in range(3):
+        keys = flat_labels * 256 + image_array[..., ch].ravel()
+        hist = np.bincount(keys, minlength=n_regions * 256).reshape(n_regions, 256)
+        gray_world.append(hist @ values / counts)
+        max_rgb.append(255 - np.argmax(hist[:, ::-1] > 0, axis=1))
+        gray_edge.append(np.bincount(flat_labels, weights=edge[:, ch], minlength=n_regions) / counts)
+    
+    estimates = {
+        'gray_world': np.stack(gray_world, axis=1),
+        'max_rgb': np.stack(max_rgb, axis=1).astype(np.float64),
+        'gray_edge': np.stack(gray_edge, axis=1)
+    }
+    for name, est in estimates.items():
+        estimates[name] = est / (np.linalg.norm(est, axis=1, keepdims=True) + 1e-9)
+    combined = sum(estimates.values())
+    estimates['combined'] = combined / (np.linalg.norm(combined, axis=1, keepdims=True) + 1e-9)
+    return estimates
+
+def illumination_gradient(lab):
+    """Sobel gradient magnitude of the L (illumination) channel"""
+    illumination = np.ascontiguousarray(lab[:, :, 0])
+    grad_x = cv2.Sobel(illumination, cv2.CV_32F, 1, 0, ksize=3)
+    grad_y = cv2.Sobel(illumination, cv2.CV_32F, 0, 1, ksize=3)
+    return cv2.magnitude(grad_x, grad_y)
+
+def analyze_illumination_consistency(image_pil, block_size=64, context=None):
     """Advanced illumination consistency analysis"""
     try:
-        image_array = np.array(image_pil)
-        
-        # Convert to different color spaces
-        lab = cv2.cvtColor(image_array, cv2.COLOR_RGB2LAB)
-        
-        # Illumination map (L channel in LAB)
-        illumination = lab[:, :, 0]
-        
-        # Gradient analysis
-        grad_x = cv2.Sobel(illumination, cv2.CV_64F, 1, 0, ksize=3)
-        grad_y = cv2.Sobel(illumination, cv2.CV_64F, 0, 1, ksize=3)
-        gradient_magnitude = np.sqrt(grad_x**2 + grad_y**2)
-        
-        # Block-wise illumination analysis
-        block_size = 64
-        h, w = illumination.shape
-        blocks_h = max(1, h // block_size)
-        blocks_w = max(1, w // block_size)
-        
-        illumination_means = []
-        illumination_stds = []
-        gradient_means = []
-        
-        for i in range(blocks_h):
-            for j in range(blocks_w):
-                y_start, y_end = i*block_size, min((i+1)*block_size, h)
-                x_start, x_end = j*block_size, min((j+1)*block_size, w)
-                
-                block_illum = illumination[y_start:y_end, x_start:x_end]
-                block_grad = gradient_magnitude[y_start:y_end, x_start:x_end]
-                
-                illumination_means.append(np.mean(block_illum))
-                illumination_stds.append(np.std(block_illum))
-                gradient_means.append(np.mean(block_grad))
+        context = ensure_context(image_pil, context)
+        image_array = context.rgb
+        
+        # Illumination map (L channel in LAB) and its gradient
+        if 'illumination_gradient' not in context:
+            context.add_plane('illumination_gradient', lambda: illumination_gradient(context.lab))
+        
+        # Block-wise illumination analysis from the shared integral images
+        h, w = image_array.shape[:2]
+        bh, bw = min(block_size, h), min(block_size, w)
+        blocks_h, blocks_w = tiled_grid((h, w), block_size)
+        
+        lab_mean_grid, lab_std_grid = context.mean_std('lab', block_size)
+        illumination_means = lab_mean_grid[..., 0].ravel()
+        illumination_stds = lab_std_grid[..., 0].ravel()
+        gradient_means = context.mean('illumination_gradient', block_size).ravel()
+        
+        # Illuminant colour per block: chromaticity map and angular deviation from the global illuminant
+        labels = block_label_map((h, w), bh, bw, blocks_h, blocks_w)
+        illuminants = estimate_region_illuminants(image_array, labels, blocks_h * blocks_w)
+        combined = illuminants['combined']
+        chromaticity = (combined[:, :2] / combined.sum(axis=1, keepdims=True)).reshape(blocks_h, blocks_w, 2)
+        global_illuminant = np.median(combined, axis=0)
+        global_illuminant /= np.linalg.norm(global_illuminant) + 1e-9
+        angular_error = np.degrees(np.arccos(np.clip(combined @ global_illuminant, -1, 1))).reshape(blocks_h, blocks_w)
         
         # Consistency metrics
         if len(illumination_means) > 0:
@@ -508,7 +637,10 @@ def analyze_illumination_consistency(image_pil):
             'illumination_mean_consistency': float(illum_mean_consistency),
             'illumination_std_consistency': float(illum_std_consistency),
             'gradient_consistency': float(gradient_consistency),
-            'overall_illumination_inconsistency': float((illum_mean_consistency + gradient_consistency) / 2)
+            'overall_illumination_inconsistency': float((illum_mean_consistency + gradient_consistency) / 2),
+            'illuminant_chromaticity_map': chromaticity.astype(np.float32),
+            'illuminant_angular_error_map': angular_error.astype(np.float32),
+            'illuminant_inconsistency': float(np.mean(angular_error))
         }
         
     except Exception as e:
@@ -517,37 +649,71 @@ def analyze_illumination_consistency(image_pil):
             'illumination_mean_consistency': 0.0,
             'illumination_std_consistency': 0.0,
             'gradient_consistency': 0.0,
-            'overall_illumination_inconsistency': 0.0
+            'overall_illumination_inconsistency': 0.0,
+            'illuminant_chromaticity_map': None,
+            'illuminant_angular_error_map': None,
+            'illuminant_inconsistency': 0.0
         }
 
 # ======================= Statistical Analysis =======================
 
-def perform_statistical_analysis(image_pil):
-    """Comprehensive statistical analysis"""
+def histogram_entropy(hist):
+    """Shannon entropy (bits) of a histogram"""
+    p = hist[hist > 0] / float(hist.sum())
+    return float(-np.sum(p * np.log2(p)))
+
+def perform_statistical_analysis(image_pil, context=None):
+    """Comprehensive statistical analysis
+    
+    Inputs are uint8, so every per-channel moment and entropy is derived in O(256) from
+    one 256-bin histogram per channel; correlations come from a single 3x3 covariance.
+    Both are accumulated in the same chunked pass over the pixels.
+    """
     try:
-        image_array = np.array(image_pil)
+        image_array = ensure_context(image_pil, context).rgb
+        pixels = image_array.reshape(-1, 3)
+        n = float(len(pixels))
         stats = {}
         
-        # Per-channel statistics
+        # One pass in chunks: histogram (key = channel * 256 + value) and Gram matrix together
+        channel_offsets = np.array([0, 256, 512], dtype=np.int32)
+        hist = np.zeros(768, dtype=np.int64)
+        gram = np.zeros((3, 3))
+        for start in range(0, len(pixels), 1 << 20):
+            chunk = pixels[start:start + (1 << 20)]
+            hist += np.bincount((chunk + channel_offsets).ravel(), minlength=768)
+            chunk = chunk.astype(np.float64)
+            gram += chunk.T @ chunk
+        hist = hist.reshape(3, 256)
+        gram /= n
+        values = np.arange(256, dtype=np.float64)
+        
+        # Per-channel statistics from the histogram
+        means = np.zeros(3)
         for i, channel in enumerate(['R', 'G', 'B']):
-            channel_data = image_array[:, :, i].flatten()
-            stats[f'{channel}_mean'] = float(np.mean(channel_data))
-            stats[f'{channel}_std'] = float(np.std(channel_data))
-            stats[f'{channel}_skewness'] = float(calculate_skewness(channel_data))
-            stats[f'{channel}_kurtosis'] = float(calculate_kurtosis(channel_data))
-            stats[f'{channel}_entropy'] = float(safe_entropy(image_array[:, :, i]))
-        
-        # Cross-channel correlation
-        r_channel = image_array[:, :, 0].flatten()
-        g_channel = image_array[:, :, 1].flatten()
-        b_channel = image_array[:, :, 2].flatten()
-        
-        stats['rg_correlation'] = float(np.corrcoef(r_channel, g_channel)[0, 1])
-        stats['rb_correlation'] = float(np.corrcoef(r_channel, b_channel)[0, 1])
-        stats['gb_correlation'] = float(np.corrcoef(g_channel, b_channel)[0, 1])
-        
-        # Overall statistics
-        stats['overall_entropy'] = float(safe_entropy(image_array))
+            p = hist[i] / n
+            mean = float(p @ values)
+            centered = values - mean
+            var = float(p @ centered ** 2)
+            std = np.sqrt(var)
+            means[i] = mean
+            stats[f'{channel}_mean'] = mean
+            stats[f'{channel}_std'] = float(std)
+            stats[f'{channel}_skewness'] = float(p @ centered ** 3 / std ** 3) if std > 0 else 0.0
+            stats[f'{channel}_kurtosis'] = float(p @ centered ** 4 / var ** 2 - 3) if std > 0 else 0.0
+            stats[f'{channel}_entropy'] = histogram_entropy(hist[i])
+        
+        # Cross-channel correlation from one 3x3 covariance
+        cov = gram - np.outer(means, means)
+        sd = np.sqrt(np.maximum(np.diag(cov), 0))
+        corr = cov / np.where(np.outer(sd, sd) > 0, np.outer(sd, sd), np.nan)
+        
+        stats['rg_correlation'] = float(corr[0, 1])
+        stats['rb_correlation'] = float(corr[0, 2])
+        stats['gb_correlation'] = float(corr[1, 2])
+        
+        # Overall statistics (value histogram pooled over channels)
+        stats['overall_entropy'] = histogram_entropy(hist.sum(axis=0))
         
         return stats
         
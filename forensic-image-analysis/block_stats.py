@@ -0,0 +1,113 @@
+"""
+Block Statistics Module for Forensic Image Analysis System
+Shared summed-area tables answering block mean/variance queries for every block-based stage
+"""
+
+import numpy as np
+import cv2
+
+# ======================= Grid Helpers =======================
+
+def tiled_grid(shape, block_size):
+    """(n_rows, n_cols) of non-overlapping blocks; an image smaller than a block is one block"""
+    h, w = shape[:2]
+    return max(1, h // block_size), max(1, w // block_size)
+
+def sliding_grid(shape, block_size, step):
+    """(n_rows, n_cols) of blocks at range(0, dim - block_size, step), the K-means/ELA-region convention"""
+    h, w = shape[:2]
+    return len(range(0, h - block_size, step)), len(range(0, w - block_size, step))
+
+# ======================= Block Statistics Service =======================
+
+class BlockStats:
+    """Lazily built integral images (sum and sum of squares) of named image planes
+
+    Planes are registered as arrays or zero-argument factories; the plane and its
+    summed-area tables are only materialised on the first query. Every query is
+    O(1) per block for any block size and stride and returns grid-shaped arrays
+    ((n_rows, n_cols) or (n_rows, n_cols, channels)).
+    """
+
+    def __init__(self):
+        self._sources = {}
+        self._planes = {}
+        self._tables = {}
+
+    def __contains__(self, name):
+        return name in self._sources
+
+    def __repr__(self):
+        return f"BlockStats(planes={list(self._sources)}, built={list(self._tables)})"
+
+    def add_plane(self, name, plane):
+        """Register an array or a factory under name, replacing any previous plane"""
+        self._sources[name] = plane
+        self._planes.pop(name, None)
+        self._tables.pop(name, None)
+
+    def release(self, *names):
+        """Drop built planes/tables (all when no names given) to free memory; sources stay registered"""
+        for name in names or list(self._sources):
+            if callable(self._sources.get(name)):
+                self._planes.pop(name, None)
+            self._tables.pop(name, None)
+
+    def plane(self, name):
+        """The plane array itself (built on first access)"""
+        if name not in self._planes:
+            source = self._sources[name]
+            self._planes[name] = source() if callable(source) else source
+        return self._planes[name]
+
+    def shape(self, name='rgb'):
+        return self.plane(name).shape[:2]
+
+    def _integrals(self, name):
+        if name not in self._tables:
+            plane = self.plane(name)
+            if plane.dtype not in (np.uint8, np.float32, np.float64):
+                plane = plane.astype(np.float64)
+            total, total_sq = cv2.integral2(plane, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+            if total.ndim == 2:
+                total, total_sq = total[..., None], total_sq[..., None]
+            self._tables[name] = (total, total_sq)
+        return self._tables[name]
+
+    def _box_means(self, name, block_size, step, n_rows, n_cols):
+        h, w = self.shape(name)
+        bh, bw = min(block_size, h), min(block_size, w)
+        step = step or block_size
+        if n_rows is None or n_cols is None:
+            n_rows, n_cols = tiled_grid((h, w), block_size) if step == block_size else sliding_grid((h, w), block_size, step)
+        r0, c0 = np.arange(n_rows) * step, np.arange(n_cols) * step
+        r1, c1 = r0 + bh, c0 + bw
+        area = float(bh * bw)
+
+        def box(table):
+            return (table[np.ix_(r1, c1)] - table[np.ix_(r0, c1)] -
+                    table[np.ix_(r1, c0)] + table[np.ix_(r0, c0)]) / area
+
+        total, total_sq = self._integrals(name)
+        return box(total), box(total_sq), self.plane(name).ndim == 2
+
+    def mean(self, name, block_size, step=None, n_rows=None, n_cols=None):
+        """Per-block mean; default grid is non-overlapping tiles (step=None) or the sliding convention"""
+        mean, _, single = self._box_means(name, block_size, step, n_rows, n_cols)
+        return mean[..., 0] if single else mean
+
+    def var(self, name, block_size, step=None, n_rows=None, n_cols=None):
+        """Per-block population variance"""
+        mean, mean_sq, single = self._box_means(name, block_size, step, n_rows, n_cols)
+        var = np.maximum(mean_sq - mean ** 2, 0)
+        return var[..., 0] if single else var
+
+    def mean_std(self, name, block_size, step=None, n_rows=None, n_cols=None):
+        """Per-block mean and population std from one pair of table lookups"""
+        mean, mean_sq, single = self._box_means(name, block_size, step, n_rows, n_cols)
+        std = np.sqrt(np.maximum(mean_sq - mean ** 2, 0))
+        return (mean[..., 0], std[..., 0]) if single else (mean, std)
+
+    def std(self, name, block_size, step=None, n_rows=None, n_cols=None):
+        """Per-block population std"""
+        return self.mean_std(name, block_size, step, n_rows, n_cols)[1]
@@ -7,7 +7,11 @@ ELA_QUALITIES = [70, 80, 90, 95]
 ELA_SCALE_FACTOR = 20
 BLOCK_SIZE = 16
 NOISE_BLOCK_SIZE = 32
+NOISE_BAND_PIXELS = 4000000  # pixels per batched-FFT band in noise analysis (bounds memory)
+NOISE_MAP_WINDOW = 15        # box window of the dense noise-level map
 TEXTURE_BLOCK_SIZE = 64
+TEXTURE_PROFILE = 'glcm'     # 'glcm' or 'glcm_lbp' (adds per-block LBP histogram distances)
+TEXTURE_GLCM_LEVELS = 256   # gray levels for GLCM texture; 256 reproduces skimage exactly, 32 is much coarser/faster
 
 # Feature detection parameters
 SIFT_FEATURES = 3000
@@ -18,12 +22,98 @@ ORB_FEATURES = 2000
 ORB_SCALE_FACTOR = 1.2
 ORB_LEVELS = 8
 
+# Tiled full-resolution feature extraction (images larger than TARGET_MAX_DIM)
+TILED_FEATURES = True
+TILE_SIZE = 1024
+TILE_OVERLAP = 64
+TILED_SIFT_FEATURES = 6000   # total budget, split evenly across tiles
+TILED_ORB_FEATURES = 4000
+ANMS_CANDIDATE_FACTOR = 3    # over-detect per tile before ANMS
+ANMS_ROBUST_COEFF = 0.9
+TILE_WORKERS = None          # None = os.cpu_count()
+
 # Copy-move detection parameters
 RATIO_THRESH = 0.7
 MIN_DISTANCE = 40
 RANSAC_THRESH = 5.0
 MIN_INLIERS = 8
 
+# Two-pass coarse-to-fine copy-move search
+COPY_MOVE_TWO_PASS = True
+COARSE_MAX_DIM = 800
+COARSE_ORB_FEATURES = 3000
+COARSE_HAMMING_THRESH = 64
+COARSE_MIN_VOTES = 5
+CANDIDATE_PADDING = 0.25     # window padding, fraction of candidate size
+MAX_CANDIDATE_PAIRS = 8
+DENSE_ZNCC_WINDOW = 7
+DENSE_ZNCC_THRESH = 0.9
+AFFINE_SCALE_RANGE = (0.5, 2.0)  # allowed singular values of a clone affine (det must be > 0)
+IDENTITY_TOLERANCE = 0.05        # max |A - I| entry for a linear part treated as identity
+
+# Dense PatchMatch copy-move field
+PATCHMATCH_ENABLED = True     # recall ~0.75 on 0-90 degree clones of the regression mosaic, ~1.6 s at 1500x1125
+PATCHMATCH_STRIDE = 3         # field is computed on a stride-subsampled grid
+PATCHMATCH_RADIUS = 8         # Zernike patch radius (pixels of the subsampled grid)
+PATCHMATCH_ITERATIONS = 3
+PATCHMATCH_RANDOM_SAMPLES = 2     # random-search candidates per pixel and iteration
+PATCHMATCH_SEED_SUBSAMPLE = 3     # KD-tree seeding on every n-th grid pixel
+PATCHMATCH_SEED_NEIGHBOURS = 16
+PATCHMATCH_FEATURE_BLUR = 1.5     # sigma; rotated lattices land between grid cells
+PATCHMATCH_MAX_RESIDUAL = 3.0     # max local affine-fit residual of the offset field (grid pixels^2)
+PATCHMATCH_UNIQUE_SHIFT = 4       # dense check drops pixels that also match 4 px off (edges, stripes)
+PATCHMATCH_MIN_OFFSET = 16    # in subsampled grid pixels, rejects self/near-self matches
+PATCHMATCH_MIN_AREA = 64      # minimum connected clone area on the grid
+# (3, 3) and (4, 4) alias badly on rotated 16-17 px patches
+ZERNIKE_ORDERS = [(0, 0), (1, 1), (2, 0), (2, 2), (3, 1), (4, 0), (4, 2)]
+
+# Block copy-move features: 'resize8' (legacy signature), 'zernike', 'fourier_mellin'
+BLOCK_FEATURE_TYPE = 'resize8'
+BLOCK_FEATURE_DIST = 0.35        # max RMS distance between standardised invariant block features
+BLOCK_MIN_CLUSTER = 12           # verified (src, dst) matches needed to accept a clone (~32 px at step 4)
+BLOCK_MIN_STD = 5.0              # flat blocks match anything; skip them
+BLOCK_VERIFY_ERROR = 0.5         # max ||src - dst|| / ||dst - mean|| of a pixel-verified invariant match
+BLOCK_FEATURE_BLUR = 1.0         # Gaussian sigma before block features; clone blocks sit up to step/2 off the grid
+FM_LOG_POLAR_SHAPE = (8, 16)     # (radial, angular) samples of the Fourier-Mellin transform
+FM_COEFFS = (8, 2)               # (radial samples, angular harmonics) kept from the log-polar spectrum
+
+# K-means tampering localization: 'blocks' (overlapping fixed blocks) or 'superpixel'
+LOCALIZATION_MODE = 'blocks'
+SUPERPIXEL_SEGMENTS = 400        # target SLIC segment count
+SUPERPIXEL_COMPACTNESS = 10
+SUPERPIXEL_MAX_DIM = 512         # segmentation runs at this size, labels upsampled
+KMEANS_STREAM_CHUNK = 4096       # samples per partial_fit step when a warm-start state is used
+
+# Double quantization map (per 8x8 block, aligned JPEG grid)
+DQ_COEFFICIENTS = 9              # low-frequency AC coefficients (zig-zag order) examined
+DQ_HIST_RANGE = 24               # histogram of quantization indices over [-range, range]
+DQ_MAX_PRIMARY_STEP = 64         # largest first-compression step tried
+DQ_MIN_GAIN = 0.35               # excess histogram mass on reachable indices to call a coefficient double quantized
+DQ_MIN_SAMPLES = 500             # non-zero coefficient values needed per histogram
+
+# Localization evidence fusion (maps combined on a 1/FUSION_GRID_FACTOR grid)
+FUSION_GRID_FACTOR = 8
+FUSION_METHOD = 'weighted'       # 'weighted' or 'logistic'
+FUSION_WEIGHTS = {'ela': 0.25, 'ghost': 0.15, 'noise': 0.1, 'dq': 0.1, 'kmeans': 0.15, 'copy_move': 0.25}
+# Replace with fusion.fit_logistic_fusion() output trained on labelled data
+FUSION_LOGISTIC_MODEL = {
+    'bias': -4.0,
+    'weights': {'ela': 3.0, 'ghost': 1.5, 'noise': 1.0, 'dq': 1.0, 'kmeans': 1.5, 'copy_move': 4.0}
+}
+FUSION_THRESHOLD = 0.35
+FUSION_POINT_SPREAD = 2.0        # Gaussian spread of rasterised keypoints, in grid cells
+
+# Cross-image splice-source retrieval index
+INDEX_MAX_SIFT_PER_IMAGE = 500
+INDEX_MAX_ORB_PER_IMAGE = 500
+INDEX_PCA_DIMS = 32
+INDEX_N_LISTS = 1024           # IVF coarse cells (capped by training sample size)
+INDEX_PQ_SUBSPACES = 8         # PQ: INDEX_PCA_DIMS / INDEX_PQ_SUBSPACES dims per byte code
+INDEX_TRAIN_SAMPLES = 100000
+INDEX_NPROBE = 8
+INDEX_IMAGE_MAX_DIM = 1024
+INDEX_SCALE_RANGE = (0.125, 8.0)  # query/donor similarity scale (normalised coordinates) accepted for a region
+
 # Classification thresholds
 DETECTION_THRESHOLD = 45
 CONFIDENCE_THRESHOLD = 60
@@ -35,3 +125,48 @@ MIN_FILE_SIZE = 50000  # 50KB
 # Processing parameters
 TARGET_MAX_DIM = 1500
 MAX_SAMPLES_DBSCAN = 50000
+
+# Preprocessing profile: 'none', 'bilateral', 'guided' or 'nlm' (fastNlMeansDenoisingColored)
+PREPROCESS_PROFILE = 'bilateral'
+# Measured cost in ms per megapixel (1500 px image, validation.benchmark_preprocess_profiles)
+PREPROCESS_PROFILE_COSTS = {'none': 0.0, 'bilateral': 25.0, 'guided': 77.0, 'nlm': 2687.0}
+# Which preprocessed image each stage reads: 'raw' (resized only) or 'denoised' (profile output).
+# Stages measuring noise/compression traces must see raw pixels.
+STAGE_INPUTS = {
+    'ela': 'raw',
+    'features': 'denoised',
+    'copy_move_two_pass': 'denoised',
+    'copy_move_blocks': 'denoised',
+    'patchmatch': 'denoised',
+    'noise': 'raw',
+    'noise_map': 'raw',
+    'jpeg': 'raw',
+    'frequency': 'raw',
+    'texture': 'denoised',
+    'edge': 'denoised',
+    'illumination': 'denoised',
+    'statistics': 'raw',
+    'localization': 'raw'
+}
+
+# Load-time JPEG decode: libjpeg DCT-domain reduction (1/2, 1/4, 1/8) down to TARGET_MAX_DIM
+JPEG_DRAFT_DECODE = True
+# Stages that explicitly request the full-resolution decode (empty = never decode full frame)
+# ('jpeg': the double-quantization map needs the file's own 8x8 grid)
+FULL_RESOLUTION_STAGES = ['features', 'copy_move_two_pass', 'jpeg']
+
+# Bulk metadata scanning (metadata_scan.scan_metadata_directory)
+METADATA_SCAN_WORKERS = 8
+
+# Pre-decode planning (validation.plan_image_processing): peak memory model, calibrated on
+# measured peak RSS (1.1 MP and 12 MP JPEGs). Working-resolution bytes per pixel per stage:
+STAGE_MEMORY_BYTES_PER_PIXEL = {
+    'ela': 72, 'features': 24, 'copy_move_two_pass': 16, 'copy_move_blocks': 24, 'patchmatch': 48,
+    'noise': 120, 'noise_map': 16, 'jpeg': 140, 'frequency': 24, 'texture': 24, 'edge': 32,
+    'illumination': 40, 'statistics': 8, 'localization': 32
+}
+# Full-resolution bytes per pixel for stages in FULL_RESOLUTION_STAGES (plus 3 B/px decode)
+FULL_RESOLUTION_BYTES_PER_PIXEL = {'features': 48, 'copy_move_two_pass': 24, 'jpeg': 36}
+PIPELINE_BASE_MEMORY = 200 * 1024 ** 2      # interpreter + libraries
+MEMORY_BUDGET_BYTES = 4 * 1024 ** 3
+MAX_DECODE_PIXELS = 100000000                # decompression-bomb guard (header width x height), also PIL's MAX_IMAGE_PIXELS
@@ -3,11 +3,24 @@ Copy-move detection functions
 """
 
 import numpy as np
+from math import factorial
 import cv2
+from scipy.spatial import cKDTree
 from sklearn.cluster import KMeans, DBSCAN, MiniBatchKMeans
-from sklearn.preprocessing import normalize as sk_normalize
-from feature_detection import match_sift_features, match_orb_features, match_akaze_features
+from sklearn.preprocessing import normalize as sk_normalize, StandardScaler
+from scipy import ndimage
+from feature_detection import (match_sift_features, match_orb_features, match_akaze_features,
+                               concatenate_match_sets, keypoints_to_feature_set, merge_feature_sets,
+                               knn_self_match_candidates, MatchSet, DETECTOR_NAMES)
 from config import *
+from block_stats import BlockStats, sliding_grid
+from image_context import ensure_context
+
+try:
+    from skimage.segmentation import slic
+    SKIMAGE_AVAILABLE = True
+except ImportError:
+    SKIMAGE_AVAILABLE = False
 
 def detect_copy_move_advanced(feature_sets, image_shape,
                             ratio_thresh=RATIO_THRESH, min_distance=MIN_DISTANCE,
@@ -17,41 +30,47 @@ def detect_copy_move_advanced(feature_sets, image_shape,
     best_inliers = 0
     best_transform = None
     
-    for detector_name, (keypoints, descriptors) in feature_sets.items():
-        if descriptors is None or len(descriptors) < 10:
+    for detector_name, feature_set in feature_sets.items():
+        if feature_set.descriptors is None or len(feature_set.descriptors) < 10:
             continue
         
-        print(f"  - Analyzing {detector_name.upper()} features: {len(keypoints)} keypoints")
+        print(f"  - Analyzing {detector_name.upper()} features: {len(feature_set)} keypoints")
         
         # Feature matching
         if detector_name == 'sift':
             matches, inliers, transform = match_sift_features(
-                keypoints, descriptors, ratio_thresh, min_distance, ransac_thresh, min_inliers)
+                feature_set, ratio_thresh, min_distance, ransac_thresh, min_inliers)
         elif detector_name == 'orb':
             matches, inliers, transform = match_orb_features(
-                keypoints, descriptors, min_distance, ransac_thresh, min_inliers)
+                feature_set, min_distance, ransac_thresh, min_inliers)
         else:  # akaze
             matches, inliers, transform = match_akaze_features(
-                keypoints, descriptors, min_distance, ransac_thresh, min_inliers)
+                feature_set, min_distance, ransac_thresh, min_inliers)
         
-        all_matches.extend(matches)
+        all_matches.append(matches)
         if inliers > best_inliers:
             best_inliers = inliers
             best_transform = transform
     
-    return all_matches, best_inliers, best_transform
+    return concatenate_match_sets(all_matches), best_inliers, best_transform
 
-def detect_copy_move_blocks(image_pil, block_size=BLOCK_SIZE, threshold=0.95):
-    """Enhanced block-based copy-move detection"""
-    print("  - Block-based copy-move detection...")
+def detect_copy_move_blocks(image_pil, block_size=BLOCK_SIZE, threshold=0.95,
+                            feature_type=BLOCK_FEATURE_TYPE, context=None):
+    """Enhanced block-based copy-move detection
     
-    if image_pil.mode != 'RGB':
-        image_pil = image_pil.convert('RGB')
+    feature_type 'resize8' hashes an 8x8 thumbnail of each block (exact clones only);
+    'zernike' and 'fourier_mellin' use batched rotation/scale-invariant block
+    features (see extract_invariant_block_features) with nearest-neighbour matching.
+    """
+    print("  - Block-based copy-move detection...")
     
-    image_array = np.array(image_pil)
-    gray = cv2.cvtColor(image_array, cv2.COLOR_RGB2GRAY)
+    gray = ensure_context(image_pil, context).gray
     h, w = gray.shape
     
+    if feature_type != 'resize8':
+        matches = match_invariant_blocks(gray, block_size, feature_type, zncc_threshold=threshold)
+        return deduplicate_block_matches(matches, block_size)
+    
     blocks = {}
     matches = []
     
@@ -93,7 +112,10 @@ def detect_copy_move_blocks(image_pil, block_size=BLOCK_SIZE, threshold=0.95):
                             'distance': distance
                         })
     
-    # Remove duplicate matches
+    return deduplicate_block_matches(matches, block_size)
+
+def deduplicate_block_matches(matches, block_size):
+    """Remove matches whose first block overlaps an already accepted match"""
     unique_matches = []
     for match in matches:
         is_duplicate = False
@@ -107,12 +129,135 @@ def detect_copy_move_blocks(image_pil, block_size=BLOCK_SIZE, threshold=0.95):
     
     return unique_matches
 
-def kmeans_tampering_localization(image_pil, ela_image, n_clusters=3):
-    """K-means clustering untuk localization tampering - OPTIMIZED VERSION"""
+def block_grid_max(plane, block_size, step, n_rows, n_cols):
+    """Max of every block on a strided grid via step-sized max-pool cells"""
+    if block_size % step:
+        # Block does not tile into whole cells - exact strided window view instead
+        windows = np.lib.stride_tricks.sliding_window_view(plane, (block_size, block_size))
+        return windows[:n_rows * step:step, :n_cols * step:step].max(axis=(2, 3))
+    k = block_size // step
+    cells_h, cells_w = n_rows + k - 1, n_cols + k - 1
+    pad_h = max(0, cells_h * step - plane.shape[0])
+    pad_w = max(0, cells_w * step - plane.shape[1])
+    if pad_h or pad_w:
+        plane = np.pad(plane, ((0, pad_h), (0, pad_w)), mode='edge')
+    cells = plane[:cells_h * step, :cells_w * step].reshape(cells_h, step, cells_w, step).max(axis=(1, 3))
+    out = cells[:n_rows, :n_cols].copy()
+    for di in range(k):
+        for dj in range(k):
+            np.maximum(out, cells[di:di + n_rows, dj:dj + n_cols], out=out)
+    return out
+
+def extract_block_cluster_features(image_array, ela_array, block_size, block_step, context=None):
+    """10-dim K-means feature per block (ELA mean/std/max, RGB mean/std, gray var) without Python loops
+
+    Means/variances come from the ImageContext integrals ('ela', 'rgb', 'gray').
+    """
+    h, w = ela_array.shape
+    n_rows, n_cols = sliding_grid((h, w), block_size, block_step)
+    if n_rows == 0 or n_cols == 0:
+        return np.zeros((0, 10)), np.zeros((0, 2), dtype=np.int32)
+
+    if context is None:
+        context = BlockStats()
+        context.add_plane('rgb', image_array)
+        context.add_plane('gray', lambda: cv2.cvtColor(image_array, cv2.COLOR_RGB2GRAY))
+    if 'ela' not in context:
+        context.add_plane('ela', ela_array)
+
+    grid = dict(step=block_step, n_rows=n_rows, n_cols=n_cols)
+    ela_mean, ela_std = context.mean_std('ela', block_size, **grid)
+    ela_max = block_grid_max(ela_array, block_size, block_step, n_rows, n_cols)
+    rgb_mean, rgb_std = context.mean_std('rgb', block_size, **grid)
+    gray_var = context.var('gray', block_size, **grid)
+
+    features = np.concatenate([
+        ela_mean[..., None], ela_std[..., None], ela_max[..., None].astype(np.float64),
+        rgb_mean, rgb_std, gray_var[..., None]
+    ], axis=2).reshape(-1, 10)
+
+    rows, cols = np.meshgrid(np.arange(n_rows) * block_step, np.arange(n_cols) * block_step, indexing='ij')
+    coordinates = np.stack([rows.ravel(), cols.ravel()], axis=1)
+    return features, coordinates
+
+def paint_block_labels(labels, coordinates, block_size, step, shape):
+    """uint8 label map from a strided block grid; where blocks overlap the later block wins"""
+    h, w = shape
+    label_map = np.zeros((h, w), dtype=np.uint8)
+    if len(labels) == 0:
+        return label_map
+    n_rows = len(np.unique(coordinates[:, 0]))
+    n_cols = len(labels) // n_rows
+    grid = np.asarray(labels, dtype=np.uint8).reshape(n_rows, n_cols)
+    # Each step x step cell belongs to the last block covering it; the final block row/column
+    # additionally covers block_size - step pixels beyond its cell
+    painted = np.repeat(np.repeat(grid, step, axis=0), step, axis=1)
+    painted = np.pad(painted, ((0, block_size - step), (0, block_size - step)), mode='edge')
+    ph, pw = min(h, painted.shape[0]), min(w, painted.shape[1])
+    label_map[:ph, :pw] = painted[:ph, :pw]
+    return label_map
+
+def create_kmeans_state(n_clusters=3, mode=LOCALIZATION_MODE):
+    """Persistent warm-start state for kmeans_tampering_localization across a batch of images
+    
+    A state belongs to one localization mode ('blocks' and 'superpixel' use different
+    feature vectors); its feature dimension and its scaler are fixed by the first
+    image it sees.
+    """
+    return {
+        'scaler': StandardScaler(),
+        'kmeans': MiniBatchKMeans(n_clusters=n_clusters, random_state=42, batch_size=1024, n_init=3),
+        'mode': mode,
+        'n_features': None,
+        'n_images': 0
+    }
+
+def fit_predict_with_state(features, kmeans_state, mode):
+    """Stream one image's features into a warm-start state with partial_fit, then label them
+    
+    The scaler is fitted on the first image only and frozen afterwards: the centroids
+    live in scaled space, so re-fitting it per image would move every centroid
+    relative to the features and make labels depend on the image order.
+    Returns (labels, fitted model, cluster centers in raw feature space).
+    """
+    if kmeans_state['mode'] != mode:
+        raise ValueError(f"K-means state was created for mode '{kmeans_state['mode']}', not '{mode}'")
+    if kmeans_state['n_features'] is None:
+        kmeans_state['n_features'] = features.shape[1]
+    elif kmeans_state['n_features'] != features.shape[1]:
+        raise ValueError(f"K-means state expects {kmeans_state['n_features']} features, got {features.shape[1]}")
+    
+    scaler, kmeans = kmeans_state['scaler'], kmeans_state['kmeans']
+    if kmeans_state['n_images'] == 0:
+        scaler.fit(features)
+    scaled = scaler.transform(features)
+    
+    # Shuffled chunks so no single region of the image dominates an update
+    order = np.random.default_rng(kmeans_state['n_images']).permutation(len(scaled))
+    for start in range(0, len(order), KMEANS_STREAM_CHUNK):
+        chunk = scaled[order[start:start + KMEANS_STREAM_CHUNK]]
+        if len(chunk) >= kmeans.n_clusters:
+            kmeans.partial_fit(chunk)
+    kmeans_state['n_images'] += 1
+    return kmeans.predict(scaled), kmeans, scaler.inverse_transform(kmeans.cluster_centers_)
+
+def kmeans_tampering_localization(image_pil, ela_image, n_clusters=3, mode=LOCALIZATION_MODE,
+                                  kmeans_state=None, context=None):
+    """K-means clustering untuk localization tampering - OPTIMIZED VERSION
+    
+    With kmeans_state (from create_kmeans_state) the centroids persist across calls and
+    are only refined with partial_fit, so similar images in a batch skip a full re-fit.
+    'cluster_centers' are always in raw (unscaled) feature space.
+    context (ImageContext of the same image) shares its planes and integrals with the other stages.
+    """
+    context = ensure_context(image_pil, context)
+    if mode == 'superpixel':
+        return superpixel_tampering_localization(image_pil, ela_image, n_clusters, kmeans_state, context)
+    
     print("🔍 Performing K-means tampering localization...")
     
-    # Konversi ke array
-    image_array = np.array(image_pil.convert('RGB'))
+    # Array dari ImageContext (tanpa konversi ulang)
+    image_array = context.rgb
     ela_array = np.array(ela_image)
     h, w = ela_array.shape
     
@@ -130,79 +275,42 @@ def kmeans_tampering_localization(image_pil, ela_image, n_clusters=3):
     
     print(f"  - Using block_size={block_size}, step={block_step} for {h}x{w} image")
     
-    # Ekstrak features untuk clustering
-    features = []
-    coordinates = []
-    
-    # Feature extraction per block dengan adaptive sampling
-    for i in range(0, h-block_size, block_step):
-        for j in range(0, w-block_size, block_step):
-            # ELA features
-            ela_block = ela_array[i:i+block_size, j:j+block_size]
-            ela_mean = np.mean(ela_block)
-            ela_std = np.std(ela_block)
-            ela_max = np.max(ela_block)
-            
-            # Color features
-            rgb_block = image_array[i:i+block_size, j:j+block_size]
-            rgb_mean = np.mean(rgb_block, axis=(0,1))
-            rgb_std = np.std(rgb_block, axis=(0,1))
-            
-            # Texture features (simple)
-            gray_block = cv2.cvtColor(rgb_block, cv2.COLOR_RGB2GRAY)
-            texture_var = np.var(gray_block)
-            
-            # Combine features
-            feature_vector = [
-                ela_mean, ela_std, ela_max,
-                rgb_mean[0], rgb_mean[1], rgb_mean[2],
-                rgb_std[0], rgb_std[1], rgb_std[2],
-                texture_var
-            ]
-            
-            features.append(feature_vector)
-            coordinates.append((i, j))
-    
-    features = np.array(features)
+    # Ekstrak features untuk clustering - semua block sekaligus via integral image
+    features, coordinates = extract_block_cluster_features(image_array, ela_array, block_size, block_step,
+                                                           context)
     print(f"  - Total features for K-means: {len(features)}")
     
     # K-means clustering with error handling
     try:
+        if kmeans_state is not None:
+            cluster_labels, kmeans, cluster_centers = fit_predict_with_state(features, kmeans_state, 'blocks')
+            n_clusters = kmeans.n_clusters
+            print(f"  - Warm-started MiniBatchKMeans (image #{kmeans_state['n_images']} in state)")
         # Use mini-batch K-means for large datasets
-        if len(features) > 10000:
+        elif len(features) > 10000:
             kmeans = MiniBatchKMeans(n_clusters=n_clusters, random_state=42,
                                    batch_size=100, n_init=3)
             print("  - Using MiniBatchKMeans for efficiency")
         else:
             kmeans = KMeans(n_clusters=n_clusters, random_state=42, n_init=10)
         
-        cluster_labels = kmeans.fit_predict(features)
+        if kmeans_state is None:
+            cluster_labels = kmeans.fit_predict(features)
+            cluster_centers = kmeans.cluster_centers_
     except MemoryError:
         print("  ⚠ Memory error in K-means, reducing clusters")
         n_clusters = 2
         kmeans = KMeans(n_clusters=n_clusters, random_state=42, n_init=3)
         cluster_labels = kmeans.fit_predict(features)
+        cluster_centers = kmeans.cluster_centers_
     
-    # Create localization map
-    localization_map = np.zeros((h, w))
-    
-    # Fill the map based on clustering results
-    for idx, (i, j) in enumerate(coordinates):
-        cluster_id = cluster_labels[idx]
-        # Fill the block area
-        i_end = min(i + block_size, h)
-        j_end = min(j + block_size, w)
-        localization_map[i:i_end, j:j_end] = cluster_id
-    
-    # Identify tampering clusters (highest ELA response)
-    cluster_ela_means = []
-    for cluster_id in range(n_clusters):
-        cluster_mask = (localization_map == cluster_id)
-        if np.sum(cluster_mask) > 0:
-            cluster_ela_mean = np.mean(ela_array[cluster_mask])
-            cluster_ela_means.append(cluster_ela_mean)
-        else:
-            cluster_ela_means.append(0)
+    # Create localization map - upsample label grid (blok overlap: blok terakhir menang)
+    localization_map = paint_block_labels(cluster_labels, coordinates, block_size, block_step, (h, w))
+    
+    # Identify tampering clusters (highest ELA response) - satu bincount untuk semua cluster
+    cluster_sizes = np.bincount(localization_map.ravel(), minlength=n_clusters)[:n_clusters]
+    cluster_sums = np.bincount(localization_map.ravel(), weights=ela_array.ravel(), minlength=n_clusters)[:n_clusters]
+    cluster_ela_means = np.where(cluster_sizes > 0, cluster_sums / np.maximum(cluster_sizes, 1), 0).tolist()
     
     # Cluster dengan ELA tertinggi dianggap sebagai tampering
     tampering_cluster = np.argmax(cluster_ela_means)
@@ -212,7 +320,995 @@ def kmeans_tampering_localization(image_pil, ela_image, n_clusters=3):
         'localization_map': localization_map,
         'tampering_mask': tampering_mask,
         'cluster_labels': cluster_labels,
-        'cluster_centers': kmeans.cluster_centers_,
+        'cluster_centers': cluster_centers,
         'tampering_cluster_id': tampering_cluster,
         'cluster_ela_means': cluster_ela_means
     }
+
+# ======================= Superpixel Localization =======================
+
+def superpixel_segments(image_array, n_segments=SUPERPIXEL_SEGMENTS, max_dim=SUPERPIXEL_MAX_DIM):
+    """Full-resolution int32 segment labels, segmented once on a downscaled copy"""
+    h, w = image_array.shape[:2]
+    scale = min(1.0, max_dim / max(h, w))
+    small = cv2.resize(image_array, (max(1, int(w * scale)), max(1, int(h * scale))),
+                       interpolation=cv2.INTER_AREA) if scale < 1.0 else image_array
+    
+    if SKIMAGE_AVAILABLE:
+        segments = slic(small, n_segments=n_segments, compactness=SUPERPIXEL_COMPACTNESS,
+                        start_label=0).astype(np.int32)
+    else:
+        # Fallback: grid-seeded regular cells (no edge adherence)
+        sh, sw = small.shape[:2]
+        cell = max(1, int(np.sqrt(sh * sw / n_segments)))
+        rows, cols = np.arange(sh) // cell, np.arange(sw) // cell
+        segments = (rows[:, None] * (cols[-1] + 1) + cols[None, :]).astype(np.int32)
+    
+    if scale < 1.0:
+        segments = cv2.resize(segments, (w, h), interpolation=cv2.INTER_NEAREST)
+    # Relabel to a dense 0..n-1 range
+    _, segments = np.unique(segments, return_inverse=True)
+    return segments.reshape(h, w).astype(np.int32)
+
+def segment_mean_var(segments_flat, plane_flat, counts):
+    """Per-segment mean and variance of one plane via bincount"""
+    n = len(counts)
+    plane_flat = plane_flat.astype(np.float64)
+    mean = np.bincount(segments_flat, weights=plane_flat, minlength=n) / counts
+    var = np.bincount(segments_flat, weights=plane_flat ** 2, minlength=n) / counts - mean ** 2
+    return mean, np.maximum(var, 0)
+
+def superpixel_tampering_localization(image_pil, ela_image, n_clusters=3, kmeans_state=None, context=None):
+    """K-means localization over superpixels instead of overlapping fixed blocks"""
+    print("🔍 Performing superpixel K-means tampering localization...")
+    
+    context = ensure_context(image_pil, context)
+    image_array = context.rgb
+    ela_array = np.array(ela_image)
+    h, w = ela_array.shape
+    
+    segments = superpixel_segments(image_array)
+    segments_flat = segments.ravel()
+    n_segments = int(segments_flat.max()) + 1
+    counts = np.maximum(np.bincount(segments_flat, minlength=n_segments), 1).astype(np.float64)
+    print(f"  - {n_segments} superpixels for {h}x{w} image")
+    
+    # Features per segment: ELA mean/std/max, RGB mean/std, texture variance, noise residual
+    gray = context.gray
+    noise = np.abs(context.plane('laplacian'))
+    
+    columns = []
+    ela_mean, ela_var = segment_mean_var(segments_flat, ela_array.ravel(), counts)
+    ela_max = ndimage.maximum(ela_array, labels=segments, index=np.arange(n_segments))
+    columns += [ela_mean, np.sqrt(ela_var), np.asarray(ela_max, dtype=np.float64)]
+    rgb_stats = [segment_mean_var(segments_flat, image_array[..., c].ravel(), counts) for c in range(3)]
+    columns += [m for m, _ in rgb_stats] + [np.sqrt(v) for _, v in rgb_stats]
+    columns.append(segment_mean_var(segments_flat, gray.ravel(), counts)[1])
+    columns.append(segment_mean_var(segments_flat, noise.ravel(), counts)[0])
+    features = np.stack(columns, axis=1)
+    
+    # Few hundred samples: full K-means is cheap and stable
+    if kmeans_state is not None:
+        cluster_labels, kmeans, cluster_centers = fit_predict_with_state(features, kmeans_state, 'superpixel')
+        n_clusters = kmeans.n_clusters
+    else:
+        n_clusters = min(n_clusters, n_segments)
+        scaler = StandardScaler()
+        kmeans = KMeans(n_clusters=n_clusters, random_state=42, n_init=10)
+        cluster_labels = kmeans.fit_predict(scaler.fit_transform(features))
+        cluster_centers = scaler.inverse_transform(kmeans.cluster_centers_)
+    
+    localization_map = cluster_labels.astype(np.uint8)[segments]
+    cluster_sizes = np.bincount(localization_map.ravel(), minlength=n_clusters)
+    cluster_sums = np.bincount(localization_map.ravel(), weights=ela_array.ravel(), minlength=n_clusters)
+    cluster_ela_means = np.where(cluster_sizes > 0, cluster_sums / np.maximum(cluster_sizes, 1), 0).tolist()
+    
+    tampering_cluster = np.argmax(cluster_ela_means)
+    tampering_mask = (localization_map == tampering_cluster)
+    
+    return {
+        'localization_map': localization_map,
+        'tampering_mask': tampering_mask,
+        'cluster_labels': cluster_labels,
+        'cluster_centers': cluster_centers,
+        'tampering_cluster_id': tampering_cluster,
+        'cluster_ela_means': cluster_ela_means,
+        'n_segments': n_segments
+    }
+
+# ======================= Two-Pass Coarse-to-Fine Search =======================
+
+def detect_copy_move_two_pass(image_pil, full_res_image=None, coarse_max_dim=COARSE_MAX_DIM,
+                              min_distance=MIN_DISTANCE, min_inliers=MIN_INLIERS, context=None,
+                              full_res_context=None):
+    """Two-pass copy-move search: global coarse ORB, then SIFT + dense check in candidate windows
+    
+    Pass 1 runs ORB on the whole (downscaled) image without the ELA ROI mask and
+    matches it with LSH, so low-ELA sources are still described. Matches are grouped
+    into candidate region pairs with DBSCAN on (src, dst) coordinates. Pass 2 runs
+    SIFT only inside the padded candidate windows of full_res_image (or image_pil)
+    and verifies each pair densely with ZNCC after warping the source onto the
+    destination. Cost is proportional to the candidate area, not the frame.
+    
+    Geometry in the returned FeatureSet/MatchSet and clone_mask is in image_pil coordinates.
+    full_res_context (e.g. ImageLoader.context_for_stage) reuses an already built full-res gray.
+    """
+    print("  - Two-pass coarse-to-fine copy-move search...")
+    
+    working_w, working_h = image_pil.size
+    if full_res_context is None and full_res_image is not None:
+        full_res_context = ensure_context(full_res_image)
+    if full_res_context is not None:
+        gray_fine = full_res_context.gray
+    else:
+        gray_fine = ensure_context(image_pil, context).gray
+    fine_h, fine_w = gray_fine.shape
+    
+    # Pass 1: global ORB on a downscaled copy
+    coarse_scale = min(1.0, coarse_max_dim / max(fine_w, fine_h))
+    gray_coarse = cv2.resize(gray_fine, (max(1, int(fine_w * coarse_scale)), max(1, int(fine_h * coarse_scale))),
+                             interpolation=cv2.INTER_AREA)
+    fine_min_distance = min_distance * fine_w / working_w
+    candidates = find_candidate_region_pairs(gray_coarse, fine_min_distance * coarse_scale)
+    print(f"  - Coarse pass: {len(candidates)} candidate region pairs")
+    
+    # Pass 2: SIFT + dense verification inside candidate windows at full resolution
+    clone_mask_fine = np.zeros((fine_h, fine_w), dtype=np.uint8)
+    feature_parts, match_pairs, match_dists = [], [], []
+    verified_pairs = []
+    best_inliers, best_transform = 0, None
+    offset = 0
+    
+    for src_box, dst_box, coarse_M in candidates:
+        src_win = _scale_pad_box(src_box, 1.0 / coarse_scale, fine_w, fine_h)
+        dst_win = _scale_pad_box(dst_box, 1.0 / coarse_scale, fine_w, fine_h)
+        M = coarse_M.copy()
+        M[:, 2] /= coarse_scale
+        
+        fs_src, fs_dst, pairs, dists, fine_M, inliers = _match_windows_sift(gray_fine, src_win, dst_win,
+                                                                             fine_min_distance)
+        if fine_M is not None and inliers >= min_inliers:
+            M = fine_M
+        # Padded windows may overlap; a transform mapping the window onto itself is a self-match
+        if not plausible_affine(M) or is_self_match_transform(M, src_win, fine_min_distance):
+            continue
+        
+        # Both are required: SIFT inliers alone can fit a degenerate affine, and dense ZNCC
+        # alone fires on smooth or periodic texture under the coarse transform
+        if inliers < min_inliers:
+            continue
+        dense_dst, dense_src = verify_clone_dense(gray_fine, src_win, dst_win, M)
+        dense_pixels = int(np.count_nonzero(dense_dst))
+        if dense_pixels == 0:
+            continue
+        
+        sx0, sy0, sx1, sy1 = src_win
+        dx0, dy0, dx1, dy1 = dst_win
+        clone_mask_fine[dy0:dy1, dx0:dx1] |= dense_dst
+        clone_mask_fine[sy0:sy1, sx0:sx1] |= dense_src
+        
+        if len(pairs) > 0:
+            feature_parts.extend([fs_src, fs_dst])
+            match_pairs.append(pairs + np.int32([offset, offset + len(fs_src)]))
+            match_dists.append(dists)
+            offset += len(fs_src) + len(fs_dst)
+        
+        verified_pairs.append({
+            'source_window': tuple(int(v) for v in src_win),
+            'target_window': tuple(int(v) for v in dst_win),
+            'transform': M,
+            'sift_inliers': int(inliers),
+            'dense_pixels': dense_pixels
+        })
+        if inliers > best_inliers:
+            best_inliers = inliers
+            best_transform = ('affine', M)
+    
+    scale = (working_w / fine_w, working_h / fine_h)
+    feature_set = merge_feature_sets(feature_parts, scale=scale)
+    if match_pairs:
+        matches = MatchSet(np.concatenate(match_pairs), np.concatenate(match_dists),
+                           np.full(sum(len(p) for p in match_pairs), DETECTOR_NAMES.index('sift'), dtype=np.int8))
+    else:
+        matches = MatchSet()
+    
+    clone_mask = cv2.resize(clone_mask_fine, (working_w, working_h), interpolation=cv2.INTER_NEAREST) > 0
+    print(f"  - Fine pass: {len(verified_pairs)} verified pairs, {best_inliers} SIFT inliers")
+    
+    return {
+        'candidate_pairs': verified_pairs,
+        'n_candidates': len(candidates),
+        'feature_set': feature_set,
+        'matches': matches,
+        'inliers': int(best_inliers),
+        'transform': best_transform,
+        'clone_mask': clone_mask,
+        'clone_percentage': float(np.mean(clone_mask) * 100)
+    }
+
+def find_candidate_region_pairs(gray_coarse, min_distance, max_pairs=MAX_CANDIDATE_PAIRS):
+    """Coarse ORB + LSH self-matching, grouped into (src_box, dst_box, affine) candidates"""
+    orb = cv2.ORB_create(nfeatures=COARSE_ORB_FEATURES, scaleFactor=ORB_SCALE_FACTOR, nlevels=ORB_LEVELS)
+    keypoints, descriptors = orb.detectAndCompute(gray_coarse, None)
+    if descriptors is None or len(keypoints) < COARSE_MIN_VOTES:
+        return []
+    
+    fs = keypoints_to_feature_set(keypoints, descriptors)
+    FLANN_INDEX_LSH = 6
+    index_params = dict(algorithm=FLANN_INDEX_LSH, table_number=6, key_size=12, multi_probe_level=1)
+    flann = cv2.FlannBasedMatcher(index_params, dict(checks=32))
+    knn = flann.knnMatch(descriptors, descriptors, k=4)
+    
+    # LSH is approximate, so the self-match is not guaranteed to come first;
+    # the spatial distance filter removes it instead
+    matches = knn_self_match_candidates(knn, fs.xy, min_distance, COARSE_HAMMING_THRESH, 'orb', skip_first=False)
+    if len(matches) < COARSE_MIN_VOTES:
+        return []
+    
+    src = fs.xy[matches.pairs[:, 0]]
+    dst = fs.xy[matches.pairs[:, 1]]
+    # Canonical orientation so A->B and B->A fall into the same cluster
+    swap = (src[:, 1] > dst[:, 1]) | ((src[:, 1] == dst[:, 1]) & (src[:, 0] > dst[:, 0]))
+    src[swap], dst[swap] = dst[swap].copy(), src[swap].copy()
+    
+    eps = 0.06 * max(gray_coarse.shape)
+    labels = DBSCAN(eps=eps, min_samples=COARSE_MIN_VOTES).fit_predict(np.hstack([src, dst]))
+    
+    candidates = []
+    for label in np.unique(labels[labels >= 0]):
+        idx = labels == label
+        M, mask = cv2.estimateAffinePartial2D(src[idx], dst[idx], method=cv2.RANSAC,
+                                              ransacReprojThreshold=RANSAC_THRESH)
+        if M is None or np.sum(mask) < COARSE_MIN_VOTES or not plausible_affine(M):
+            continue
+        inl = mask.ravel() == 1
+        candidates.append((int(np.sum(mask)), _bbox(src[idx][inl]), _bbox(dst[idx][inl]), M))
+    
+    candidates.sort(key=lambda c: -c[0])
+    return [(s, d, M) for _, s, d, M in candidates[:max_pairs]]
+
+def plausible_affine(M, scale_range=AFFINE_SCALE_RANGE):
+    """True for an orientation-preserving 2x3 affine whose singular values lie in scale_range"""
+    if M is None or not np.all(np.isfinite(M)):
+        return False
+    A = np.asarray(M, dtype=np.float64)[:, :2]
+    singular = np.linalg.svd(A, compute_uv=False)
+    return bool(np.linalg.det(A) > 0 and scale_range[0] <= singular.min() and singular.max() <= scale_range[1])
+
+def is_self_match_transform(M, window, min_distance, identity_tol=IDENTITY_TOLERANCE):
+    """True when M (nearly) maps window onto itself rather than onto a separate region
+    
+    Either the median displacement of a point grid over window is below min_distance,
+    or the linear part is within identity_tol of identity and the translation is
+    below min_distance (a pure translation further away is a regular clone).
+    """
+    x0, y0, x1, y1 = window
+    gx, gy = np.meshgrid(np.linspace(x0, x1, 5), np.linspace(y0, y1, 5))
+    points = np.stack([gx.ravel(), gy.ravel()], axis=1)
+    M = np.asarray(M, dtype=np.float64)
+    displacement = np.linalg.norm(points @ M[:, :2].T + M[:, 2] - points, axis=1)
+    if np.median(displacement) < min_distance:
+        return True
+    near_identity = np.max(np.abs(M[:, :2] - np.eye(2))) < identity_tol
+    return bool(near_identity and np.linalg.norm(M[:, 2]) < min_distance)
+
+def _bbox(points):
+    """Axis-aligned (x0, y0, x1, y1) box of points"""
+    return (*points.min(axis=0), *points.max(axis=0))
+
+def _scale_pad_box(box, scale, w, h):
+    """Scale a coarse box to full resolution, pad it and clip to the image"""
+    x0, y0, x1, y1 = (np.asarray(box) * scale)
+    pad_x = max(16.0, (x1 - x0) * CANDIDATE_PADDING)
+    pad_y = max(16.0, (y1 - y0) * CANDIDATE_PADDING)
+    return (int(max(0, x0 - pad_x)), int(max(0, y0 - pad_y)),
+            int(min(w, np.ceil(x1 + pad_x))), int(min(h, np.ceil(y1 + pad_y))))
+
+def _match_windows_sift(gray, src_win, dst_win, min_distance=0):
+    """SIFT inside two windows, ratio-test A->B matching and RANSAC affine (global coords)
+    
+    Pairs closer than min_distance are dropped: where the padded windows overlap, a
+    keypoint would otherwise match its own copy and pull RANSAC towards identity.
+    """
+    sift = cv2.SIFT_create(contrastThreshold=SIFT_CONTRAST_THRESHOLD, edgeThreshold=SIFT_EDGE_THRESHOLD)
+    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+    
+    sets = []
+    for x0, y0, x1, y1 in (src_win, dst_win):
+        kp, desc = sift.detectAndCompute(clahe.apply(np.ascontiguousarray(gray[y0:y1, x0:x1])), None)
+        fs = keypoints_to_feature_set(kp, desc)
+        fs.xy += np.float32([x0, y0])
+        sets.append(fs)
+    fs_src, fs_dst = sets
+    
+    empty = np.zeros((0, 2), dtype=np.int32), np.zeros(0, dtype=np.float32)
+    if fs_src.descriptors is None or fs_dst.descriptors is None or len(fs_src) < 2 or len(fs_dst) < 2:
+        return fs_src, fs_dst, *empty, None, 0
+    
+    knn = cv2.BFMatcher(cv2.NORM_L2).knnMatch(fs_src.descriptors, fs_dst.descriptors, k=2)
+    good = [m[0] for m in knn if len(m) == 2 and m[0].distance < 0.8 * m[1].distance and
+            np.linalg.norm(fs_src.xy[m[0].queryIdx] - fs_dst.xy[m[0].trainIdx]) >= min_distance]
+    if len(good) < 3:
+        return fs_src, fs_dst, *empty, None, 0
+    
+    pairs = np.int32([(m.queryIdx, m.trainIdx) for m in good])
+    dists = np.float32([m.distance for m in good])
+    M, mask = cv2.estimateAffine2D(fs_src.xy[pairs[:, 0]], fs_dst.xy[pairs[:, 1]],
+                                   method=cv2.RANSAC, ransacReprojThreshold=RANSAC_THRESH)
+    if M is None:
+        return fs_src, fs_dst, pairs, dists, None, 0
+    
+    if not plausible_affine(M):
+        return fs_src, fs_dst, pairs, dists, None, 0
+    
+    inl = mask.ravel() == 1
+    return fs_src, fs_dst, pairs[inl], dists[inl], M, int(np.sum(inl))
+
+def _dense_zncc_mask(gray, dst_win, M, window, thresh):
+    """Destination pixels of dst_win whose ZNCC window matches the source under M, uint8"""
+    dx0, dy0, dx1, dy1 = dst_win
+    
+    # dst-local pixel -> global source pixel
+    M_inv = cv2.invertAffineTransform(M)
+    T_dst = M_inv.copy()
+    T_dst[:, 2] = M_inv[:, :2] @ np.float64([dx0, dy0]) + M_inv[:, 2]
+    warped = cv2.warpAffine(gray, T_dst, (dx1 - dx0, dy1 - dy0),
+                            flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                            borderMode=cv2.BORDER_CONSTANT)
+    valid = cv2.warpAffine(np.ones_like(gray), T_dst, (dx1 - dx0, dy1 - dy0),
+                           flags=cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP)
+    
+    a = warped.astype(np.float32)
+    b = gray[dy0:dy1, dx0:dx1].astype(np.float32)
+    ksize = (window, window)
+    mean_a, mean_b = cv2.blur(a, ksize), cv2.blur(b, ksize)
+    var_a = cv2.blur(a * a, ksize) - mean_a ** 2
+    var_b = cv2.blur(b * b, ksize) - mean_b ** 2
+    cov = cv2.blur(a * b, ksize) - mean_a * mean_b
+    zncc = cov / np.sqrt(np.maximum(var_a * var_b, 1e-6))
+    
+    # Flat areas correlate trivially; require some texture
+    return ((zncc > thresh) & (var_b > 4.0) & (valid > 0)).astype(np.uint8)
+
+def verify_clone_dense(gray, src_win, dst_win, M, window=DENSE_ZNCC_WINDOW, thresh=DENSE_ZNCC_THRESH,
+                       unique_shift=0):
+    """Dense ZNCC check of a src->dst affine clone hypothesis, returns (dst_mask, src_mask) uint8
+    
+    Both warps use WARP_INVERSE_MAP with the window offset folded into the matrix, so
+    only the window-sized outputs are computed, never a full-frame warp. With
+    unique_shift > 0, pixels that still match with the source displaced by that many
+    pixels (in four directions) are dropped: edges, stripes and other 1-D structure
+    match along a whole line of offsets, a clone only at one.
+    """
+    sx0, sy0, sx1, sy1 = src_win
+    dx0, dy0, dx1, dy1 = dst_win
+    
+    dst_mask = _dense_zncc_mask(gray, dst_win, M, window, thresh)
+    if unique_shift > 0:
+        for shift in ((unique_shift, 0), (0, unique_shift), (unique_shift, unique_shift), (unique_shift, -unique_shift)):
+            M_shift = M.copy()
+            M_shift[:, 2] = M[:, 2] - M[:, :2] @ np.float64(shift)
+            dst_mask &= 1 - _dense_zncc_mask(gray, dst_win, M_shift, window, thresh)
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+    dst_mask = cv2.morphologyEx(dst_mask, cv2.MORPH_OPEN, kernel)
+    
+    # Map the verified destination pixels back onto the source window
+    T_src = M.copy()
+    T_src[:, 2] = M[:, :2] @ np.float64([sx0, sy0]) + M[:, 2] - np.float64([dx0, dy0])
+    src_mask = cv2.warpAffine(dst_mask, T_src, (sx1 - sx0, sy1 - sy0),
+                              flags=cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP)
+    
+    return dst_mask, src_mask
+
+# ======================= Dense PatchMatch Copy-Move =======================
+
+def zernike_basis(size, orders=ZERNIKE_ORDERS):
+    """Conjugate Zernike basis V*_nm sampled on a size x size grid, (D, size, size) complex64
+    
+    The unit disc is inscribed in the grid (centre at (size - 1) / 2), so odd sizes
+    give pixel-centred kernels and even sizes match block grids. |Z_nm| of a patch
+    is invariant to rotation about the patch centre.
+    """
+    half = (size - 1) / 2.0
+    coords = (np.arange(size, dtype=np.float64) - half) / max(half, 1.0)
+    xx, yy = np.meshgrid(coords, coords)
+    rho = np.sqrt(xx ** 2 + yy ** 2)
+    theta = np.arctan2(yy, xx)
+    disc = rho <= 1.0
+    
+    basis = []
+    for n, m in orders:
+        m_abs = abs(m)
+        radial = np.zeros_like(rho)
+        for k in range((n - m_abs) // 2 + 1):
+            coeff = ((-1) ** k * factorial(n - k) /
+                     (factorial(k) * factorial((n + m_abs) // 2 - k) *
+                      factorial((n - m_abs) // 2 - k)))
+            radial += coeff * rho ** (n - 2 * k)
+        # (n+1)/pi normalisation, discretised over the number of disc pixels
+        basis.append(radial * np.exp(-1j * m * theta) * disc * (n + 1) / np.sum(disc))
+    return np.array(basis, dtype=np.complex64)
+
+def zernike_kernels(radius, orders=ZERNIKE_ORDERS):
+    """Zernike basis as (n, m, complex64 kernel) filter2D kernels of size 2 * radius + 1"""
+    basis = zernike_basis(2 * radius + 1, orders)
+    return [(n, m, kernel) for (n, m), kernel in zip(orders, basis)]
+
+def dense_zernike_features(gray, radius=PATCHMATCH_RADIUS, orders=ZERNIKE_ORDERS):
+    """Per-pixel Zernike moment magnitudes, (H, W, D) float32, one filter2D per basis part"""
+    gray = gray.astype(np.float32)
+    features = []
+    for n, m, kernel in zernike_kernels(radius, orders):
+        real = cv2.filter2D(gray, cv2.CV_32F, np.ascontiguousarray(kernel.real), borderType=cv2.BORDER_REFLECT)
+        if m == 0:
+            features.append(np.abs(real))
+        else:
+            imag = cv2.filter2D(gray, cv2.CV_32F, np.ascontiguousarray(kernel.imag), borderType=cv2.BORDER_REFLECT)
+            features.append(cv2.magnitude(real, imag))
+    features = np.stack(features, axis=-1)
+    
+    # Equalise feature scales so high orders are not drowned by Z00
+    features /= features.reshape(-1, features.shape[-1]).std(axis=0) + 1e-6
+    return features
+
+def _patchmatch_try(features_flat, offsets, cost, candidate, min_offset):
+    """Adopt candidate offsets wherever they lower the cost (in place)
+    
+    Only pixels whose candidate differs from their current offset are evaluated, and
+    targets outside the grid or closer than min_offset are skipped.
+    """
+    h, w = cost.shape
+    flat_offsets = offsets.reshape(-1, 2)
+    flat_cost = cost.reshape(-1)
+    candidate = np.ascontiguousarray(candidate, dtype=np.int32).reshape(-1, 2)
+    
+    # (dy, dx) int32 pairs compared as one int64
+    idx = np.flatnonzero(candidate.view(np.int64).ravel() != flat_offsets.view(np.int64).ravel())
+    candidate = np.take(candidate, idx, axis=0)
+    y, x = np.divmod(idx, w)
+    ty = y + candidate[:, 0]
+    tx = x + candidate[:, 1]
+    valid = np.flatnonzero((ty >= 0) & (ty < h) & (tx >= 0) & (tx < w) &
+                           (candidate[:, 0] ** 2 + candidate[:, 1] ** 2 >= min_offset ** 2))
+    idx, candidate = idx[valid], np.take(candidate, valid, axis=0)
+    target = ty[valid] * w + tx[valid]
+    
+    diff = np.take(features_flat, idx, axis=0) - np.take(features_flat, target, axis=0)
+    candidate_cost = np.einsum('ij,ij->i', diff, diff)
+    better = np.flatnonzero(candidate_cost < flat_cost[idx])
+    flat_offsets[idx[better]] = candidate[better]
+    flat_cost[idx[better]] = candidate_cost[better]
+
+def _seed_offsets(features, min_offset, subsample=PATCHMATCH_SEED_SUBSAMPLE,
+                  neighbours=PATCHMATCH_SEED_NEIGHBOURS):
+    """Initial offsets from a KD-tree over a sub-lattice of the feature image
+    
+    Each lattice point takes its nearest feature neighbour at least min_offset away;
+    the offset is repeated over the subsample x subsample cell it stands for.
+    """
+    h, w, d = features.shape
+    ys, xs = np.mgrid[0:h:subsample, 0:w:subsample]
+    points = features[ys, xs].reshape(-1, d)
+    _, idx = cKDTree(points).query(points, min(neighbours, len(points)))
+    idx = np.minimum(idx.reshape(len(points), -1), len(points) - 1)
+    
+    py, px = ys.ravel(), xs.ravel()
+    dy = py[idx] - py[:, None]
+    dx = px[idx] - px[:, None]
+    first_far = np.argmax(dy ** 2 + dx ** 2 >= min_offset ** 2, axis=1)
+    rows = np.arange(len(points))
+    seed = np.stack([dy[rows, first_far], dx[rows, first_far]], axis=-1).reshape(ys.shape + (2,))
+    return np.repeat(np.repeat(seed, subsample, axis=0), subsample, axis=1)[:h, :w]
+
+def patchmatch_offsets(features, min_offset=PATCHMATCH_MIN_OFFSET, iterations=PATCHMATCH_ITERATIONS,
+                       samples=PATCHMATCH_RANDOM_SAMPLES, seed=42):
+    """Vectorised PatchMatch nearest-neighbour field over a feature image
+    
+    The field is seeded from a KD-tree, so a clone starts with correct offsets on part
+    of its lattice. Each iteration propagates the neighbours' offsets (jumps of 2 and
+    1 in the four directions) and then draws `samples` random candidates per pixel,
+    each in a square of radius 2^k around the current offset with k uniform in
+    [0, log2(max(H, W))]: every scale is sampled at a fixed O(H * W * D) cost per
+    iteration instead of a full radius-halving sweep.
+    Returns (offsets (H, W, 2) int32 as (dy, dx), cost (H, W) float32).
+    """
+    h, w, d = features.shape
+    features_flat = np.ascontiguousarray(features.reshape(-1, d), dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    offsets = np.zeros((h, w, 2), dtype=np.int32)
+    cost = np.full((h, w), np.inf, dtype=np.float32)
+    
+    _patchmatch_try(features_flat, offsets, cost, _seed_offsets(features, min_offset), min_offset)
+    
+    max_exponent = int(np.log2(max(h, w)))
+    for _ in range(iterations):
+        # Propagation from the neighbours' offsets
+        for jump in (2, 1):
+            for axis in (0, 1):
+                for direction in (1, -1):
+                    _patchmatch_try(features_flat, offsets, cost,
+                                    np.roll(offsets, direction * jump, axis=axis), min_offset)
+        
+        # Random search, one scale drawn per pixel
+        for _ in range(samples):
+            radius = (2.0 ** rng.integers(0, max_exponent + 1, (h, w)))[..., None]
+            step = np.round(rng.uniform(-1, 1, (h, w, 2)) * radius).astype(np.int32)
+            _patchmatch_try(features_flat, offsets, cost, offsets + step, min_offset)
+    
+    return offsets, cost
+
+def local_affine_residual(offsets, size=7):
+    """Residual variance of a least-squares affine fit of the offset field in a size x size box
+    
+    A clone (translated, rotated or scaled) has an offset field that is affine in the
+    pixel position, so the residual is ~0 inside it and large on random matches.
+    """
+    h, w = offsets.shape[:2]
+    yy, xx = np.indices((h, w), dtype=np.float32)
+    box = lambda a: cv2.boxFilter(a, cv2.CV_32F, (size, size), borderType=cv2.BORDER_REFLECT)
+    mean_x, mean_y = box(xx), box(yy)
+    sxx = box(xx * xx) - mean_x ** 2
+    syy = box(yy * yy) - mean_y ** 2
+    sxy = box(xx * yy) - mean_x * mean_y
+    det = np.maximum(sxx * syy - sxy ** 2, 1e-6)
+    
+    residual = np.zeros((h, w), dtype=np.float32)
+    for c in range(2):
+        o = offsets[..., c].astype(np.float32)
+        mean_o = box(o)
+        cx = box(o * xx) - mean_o * mean_x
+        cy = box(o * yy) - mean_o * mean_y
+        explained = (syy * cx * cx - 2 * sxy * cx * cy + sxx * cy * cy) / det
+        residual += np.maximum(box(o * o) - mean_o ** 2 - explained, 0)
+    return residual
+
+def coherent_offset_regions(offsets, cost, min_area=PATCHMATCH_MIN_AREA, texture=None,
+                            max_residual=PATCHMATCH_MAX_RESIDUAL):
+    """Candidate clone regions of a PatchMatch field, (labels, n_labels) on the grid
+    
+    Offsets are median-filtered against isolated wrong matches, then pixels whose
+    neighbourhood follows one affine map (local_affine_residual) are kept; regions
+    smaller than min_area are dropped. The regions are only candidates: the caller
+    fits and verifies an affine map per region.
+    """
+    smooth = np.stack([cv2.medianBlur(np.ascontiguousarray(offsets[..., c], dtype=np.float32), 5)
+                       for c in range(2)], axis=-1)
+    coherent = (local_affine_residual(smooth) < max_residual) & np.isfinite(cost)
+    if texture is not None:
+        coherent &= texture
+    mask = cv2.medianBlur(coherent.astype(np.uint8), 5)
+    
+    n_labels, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    keep = np.zeros(n_labels, dtype=bool)
+    keep[1:] = stats[1:, cv2.CC_STAT_AREA] >= min_area
+    labels[~keep[labels]] = 0
+    return labels, n_labels
+
+def _affine_window(M, window, w, h):
+    """Bounding box of window mapped through M, clipped to the image"""
+    x0, y0, x1, y1 = window
+    corners = np.float64([[x0, y0], [x1, y0], [x0, y1], [x1, y1]]) @ M[:, :2].T + M[:, 2]
+    return (int(max(0, corners[:, 0].min())), int(max(0, corners[:, 1].min())),
+            int(min(w, np.ceil(corners[:, 0].max()))), int(min(h, np.ceil(corners[:, 1].max()))))
+
+def grow_verified_clone(gray, M, src_win, unique_shift=PATCHMATCH_UNIQUE_SHIFT, max_rounds=3):
+    """Dense verification of M, re-run on the padded box of the verified source until it stops growing
+    
+    Returns (dst_mask, src_mask, src_win, dst_win) of the last verification or None.
+    """
+    h, w = gray.shape
+    result = None
+    for _ in range(max_rounds):
+        dst_win = _affine_window(M, src_win, w, h)
+        if dst_win[2] <= dst_win[0] or dst_win[3] <= dst_win[1]:
+            break
+        dst_mask, src_mask = verify_clone_dense(gray, src_win, dst_win, M, unique_shift=unique_shift)
+        result = (dst_mask, src_mask, src_win, dst_win)
+        
+        ys, xs = np.nonzero(src_mask)
+        if len(ys) == 0:
+            break
+        grown = _scale_pad_box((xs.min() + src_win[0], ys.min() + src_win[1],
+                                xs.max() + src_win[0] + 1, ys.max() + src_win[1] + 1), 1.0, w, h)
+        if (grown[0] >= src_win[0] and grown[1] >= src_win[1] and
+                grown[2] <= src_win[2] and grown[3] <= src_win[3]):
+            break
+        src_win = (min(src_win[0], grown[0]), min(src_win[1], grown[1]),
+                   max(src_win[2], grown[2]), max(src_win[3], grown[3]))
+    return result
+
+def refine_clone_ecc(gray, M, src_win, dst_win, src_mask):
+    """Refine a src->dst clone affine with masked ECC alignment, None if ECC fails
+    
+    The destination window is the template and the source window the input image
+    (ECC smooths its whole input, so it only gets the window); ECC is restricted to
+    the (dilated) verified source pixels, or the whole window if too few verified.
+    """
+    sx0, sy0, sx1, sy1 = src_win
+    dx0, dy0, dx1, dy1 = dst_win
+    
+    # dst-local pixel -> src-local pixel
+    M_inv = cv2.invertAffineTransform(M)
+    warp = M_inv.copy()
+    warp[:, 2] = M_inv[:, :2] @ np.float64([dx0, dy0]) + M_inv[:, 2] - np.float64([sx0, sy0])
+    
+    if np.count_nonzero(src_mask) >= PATCHMATCH_MIN_AREA:
+        ecc_mask = cv2.dilate(src_mask, np.ones((9, 9), np.uint8))
+    else:
+        ecc_mask = np.ones((sy1 - sy0, sx1 - sx0), dtype=np.uint8)
+    
+    try:
+        _, warp = cv2.findTransformECC(gray[dy0:dy1, dx0:dx1].astype(np.float32),
+                                       gray[sy0:sy1, sx0:sx1].astype(np.float32),
+                                       warp.astype(np.float32), cv2.MOTION_AFFINE,
+                                       (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 50, 1e-4), ecc_mask, 5)
+    except cv2.error:
+        return None
+    
+    warp = warp.astype(np.float64)
+    M_inv = warp.copy()
+    M_inv[:, 2] = warp[:, 2] - warp[:, :2] @ np.float64([dx0, dy0]) + np.float64([sx0, sy0])
+    M = cv2.invertAffineTransform(M_inv)
+    return M if plausible_affine(M) else None
+
+def detect_copy_move_patchmatch(image_pil, stride=PATCHMATCH_STRIDE, radius=PATCHMATCH_RADIUS,
+                                min_offset=PATCHMATCH_MIN_OFFSET, iterations=PATCHMATCH_ITERATIONS,
+                                context=None):
+    """Dense copy-move detection with a PatchMatch field over rotation-invariant Zernike moments
+    
+    Coherent regions of the field give an affine map each (RANSAC on the raw offsets),
+    which is checked against self-matches, verified densely at full resolution,
+    refined with ECC and grown over the verified clone.
+    """
+    print("  - Dense PatchMatch copy-move field...")
+    
+    gray = ensure_context(image_pil, context).gray
+    h, w = gray.shape
+    # Exact stride cells, so a translated clone lands on the same lattice phase
+    gh, gw = max(1, h // stride), max(1, w // stride)
+    grid = cv2.resize(gray[:gh * stride, :gw * stride], (gw, gh), interpolation=cv2.INTER_AREA)
+    
+    features = dense_zernike_features(grid, radius)
+    if PATCHMATCH_FEATURE_BLUR > 0:
+        features = np.stack([cv2.GaussianBlur(features[..., c], (0, 0), PATCHMATCH_FEATURE_BLUR)
+                             for c in range(features.shape[-1])], axis=-1)
+        features /= features.reshape(-1, features.shape[-1]).std(axis=0) + 1e-6
+    offsets, cost = patchmatch_offsets(features, min_offset, iterations)
+    
+    # Saturated / perfectly flat patches match everything; require a little texture
+    grid_f = grid.astype(np.float32)
+    local_var = cv2.blur(grid_f * grid_f, (5, 5)) - cv2.blur(grid_f, (5, 5)) ** 2
+    labels, n_labels = coherent_offset_regions(offsets, cost, texture=local_var > 4.0)
+    
+    rng = np.random.default_rng(0)
+    clone_mask = np.zeros((h, w), dtype=np.uint8)
+    for label in range(1, n_labels):
+        ys, xs = np.nonzero(labels == label)
+        if len(ys) == 0:
+            continue
+        if len(ys) > 2000:
+            pick = rng.choice(len(ys), 2000, replace=False)
+            ys, xs = ys[pick], xs[pick]
+        src = np.stack([xs, ys], axis=1).astype(np.float32)
+        dst = src + offsets[ys, xs, ::-1].astype(np.float32)
+        M, inliers = cv2.estimateAffine2D(src * stride, dst * stride, method=cv2.RANSAC,
+                                          ransacReprojThreshold=2.0 * stride)
+        if M is None or inliers.mean() < 0.5 or not plausible_affine(M):
+            continue
+        
+        inl = inliers.ravel() == 1
+        x0, y0 = src[inl].min(axis=0) * stride
+        x1, y1 = src[inl].max(axis=0) * stride
+        src_win = _scale_pad_box((x0, y0, x1, y1), 1.0, w, h)
+        if is_self_match_transform(M, src_win, min_offset * stride):
+            continue
+        
+        verified = grow_verified_clone(gray, M, src_win)
+        if verified is None:
+            continue
+        refined = refine_clone_ecc(gray, M, verified[2], verified[3], verified[1])
+        if refined is not None and not is_self_match_transform(refined, verified[2], min_offset * stride):
+            regrown = grow_verified_clone(gray, refined, verified[2])
+            if regrown is not None and np.count_nonzero(regrown[0]) > np.count_nonzero(verified[0]):
+                verified = regrown
+        
+        dst_mask, src_mask, (sx0, sy0, sx1, sy1), (dx0, dy0, dx1, dy1) = verified
+        if np.count_nonzero(dst_mask) < PATCHMATCH_MIN_AREA * stride * stride:
+            continue
+        clone_mask[dy0:dy1, dx0:dx1] |= dst_mask
+        clone_mask[sy0:sy1, sx0:sx1] |= src_mask
+    
+    clone_mask = clone_mask > 0
+    print(f"  - PatchMatch clone area: {np.mean(clone_mask) * 100:.1f}%")
+    
+    return {
+        'offset_field': offsets,
+        'match_cost': cost,
+        'field_stride': stride,
+        'clone_mask': clone_mask,
+        'clone_percentage': float(np.mean(clone_mask) * 100)
+    }
+
+# ======================= Invariant Block Features =======================
+
+def block_view(gray, block_size, step):
+    """All overlapping blocks as one strided view, (grid_h, grid_w, block_size, block_size)"""
+    windows = np.lib.stride_tricks.sliding_window_view(gray, (block_size, block_size))
+    return windows[::step, ::step]
+
+def log_polar_matrix(size, shape=FM_LOG_POLAR_SHAPE):
+    """Bilinear resampling matrix from a centred size x size spectrum to log-polar, (size*size, R*T)"""
+    n_r, n_t = shape
+    centre = size / 2.0
+    radii = np.exp(np.linspace(0, np.log(centre - 1), n_r))
+    # Magnitude spectra are point-symmetric, half a turn covers all orientations
+    angles = np.linspace(0, np.pi, n_t, endpoint=False)
+    ys = centre + radii[:, None] * np.sin(angles)[None, :]
+    xs = centre + radii[:, None] * np.cos(angles)[None, :]
+    
+    y0, x0 = np.floor(ys).astype(int), np.floor(xs).astype(int)
+    fy, fx = ys - y0, xs - x0
+    matrix = np.zeros((size * size, n_r * n_t), dtype=np.float32)
+    cols = np.arange(n_r * n_t).reshape(n_r, n_t)
+    for dy, dx, weight in ((0, 0, (1 - fy) * (1 - fx)), (0, 1, (1 - fy) * fx),
+                           (1, 0, fy * (1 - fx)), (1, 1, fy * fx)):
+        rows = np.clip(y0 + dy, 0, size - 1) * size + np.clip(x0 + dx, 0, size - 1)
+        np.add.at(matrix, (rows.ravel(), cols.ravel()), weight.ravel())
+    return matrix
+
+def extract_invariant_block_features(gray, block_size, step, feature_type='zernike'):
+    """Rotation/scale-invariant features for every overlapping block, computed in batch
+    
+    The blocks come from a single strided view of the lightly blurred image; 'zernike'
+    projects all blocks onto a precomputed Zernike basis matrix in one matmul,
+    'fourier_mellin' runs one batched FFT of the disc-windowed blocks, resamples the
+    magnitude spectra to log-polar with a precomputed matrix and takes the magnitude
+    of an FFT along the angle axis (a rotation becomes a cyclic shift there). The
+    disc window matters: the square block border puts a fixed cross into the spectrum
+    that does not turn with the content.
+    Returns (features (N, D) float32, standardised and RMS-scaled, positions (N, 2) as (x, y),
+    block std (N,)).
+    """
+    if BLOCK_FEATURE_BLUR > 0:
+        gray = cv2.GaussianBlur(gray.astype(np.float32), (0, 0), BLOCK_FEATURE_BLUR)
+    view = block_view(gray, block_size, step)
+    grid_h, grid_w = view.shape[:2]
+    blocks = view.reshape(grid_h * grid_w, block_size * block_size).astype(np.float32)
+    
+    ys, xs = np.mgrid[0:grid_h, 0:grid_w]
+    positions = np.stack([xs.ravel() * step, ys.ravel() * step], axis=1)
+    block_std = blocks.std(axis=1)
+    block_mean = blocks.mean(axis=1, keepdims=True)
+    
+    if feature_type == 'zernike':
+        # Z00 carries the block mean, which is rotation invariant and very discriminative
+        basis = zernike_basis(block_size).reshape(len(ZERNIKE_ORDERS), -1)
+        features = np.abs(blocks @ basis.T)
+    elif feature_type == 'fourier_mellin':
+        # Raised-cosine disc window, zero outside the inscribed circle
+        centre = (block_size - 1) / 2.0
+        v, u = np.mgrid[0:block_size, 0:block_size]
+        rho = np.hypot(v - centre, u - centre) / (block_size / 2.0)
+        window = np.where(rho < 1.0, 0.5 + 0.5 * np.cos(np.pi * rho), 0.0).astype(np.float32)
+        spectra = np.abs(np.fft.fft2((blocks - block_mean).reshape(-1, block_size, block_size) * window,
+                                     axes=(-2, -1)))
+        spectra = np.fft.fftshift(spectra, axes=(-2, -1)).reshape(len(blocks), -1).astype(np.float32)
+        log_polar = (spectra @ log_polar_matrix(block_size)).reshape(-1, *FM_LOG_POLAR_SHAPE)
+        mellin = np.abs(np.fft.fft(log_polar, axis=-1))
+        features = np.hstack([block_mean, mellin[:, :FM_COEFFS[0], :FM_COEFFS[1]].reshape(len(blocks), -1)])
+    else:
+        raise ValueError(f"Unknown block feature type: {feature_type}")
+    
+    # Standardise each dimension and divide by sqrt(D) so distances are RMS per dimension
+    features = features.astype(np.float32)
+    features /= (features.std(axis=0) + 1e-6) * np.sqrt(features.shape[1])
+    return features, positions, block_std
+
+def block_pair_similarity(gray, src_xy, dst_xy, M, block_size, src_shift=(0, 0)):
+    """(ZNCC, relative error) of each destination block against the source pixels M maps onto it
+    
+    ZNCC ignores brightness and contrast, so any two smooth gradients correlate; the
+    relative error ||a - b|| / ||b - mean(b)|| on raw intensities keeps a clone's
+    requirement that the pixels themselves agree. src_shift displaces the sampled
+    source pixels, for ambiguity checks. All blocks of one transform are resampled
+    with a single cv2.remap call.
+    """
+    M_inv = cv2.invertAffineTransform(M.astype(np.float64))
+    v, u = np.mgrid[0:block_size, 0:block_size]
+    xs = dst_xy[:, 0, None, None] + u
+    ys = dst_xy[:, 1, None, None] + v
+    map_x = (M_inv[0, 0] * xs + M_inv[0, 1] * ys + M_inv[0, 2] + src_shift[0]).astype(np.float32)
+    map_y = (M_inv[1, 0] * xs + M_inv[1, 1] * ys + M_inv[1, 2] + src_shift[1]).astype(np.float32)
+    n = len(dst_xy)
+    warped = cv2.remap(gray, map_x.reshape(n * block_size, block_size), map_y.reshape(n * block_size, block_size),
+                       cv2.INTER_LINEAR, borderMode=cv2.BORDER_REFLECT)
+    a = warped.reshape(n, -1).astype(np.float32)
+    b = gray[ys, xs].reshape(n, -1).astype(np.float32)
+    error = np.sqrt(((a - b) ** 2).sum(axis=1))
+    a -= a.mean(axis=1, keepdims=True)
+    b -= b.mean(axis=1, keepdims=True)
+    energy_b = np.maximum((b * b).sum(axis=1), 1e-6)
+    zncc = (a * b).sum(axis=1) / np.sqrt(np.maximum((a * a).sum(axis=1) * energy_b, 1e-6))
+    return zncc, error / np.sqrt(energy_b)
+
+def match_invariant_blocks(gray, block_size, feature_type, step=None,
+                           max_distance=BLOCK_FEATURE_DIST, k=32, zncc_threshold=DENSE_ZNCC_THRESH):
+    """Nearest-neighbour matching of invariant block features (KD-tree, Euclidean distance)
+    
+    Each block is paired with its closest feature neighbour at least two blocks away.
+    Candidate pairs must also be coherent: a real clone yields several pairs that are
+    close to each other in both source and destination position (DBSCAN on the
+    4-D (src, dst) coordinates) and consistent with one similarity transform, which
+    rejects isolated look-alike blocks. Invariant features still pair up many blocks
+    of similar texture, so every surviving pair is then checked in the pixel domain
+    (ZNCC of the destination block against the source warped by the cluster's
+    transform, like matchTemplate in the resize8 path). The transform is fitted to
+    grid positions, so it is refined with ECC first. A pair that still correlates
+    with the source displaced by a quarter block is ambiguous (edges, stripes) and
+    is dropped. A cluster is only kept with at least BLOCK_MIN_CLUSTER verified pairs.
+    """
+    # Invariant features are not translation invariant on the block grid, so sample densely
+    step = step or max(1, block_size // 4)
+    features, positions, block_std = extract_invariant_block_features(gray, block_size, step, feature_type)
+    
+    textured = np.nonzero(block_std > BLOCK_MIN_STD)[0]
+    if len(textured) < 2:
+        return []
+    features, positions = features[textured], positions[textured]
+    
+    # Spatial neighbours look alike on a dense grid, so ask for more than one neighbour
+    # and keep, per block, the closest one at least two blocks away
+    k = min(k, len(features))
+    # eps=1: approximate search, a reported neighbour is within 2x the true nearest distance
+    dist, idx = cKDTree(features).query(features, k=k, eps=1.0, distance_upper_bound=max_distance)
+    idx = np.minimum(idx, len(features) - 1)
+    spatial = np.linalg.norm(positions[idx] - positions[:, None], axis=2)
+    far = np.isfinite(dist) & (spatial >= block_size * 2)
+    first = np.argmax(far, axis=1)
+    rows = np.nonzero(far[np.arange(len(features)), first])[0]
+    query, train = rows, idx[rows, first[rows]]
+    dist, spatial = dist[rows, first[rows]], spatial[rows, first[rows]]
+    if len(query) < BLOCK_MIN_CLUSTER:
+        return []
+    
+    # Canonical orientation so A->B and B->A pairs of one clone land in the same cluster
+    swap = (positions[query, 1] > positions[train, 1]) | (
+        (positions[query, 1] == positions[train, 1]) & (positions[query, 0] > positions[train, 0]))
+    query[swap], train[swap] = train[swap], query[swap].copy()
+    
+    pair_coords = np.hstack([positions[query], positions[train]]).astype(np.float32)
+    labels = DBSCAN(eps=block_size, min_samples=BLOCK_MIN_CLUSTER).fit_predict(pair_coords)
+    
+    # Each coherent group must also follow one rotation + translation (+ mild scale)
+    coherent = np.zeros(len(query), dtype=bool)
+    for label in np.unique(labels[labels >= 0]):
+        members = np.nonzero(labels == label)[0]
+        if len(members) < BLOCK_MIN_CLUSTER:
+            continue
+        M, inliers = cv2.estimateAffinePartial2D(pair_coords[members, :2], pair_coords[members, 2:],
+                                                 method=cv2.RANSAC, ransacReprojThreshold=step)
+        if M is None:
+            continue
+        inliers = inliers.ravel() == 1
+        if not plausible_affine(M) or inliers.mean() < 0.5 or inliers.sum() < BLOCK_MIN_CLUSTER:
+            continue
+        members = members[inliers]
+        src_xy, dst_xy = pair_coords[members, :2], pair_coords[members, 2:].astype(np.int64)
+        
+        # Block positions sit on the step grid, so M is off by up to step / 2 pixels;
+        # align the pixels before the ZNCC check
+        h, w = gray.shape
+        src_win = _scale_pad_box((*src_xy.min(axis=0), *(src_xy.max(axis=0) + block_size)), 1.0, w, h)
+        dst_win = _scale_pad_box((*dst_xy.min(axis=0), *(dst_xy.max(axis=0) + block_size)), 1.0, w, h)
+        refined = refine_clone_ecc(gray, M, src_win, dst_win, np.zeros((1, 1), dtype=np.uint8))
+        if refined is not None:
+            M = refined
+        zncc, error = block_pair_similarity(gray, src_xy, dst_xy, M, block_size)
+        verified = (zncc >= zncc_threshold) & (error <= BLOCK_VERIFY_ERROR)
+        quarter = max(1, block_size // 4)
+        for shift in ((quarter, 0), (0, quarter), (quarter, quarter), (quarter, -quarter)):
+            shifted_zncc, _ = block_pair_similarity(gray, src_xy, dst_xy, M, block_size, shift)
+            verified &= shifted_zncc < zncc_threshold
+        verified = members[verified]
+        if len(verified) >= BLOCK_MIN_CLUSTER:
+            coherent[verified] = True
+    
+    order = np.argsort(dist[coherent], kind='stable')
+    query, train = query[coherent][order], train[coherent][order]
+    dist, spatial = dist[coherent][order], spatial[coherent][order]
+    
+    # Report a correlation-like score in [0, 1] for compatibility with resize8 matches
+    return [{
+        'block1': (int(positions[q][0]), int(positions[q][1])),
+        'block2': (int(positions[t][0]), int(positions[t][1])),
+        'correlation': float(1.0 - d / max_distance),
+        'distance': float(dist_xy)
+    } for q, t, d, dist_xy in zip(query, train, dist, spatial)]
+
+# ======================= Regression Cases =======================
+
+# 'grass' is left out: the sample texture itself repeats a patch (r = 0.83 at offset (346, 182))
+REGRESSION_TILES = ('astronaut', 'coffee', 'chelsea', 'rocket', 'camera', 'coins',
+                    'moon', 'page', 'text', 'brick', 'immunohistochemistry', 'gravel')
+
+def regression_mosaic(tile=375, grid=(4, 3)):
+    """Authentic mosaic of scikit-image sample photos, RGB uint8 (no clone)
+    
+    Coins, text, brick, cells and gravel hold repeated but genuinely distinct structure,
+    which is what self-matching copy-move detectors tend to flag.
+    """
+    from skimage import data
+    tiles = []
+    for name in REGRESSION_TILES[:grid[0] * grid[1]]:
+        image = getattr(data, name)()
+        if image.ndim == 2:
+            image = np.stack([image] * 3, axis=-1)
+        tiles.append(cv2.resize(image[..., :3], (tile, tile), interpolation=cv2.INTER_AREA))
+    rows = [np.hstack(tiles[r * grid[0]:(r + 1) * grid[0]]) for r in range(grid[1])]
+    return np.vstack(rows)
+
+def copy_move_regression_cases(radius=60, rotation=30.0, source=(190, 200), target=(940, 560)):
+    """(name, image_pil, truth_mask) regression cases on the regression mosaic
+    
+    'authentic' is the untouched mosaic; 'translated' and 'rotated' paste a disc of
+    the given radius from source to target, the latter rotated by rotation degrees.
+    truth_mask marks both the source and the pasted disc.
+    """
+    from PIL import Image
+    mosaic = regression_mosaic()
+    h, w = mosaic.shape[:2]
+    
+    source_disc = np.zeros((h, w), dtype=np.uint8)
+    target_disc = np.zeros((h, w), dtype=np.uint8)
+    cv2.circle(source_disc, source, radius, 1, -1)
+    cv2.circle(target_disc, target, radius, 1, -1)
+    truth = (source_disc | target_disc) > 0
+    
+    cases = [('authentic', Image.fromarray(mosaic), np.zeros((h, w), dtype=bool))]
+    for name, angle in (('translated', 0.0), ('rotated', rotation)):
+        M = cv2.getRotationMatrix2D((float(source[0]), float(source[1])), angle, 1.0)
+        M[:, 2] += (target[0] - source[0], target[1] - source[1])
+        warped = cv2.warpAffine(mosaic, M, (w, h), flags=cv2.INTER_LINEAR)
+        forged = mosaic.copy()
+        forged[target_disc > 0] = warped[target_disc > 0]
+        cases.append((name, Image.fromarray(forged), truth))
+    return cases
+
+def block_matches_mask(matches, block_size, shape):
+    """Bool mask covering both blocks of every block match, for run_copy_move_regression"""
+    mask = np.zeros(shape, dtype=bool)
+    for match in matches:
+        for x, y in (match['block1'], match['block2']):
+            mask[y:y + block_size, x:x + block_size] = True
+    return mask
+
+def run_copy_move_regression(detector=None, cases=None, min_recall=0.3, max_false_percentage=0.05):
+    """Run a clone-mask detector (image_pil -> bool mask) on the regression cases
+    
+    Reports per case the recall of the truth mask, the flagged area outside it (percent
+    of the image) and the runtime; a case passes with recall >= min_recall (clones
+    only) and false area <= max_false_percentage. Defaults to the two-pass search,
+    whose mask stops at the padded keypoint windows (recall ~0.4-0.5 here). Block
+    detectors go through block_matches_mask, e.g.
+    lambda image: block_matches_mask(detect_copy_move_blocks(image, feature_type='zernike'),
+                                     BLOCK_SIZE, image.size[::-1])
+    """
+    import time
+    if detector is None:
+        detector = lambda image: detect_copy_move_two_pass(image)['clone_mask']
+    cases = cases if cases is not None else copy_move_regression_cases()
+    
+    results = {}
+    for name, image, truth in cases:
+        start = time.perf_counter()
+        mask = np.asarray(detector(image), dtype=bool)
+        elapsed = time.perf_counter() - start
+        recall = float(np.mean(mask[truth])) if truth.any() else None
+        false_percentage = float(np.mean(mask & ~truth) * 100)
+        results[name] = {
+            'recall': recall,
+            'false_percentage': false_percentage,
+            'seconds': elapsed,
+            'passed': (recall is None or recall >= min_recall) and false_percentage <= max_false_percentage
+        }
+    return results
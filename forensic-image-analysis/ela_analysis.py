@@ -7,15 +7,20 @@ import numpy as np
 from PIL import Image, ImageChops, ImageStat
 from config import ELA_QUALITIES, ELA_SCALE_FACTOR
 from utils import detect_outliers_iqr
+from block_stats import BlockStats, sliding_grid
+from image_context import ensure_context
 
-def perform_multi_quality_ela(image_pil, qualities=ELA_QUALITIES, scale_factor=ELA_SCALE_FACTOR):
-    """Multi-quality ELA dengan analisis cross-quality"""
+def perform_multi_quality_ela(image_pil, qualities=ELA_QUALITIES, scale_factor=ELA_SCALE_FACTOR,
+                              context=None):
+    """Multi-quality ELA dengan analisis cross-quality
+
+    The weighted ELA and the cross-quality variance are registered on the
+    ImageContext as 'ela' and 'ela_variance' so later block stages reuse them.
+    """
     temp_filename = "temp_ela_multi.jpg"
     
-    if image_pil.mode != 'RGB':
-        image_rgb = image_pil.convert('RGB')
-    else:
-        image_rgb = image_pil
+    context = ensure_context(image_pil, context)
+    image_rgb = context.image
     
     ela_results = []
     quality_stats = []
@@ -53,7 +58,9 @@ def perform_multi_quality_ela(image_pil, qualities=ELA_QUALITIES, scale_factor=E
     final_ela_image = Image.fromarray(final_ela.astype(np.uint8), mode='L')
     
     # Enhanced regional analysis
-    regional_stats = analyze_ela_regions_enhanced(final_ela, ela_variance)
+    context.add_plane('ela', final_ela)
+    context.add_plane('ela_variance', ela_variance)
+    regional_stats = analyze_ela_regions_enhanced(final_ela, ela_variance, context=context)
     
     # Overall statistics
     final_stat = ImageStat.Stat(final_ela_image)
@@ -66,40 +73,33 @@ def perform_multi_quality_ela(image_pil, qualities=ELA_QUALITIES, scale_factor=E
     return (final_ela_image, final_stat.mean[0], final_stat.stddev[0],
             regional_stats, quality_stats, ela_variance)
 
-def analyze_ela_regions_enhanced(ela_array, ela_variance, block_size=32):
-    """Enhanced regional ELA analysis"""
-    h, w = ela_array.shape
-    regional_means = []
-    regional_stds = []
-    regional_variances = []
-    suspicious_regions = []
+def analyze_ela_regions_enhanced(ela_array, ela_variance, block_size=32, context=None):
+    """Enhanced regional ELA analysis (blocks at stride block_size//2, from integral images)"""
+    if context is None:
+        context = BlockStats()
+        context.add_plane('ela', ela_array)
+        context.add_plane('ela_variance', ela_variance)
     
-    for i in range(0, h - block_size, block_size//2):
-        for j in range(0, w - block_size, block_size//2):
-            block = ela_array[i:i+block_size, j:j+block_size]
-            var_block = ela_variance[i:i+block_size, j:j+block_size]
-            
-            block_mean = np.mean(block)
-            block_std = np.std(block)
-            block_var = np.mean(var_block)
-            
-            regional_means.append(block_mean)
-            regional_stds.append(block_std)
-            regional_variances.append(block_var)
-            
-            # Detect suspicious regions
-            if block_mean > 15 or block_std > 25 or block_var > 100:
-                suspicious_regions.append({
-                    'position': (i, j),
-                    'mean': block_mean,
-                    'std': block_std,
-                    'variance': block_var
-                })
+    step = block_size // 2
+    n_rows, n_cols = sliding_grid(ela_array.shape, block_size, step)
+    grid = dict(step=step, n_rows=n_rows, n_cols=n_cols)
+    mean_grid, std_grid = context.mean_std('ela', block_size, **grid)
+    var_grid = context.mean('ela_variance', block_size, **grid)
     
-    # Statistical analysis
-    regional_means = np.array(regional_means)
-    regional_stds = np.array(regional_stds)
+    regional_means = mean_grid.ravel()
+    regional_stds = std_grid.ravel()
+    regional_variances = var_grid.ravel()
     
+    # Detect suspicious regions
+    suspicious = (mean_grid > 15) | (std_grid > 25) | (var_grid > 100)
+    suspicious_regions = [{
+        'position': (int(r) * step, int(c) * step),
+        'mean': mean_grid[r, c],
+        'std': std_grid[r, c],
+        'variance': var_grid[r, c]
+    } for r, c in zip(*np.nonzero(suspicious))]
+    
+    # Statistical analysis
     return {
         'mean_variance': np.var(regional_means),
         'std_variance': np.var(regional_stds),
@@ -176,7 +176,7 @@ def export_visualization_pdf(original_pil, analysis_results, output_filename="fo
             create_quality_response_plot(ax13, analysis_results)
             
             ax14 = fig2.add_subplot(gs2[1, 1])
-            ax14.imshow(analysis_results['noise_map'], cmap='gray')
+            ax14.imshow(analysis_results['noise_map'], cmap='inferno')
             ax14.set_title(f"Noise Map", fontsize=12)
             ax14.axis('off')
             
@@ -2,63 +2,349 @@
 Feature detection and matching functions
 """
 
+import os
 import numpy as np
 import cv2
+from concurrent.futures import ThreadPoolExecutor
 from sklearn.preprocessing import normalize as sk_normalize
 from config import *
+from image_context import ensure_context
 
-def extract_multi_detector_features(image_pil, ela_image_pil, ela_mean, ela_stddev):
-    """Extract features using multiple detectors (SIFT, ORB, SURF)"""
-    ela_np = np.array(ela_image_pil)
+# ======================= Feature Containers =======================
+
+DETECTOR_NAMES = ('sift', 'orb', 'akaze')
+
+class FeatureSet:
+    """Struct-of-arrays keypoint/descriptor container (picklable)"""
+
+    def __init__(self, xy=None, size=None, angle=None, response=None,
+                 octave=None, descriptors=None):
+        n = 0 if xy is None else len(xy)
+        self.xy = np.asarray(xy if xy is not None else [], dtype=np.float32).reshape(n, 2)
+        self.size = _column(size, n, np.float32)
+        self.angle = _column(angle, n, np.float32, fill=-1)
+        self.response = _column(response, n, np.float32)
+        self.octave = _column(octave, n, np.int32)
+        self.descriptors = descriptors
+
+    def __len__(self):
+        return len(self.xy)
+
+    def __repr__(self):
+        desc = None if self.descriptors is None else self.descriptors.shape
+        return f"FeatureSet(n={len(self)}, descriptors={desc})"
+
+    def subset(self, index):
+        """Return a new FeatureSet restricted to index (mask or indices)"""
+        descriptors = None if self.descriptors is None else self.descriptors[index]
+        return FeatureSet(self.xy[index], self.size[index], self.angle[index],
+                          self.response[index], self.octave[index], descriptors)
+
+class MatchSet:
+    """Struct-of-arrays match container: (M, 2) int32 index pairs + float32 distances"""
+
+    def __init__(self, pairs=None, distances=None, source=None):
+        m = 0 if pairs is None else len(pairs)
+        self.pairs = np.asarray(pairs if pairs is not None else [], dtype=np.int32).reshape(m, 2)
+        self.distances = _column(distances, m, np.float32)
+        # Index ke DETECTOR_NAMES, karena pairs hanya valid terhadap FeatureSet detektornya
+        self.source = _column(source, m, np.int8)
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def __repr__(self):
+        return f"MatchSet(m={len(self)})"
+
+    def subset(self, index):
+        """Return a new MatchSet restricted to index (mask or indices)"""
+        return MatchSet(self.pairs[index], self.distances[index], self.source[index])
+
+    def for_detector(self, detector_name):
+        """Matches produced by a single detector"""
+        return self.subset(self.source == DETECTOR_NAMES.index(detector_name))
+
+def _column(values, n, dtype, fill=0):
+    """Coerce an optional per-item column to a 1-D array of length n"""
+    if values is None:
+        return np.full(n, fill, dtype=dtype)
+    return np.asarray(values, dtype=dtype).reshape(n)
+
+def keypoints_to_feature_set(keypoints, descriptors):
+    """Convert cv2.KeyPoint list + descriptors to a FeatureSet"""
+    if not keypoints:
+        return FeatureSet(descriptors=descriptors)
+    return FeatureSet(
+        xy=[kp.pt for kp in keypoints],
+        size=[kp.size for kp in keypoints],
+        angle=[kp.angle for kp in keypoints],
+        response=[kp.response for kp in keypoints],
+        octave=[kp.octave for kp in keypoints],
+        descriptors=descriptors
+    )
+
+def feature_set_to_keypoints(feature_set):
+    """Convert a FeatureSet back to a list of cv2.KeyPoint (e.g. for cv2.drawKeypoints)"""
+    return [cv2.KeyPoint(float(x), float(y), float(s), float(a), float(r), int(o))
+            for (x, y), s, a, r, o in zip(feature_set.xy, feature_set.size, feature_set.angle,
+                                          feature_set.response, feature_set.octave)]
+
+def dmatches_to_match_set(matches, detector_name='sift'):
+    """Convert a list of cv2.DMatch to a MatchSet"""
+    source = np.full(len(matches), DETECTOR_NAMES.index(detector_name), dtype=np.int8)
+    return MatchSet([(m.queryIdx, m.trainIdx) for m in matches],
+                    [m.distance for m in matches], source)
+
+def match_set_to_dmatches(match_set):
+    """Convert a MatchSet back to a list of cv2.DMatch"""
+    return [cv2.DMatch(int(q), int(t), float(d))
+            for (q, t), d in zip(match_set.pairs, match_set.distances)]
+
+def concatenate_match_sets(match_sets):
+    """Concatenate several MatchSets (e.g. one per detector)"""
+    match_sets = [ms for ms in match_sets if len(ms) > 0]
+    if not match_sets:
+        return MatchSet()
+    return MatchSet(np.concatenate([ms.pairs for ms in match_sets]),
+                    np.concatenate([ms.distances for ms in match_sets]),
+                    np.concatenate([ms.source for ms in match_sets]))
+
+def knn_self_match_candidates(knn_matches, xy, min_distance, max_descriptor_distance, detector_name,
+                              skip_first=True):
+    """Flatten knnMatch output (skipping self-match) and filter by spatial/descriptor distance"""
+    query, train, dist = [], [], []
+    first = 1 if skip_first else 0
+    for i, match_list in enumerate(knn_matches):
+        for m in match_list[first:]:  # Skip self-match
+            query.append(i)
+            train.append(m.trainIdx)
+            dist.append(m.distance)
+    
+    query = np.asarray(query, dtype=np.int32)
+    train = np.asarray(train, dtype=np.int32)
+    dist = np.asarray(dist, dtype=np.float32)
     
-    # Dynamic thresholding
-    threshold = ela_mean + 1.5 * ela_stddev
-    threshold = max(min(threshold, 180), 30)
+    if len(query) > 0:
+        spatial_dist = np.linalg.norm(xy[query] - xy[train], axis=1)
+        keep = (spatial_dist > min_distance) & (dist < max_descriptor_distance)
+        query, train, dist = query[keep], train[keep], dist[keep]
     
-    # Enhanced ROI mask
-    roi_mask = (ela_np > threshold).astype(np.uint8) * 255
-    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (7, 7))
-    roi_mask = cv2.morphologyEx(roi_mask, cv2.MORPH_CLOSE, kernel)
-    roi_mask = cv2.morphologyEx(roi_mask, cv2.MORPH_OPEN, kernel)
+    source = np.full(len(query), DETECTOR_NAMES.index(detector_name), dtype=np.int8)
+    return MatchSet(np.stack([query, train], axis=1), dist, source)
+
+# ======================= Feature Extraction =======================
+
+def extract_multi_detector_features(image_pil, ela_image_pil, ela_mean, ela_stddev,
+                                    full_res_image=None, context=None, full_res_context=None,
+                                    detectors=('sift', 'orb', 'akaze')):
+    """Extract features using multiple detectors (SIFT, ORB, SURF)
     
-    # Convert to grayscale with enhancement
-    original_image_np = np.array(image_pil.convert('RGB'))
-    gray_original = cv2.cvtColor(original_image_np, cv2.COLOR_RGB2GRAY)
+    If full_res_image is given and larger than image_pil, SIFT/ORB are extracted
+    on full-resolution tiles (see extract_tiled_features) and mapped back to
+    image_pil coordinates. With ela_image_pil=None the whole image is described
+    (no ROI mask), e.g. for indexing donor images. full_res_context may stand in
+    for full_res_image so its CLAHE plane is shared with other full-res stages.
+    Only the named detectors run; the others are left out of feature_sets.
+    """
+    if ela_image_pil is None:
+        roi_mask = None
+    else:
+        ela_np = np.array(ela_image_pil)
+        
+        # Dynamic thresholding
+        threshold = ela_mean + 1.5 * ela_stddev
+        threshold = max(min(threshold, 180), 30)
+        
+        # Enhanced ROI mask
+        roi_mask = (ela_np > threshold).astype(np.uint8) * 255
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (7, 7))
+        roi_mask = cv2.morphologyEx(roi_mask, cv2.MORPH_CLOSE, kernel)
+        roi_mask = cv2.morphologyEx(roi_mask, cv2.MORPH_OPEN, kernel)
     
-    # Multiple enhancement techniques
-    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-    gray_enhanced = clahe.apply(gray_original)
+    # Grayscale with CLAHE enhancement (memoized in the ImageContext)
+    gray_enhanced = ensure_context(image_pil, context).plane('clahe')
     
     # Extract features using multiple detectors
     feature_sets = {}
     
-    # 1. SIFT
-    sift = cv2.SIFT_create(nfeatures=SIFT_FEATURES, 
-                          contrastThreshold=SIFT_CONTRAST_THRESHOLD, 
-                          edgeThreshold=SIFT_EDGE_THRESHOLD)
-    kp_sift, desc_sift = sift.detectAndCompute(gray_enhanced, mask=roi_mask)
-    feature_sets['sift'] = (kp_sift, desc_sift)
+    if full_res_context is not None:
+        full_res_image = full_res_context.image
+    use_tiles = (TILED_FEATURES and full_res_image is not None and
+                 max(full_res_image.size) > max(image_pil.size))
+    
+    if use_tiles:
+        tiled_sets = extract_tiled_features(full_res_image, image_pil.size, roi_mask, context=full_res_context)
+        feature_sets.update(tiled_sets)
+    
+    # 1. SIFT (whole image only when the tiled path did not supply it)
+    if 'sift' not in feature_sets and 'sift' in detectors:
+        sift = cv2.SIFT_create(nfeatures=SIFT_FEATURES, 
+                              contrastThreshold=SIFT_CONTRAST_THRESHOLD, 
+                              edgeThreshold=SIFT_EDGE_THRESHOLD)
+        kp_sift, desc_sift = sift.detectAndCompute(gray_enhanced, mask=roi_mask)
+        feature_sets['sift'] = keypoints_to_feature_set(kp_sift, desc_sift)
     
     # 2. ORB
-    orb = cv2.ORB_create(nfeatures=ORB_FEATURES, 
-                        scaleFactor=ORB_SCALE_FACTOR, 
-                        nlevels=ORB_LEVELS)
-    kp_orb, desc_orb = orb.detectAndCompute(gray_enhanced, mask=roi_mask)
-    feature_sets['orb'] = (kp_orb, desc_orb)
+    if 'orb' not in feature_sets and 'orb' in detectors:
+        orb = cv2.ORB_create(nfeatures=ORB_FEATURES, 
+                            scaleFactor=ORB_SCALE_FACTOR, 
+                            nlevels=ORB_LEVELS)
+        kp_orb, desc_orb = orb.detectAndCompute(gray_enhanced, mask=roi_mask)
+        feature_sets['orb'] = keypoints_to_feature_set(kp_orb, desc_orb)
     
     # 3. AKAZE
-    try:
-        akaze = cv2.AKAZE_create()
-        kp_akaze, desc_akaze = akaze.detectAndCompute(gray_enhanced, mask=roi_mask)
-        feature_sets['akaze'] = (kp_akaze, desc_akaze)
-    except:
-        feature_sets['akaze'] = ([], None)
+    if 'akaze' in detectors:
+        try:
+            akaze = cv2.AKAZE_create()
+            kp_akaze, desc_akaze = akaze.detectAndCompute(gray_enhanced, mask=roi_mask)
+            feature_sets['akaze'] = keypoints_to_feature_set(kp_akaze, desc_akaze)
+        except:
+            feature_sets['akaze'] = FeatureSet()
     
     return feature_sets, roi_mask, gray_enhanced
 
-def match_sift_features(keypoints, descriptors, ratio_thresh, min_distance, ransac_thresh, min_inliers):
+# ======================= Tiled Feature Extraction =======================
+
+def adaptive_non_maximal_suppression(xy, response, n_keep, c_robust=ANMS_ROBUST_COEFF):
+    """Adaptive non-maximal suppression (Brown et al.), returns indices of kept keypoints
+    
+    Each keypoint gets the radius to the nearest keypoint that is clearly stronger
+    (response_i < c_robust * response_j); the n_keep largest radii are kept so that
+    the surviving keypoints are spread evenly instead of clustering on strong texture.
+    """
+    n = len(xy)
+    if n <= n_keep:
+        return np.arange(n)
+    
+    order = np.argsort(-response, kind='stable')
+    xy_sorted = xy[order].astype(np.float32)
+    resp_sorted = response[order].astype(np.float32)
+    radius = np.full(n, np.inf, dtype=np.float32)
+    
+    # Chunk rows to bound the (chunk, n) distance matrix
+    chunk = 1024
+    for start in range(0, n, chunk):
+        stop = min(start + chunk, n)
+        diff = xy_sorted[start:stop, None, :] - xy_sorted[None, :, :]
+        d2 = np.einsum('ijk,ijk->ij', diff, diff)
+        stronger = resp_sorted[start:stop, None] < c_robust * resp_sorted[None, :]
+        d2[~stronger] = np.inf
+        radius[start:stop] = d2.min(axis=1)
+    
+    keep = np.argsort(-radius, kind='stable')[:n_keep]
+    return np.sort(order[keep])
+
+def _tile_grid(h, w, tile_size, overlap):
+    """Yield (y0, y1, x0, x1, core) tiles; core = region owned by the tile without overlap"""
+    step = tile_size - overlap
+    ys = list(range(0, max(h - overlap, 1), step))
+    xs = list(range(0, max(w - overlap, 1), step))
+    for y0 in ys:
+        for x0 in xs:
+            y1, x1 = min(y0 + tile_size, h), min(x0 + tile_size, w)
+            # Keypoints in the overlap belong to the tile whose core contains them
+            core = (y0 + (overlap // 2 if y0 > 0 else 0),
+                    y1 - (overlap // 2 if y1 < h else 0),
+                    x0 + (overlap // 2 if x0 > 0 else 0),
+                    x1 - (overlap // 2 if x1 < w else 0))
+            yield y0, y1, x0, x1, core
+
+def _detect_tile(detector_name, gray_tile, mask_tile, budget):
+    """Detect + describe on a single tile with ANMS down to budget"""
+    if detector_name == 'sift':
+        detector = cv2.SIFT_create(nfeatures=budget * ANMS_CANDIDATE_FACTOR,
+                                   contrastThreshold=SIFT_CONTRAST_THRESHOLD,
+                                   edgeThreshold=SIFT_EDGE_THRESHOLD)
+    else:
+        detector = cv2.ORB_create(nfeatures=budget * ANMS_CANDIDATE_FACTOR,
+                                  scaleFactor=ORB_SCALE_FACTOR,
+                                  nlevels=ORB_LEVELS)
+    
+    keypoints = detector.detect(gray_tile, mask=mask_tile)
+    if not keypoints:
+        return []
+    
+    xy = np.float32([kp.pt for kp in keypoints])
+    response = np.float32([kp.response for kp in keypoints])
+    keep = adaptive_non_maximal_suppression(xy, response, budget)
+    keypoints, descriptors = detector.compute(gray_tile, [keypoints[i] for i in keep])
+    return keypoints, descriptors
+
+def extract_tiled_features(image_full, working_size, roi_mask=None,
+                           tile_size=TILE_SIZE, tile_overlap=TILE_OVERLAP,
+                           detectors=('sift', 'orb'), max_workers=TILE_WORKERS, context=None):
+    """SIFT/ORB on overlapping full-resolution tiles, merged into working-image coordinates
+    
+    Each tile gets an equal share of the TILED_*_FEATURES budget and is thinned with ANMS,
+    so the total keypoint count stays bounded while small cloned regions that vanish in
+    the TARGET_MAX_DIM downscale are still described. Tiles run in a thread pool
+    (OpenCV releases the GIL), which keeps peak memory at one SIFT pyramid per worker.
+    roi_mask is given at working resolution and upsampled per tile. The CLAHE gray
+    comes from context (an ImageContext of image_full) when one is given.
+    """
+    gray_full = ensure_context(image_full, context).plane('clahe')
+    
+    h, w = gray_full.shape
+    scale_x = working_size[0] / w
+    scale_y = working_size[1] / h
+    tiles = list(_tile_grid(h, w, tile_size, tile_overlap))
+    budgets = {'sift': TILED_SIFT_FEATURES, 'orb': TILED_ORB_FEATURES}
+    
+    print(f"  - Tiled extraction: {len(tiles)} tiles of {tile_size}px on {w}x{h}")
+    
+    def run_tile(detector_name, tile):
+        y0, y1, x0, x1, (cy0, cy1, cx0, cx1) = tile
+        mask_tile = None
+        if roi_mask is not None:
+            my0, my1 = int(y0 * scale_y), max(int(np.ceil(y1 * scale_y)), int(y0 * scale_y) + 1)
+            mx0, mx1 = int(x0 * scale_x), max(int(np.ceil(x1 * scale_x)), int(x0 * scale_x) + 1)
+            mask_tile = cv2.resize(roi_mask[my0:my1, mx0:mx1], (x1 - x0, y1 - y0),
+                                   interpolation=cv2.INTER_NEAREST)
+            if not np.any(mask_tile):
+                return None
+        
+        budget = max(1, budgets[detector_name] // len(tiles))
+        result = _detect_tile(detector_name, gray_full[y0:y1, x0:x1], mask_tile, budget)
+        if not result or result[1] is None:
+            return None
+        
+        fs = keypoints_to_feature_set(*result)
+        fs.xy += np.float32([x0, y0])
+        in_core = ((fs.xy[:, 0] >= cx0) & (fs.xy[:, 0] < cx1) &
+                   (fs.xy[:, 1] >= cy0) & (fs.xy[:, 1] < cy1))
+        return fs.subset(in_core)
+    
+    workers = max_workers or os.cpu_count() or 1
+    feature_sets = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for detector_name in detectors:
+            parts = [fs for fs in pool.map(lambda t: run_tile(detector_name, t), tiles)
+                     if fs is not None and len(fs) > 0]
+            feature_sets[detector_name] = merge_feature_sets(parts, scale=(scale_x, scale_y))
+            print(f"  - Tiled {detector_name.upper()}: {len(feature_sets[detector_name])} keypoints")
+    
+    return feature_sets
+
+def merge_feature_sets(feature_sets, scale=(1.0, 1.0)):
+    """Concatenate FeatureSets and rescale their geometry (e.g. full-res -> working coords)"""
+    if not feature_sets:
+        return FeatureSet()
+    sx, sy = scale
+    merged = FeatureSet(
+        xy=np.concatenate([fs.xy for fs in feature_sets]) * np.float32([sx, sy]),
+        size=np.concatenate([fs.size for fs in feature_sets]) * np.float32((sx + sy) / 2),
+        angle=np.concatenate([fs.angle for fs in feature_sets]),
+        response=np.concatenate([fs.response for fs in feature_sets]),
+        octave=np.concatenate([fs.octave for fs in feature_sets]),
+        descriptors=np.concatenate([fs.descriptors for fs in feature_sets])
+    )
+    return merged
+
+# ======================= Feature Matching =======================
+
+def match_sift_features(feature_set, ratio_thresh, min_distance, ransac_thresh, min_inliers):
     """Enhanced SIFT matching"""
-    descriptors_norm = sk_normalize(descriptors, norm='l2', axis=1)
+    descriptors_norm = sk_normalize(feature_set.descriptors, norm='l2', axis=1)
     
     # FLANN matcher
     FLANN_INDEX_KDTREE = 1
@@ -67,27 +353,14 @@ def match_sift_features(keypoints, descriptors, ratio_thresh, min_distance, rans
     flann = cv2.FlannBasedMatcher(index_params, search_params)
     
     matches = flann.knnMatch(descriptors_norm, descriptors_norm, k=8)
+    good_matches = knn_self_match_candidates(matches, feature_set.xy, min_distance, ratio_thresh, 'sift')
     
-    good_matches = []
-    match_pairs = []
-    
-    for i, match_list in enumerate(matches):
-        for m in match_list[1:]:  # Skip self-match
-            pt1 = keypoints[i].pt
-            pt2 = keypoints[m.trainIdx].pt
-            
-            spatial_dist = np.sqrt((pt1[0] - pt2[0])**2 + (pt1[1] - pt2[1])**2)
-            
-            if spatial_dist > min_distance and m.distance < ratio_thresh:
-                good_matches.append(m)
-                match_pairs.append((i, m.trainIdx))
-    
-    if len(match_pairs) < min_inliers:
+    if len(good_matches) < min_inliers:
         return good_matches, 0, None
     
     # RANSAC verification
-    src_pts = np.float32([keypoints[i].pt for i, _ in match_pairs]).reshape(-1, 1, 2)
-    dst_pts = np.float32([keypoints[j].pt for _, j in match_pairs]).reshape(-1, 1, 2)
+    src_pts = feature_set.xy[good_matches.pairs[:, 0]].reshape(-1, 1, 2)
+    dst_pts = feature_set.xy[good_matches.pairs[:, 1]].reshape(-1, 1, 2)
     
     best_inliers = 0
     best_transform = None
@@ -118,60 +391,35 @@ def match_sift_features(keypoints, descriptors, ratio_thresh, min_distance, rans
             continue
     
     if best_mask is not None and best_inliers >= min_inliers:
-        ransac_matches = [good_matches[i] for i in range(len(good_matches))
-                         if best_mask[i][0] == 1]
+        ransac_matches = good_matches.subset(best_mask.ravel() == 1)
         return ransac_matches, best_inliers, best_transform
     
     return good_matches, 0, None
 
-def match_orb_features(keypoints, descriptors, min_distance, ransac_thresh, min_inliers):
+def match_orb_features(feature_set, min_distance, ransac_thresh, min_inliers):
     """ORB feature matching"""
     # Hamming distance matcher for ORB
     bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=False)
-    matches = bf.knnMatch(descriptors, descriptors, k=6)
-    
-    good_matches = []
-    match_pairs = []
+    matches = bf.knnMatch(feature_set.descriptors, feature_set.descriptors, k=6)
     
-    for i, match_list in enumerate(matches):
-        for m in match_list[1:]:  # Skip self-match
-            pt1 = keypoints[i].pt
-            pt2 = keypoints[m.trainIdx].pt
-            
-            spatial_dist = np.sqrt((pt1[0] - pt2[0])**2 + (pt1[1] - pt2[1])**2)
-            
-            if spatial_dist > min_distance and m.distance < 80:  # Hamming distance threshold
-                good_matches.append(m)
-                match_pairs.append((i, m.trainIdx))
+    # Hamming distance threshold 80
+    good_matches = knn_self_match_candidates(matches, feature_set.xy, min_distance, 80, 'orb')
     
-    if len(match_pairs) < min_inliers:
+    if len(good_matches) < min_inliers:
         return good_matches, 0, None
     
     # Simple geometric verification
-    return good_matches, len(match_pairs), ('orb_matches', None)
+    return good_matches, len(good_matches), ('orb_matches', None)
 
-def match_akaze_features(keypoints, descriptors, min_distance, ransac_thresh, min_inliers):
+def match_akaze_features(feature_set, min_distance, ransac_thresh, min_inliers):
     """AKAZE feature matching"""
-    if descriptors is None:
-        return [], 0, None
+    if feature_set.descriptors is None:
+        return MatchSet(), 0, None
     
     # Hamming distance for AKAZE
     bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=False)
-    matches = bf.knnMatch(descriptors, descriptors, k=6)
-    
-    good_matches = []
-    match_pairs = []
-    
-    for i, match_list in enumerate(matches):
-        if len(match_list) > 1:
-            for m in match_list[1:]:  # Skip self-match
-                pt1 = keypoints[i].pt
-                pt2 = keypoints[m.trainIdx].pt
-                
-                spatial_dist = np.sqrt((pt1[0] - pt2[0])**2 + (pt1[1] - pt2[1])**2)
-                
-                if spatial_dist > min_distance and m.distance < 100:
-                    good_matches.append(m)
-                    match_pairs.append((i, m.trainIdx))
-    
-    return good_matches, len(match_pairs), ('akaze_matches', None)
+    matches = bf.knnMatch(feature_set.descriptors, feature_set.descriptors, k=6)
+    
+    good_matches = knn_self_match_candidates(matches, feature_set.xy, min_distance, 100, 'akaze')
+    
+    return good_matches, len(good_matches), ('akaze_matches', None)
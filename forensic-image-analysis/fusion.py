@@ -0,0 +1,217 @@
+"""
+Evidence Fusion Module for Forensic Image Analysis System
+Combines per-detector evidence maps on one coarse grid into a tampering probability map
+"""
+
+import numpy as np
+import cv2
+from config import *
+import warnings
+
+warnings.filterwarnings('ignore')
+
+# ======================= Grid Registration =======================
+
+def fusion_grid_shape(image_shape, factor=FUSION_GRID_FACTOR):
+    """(rows, cols) of the coarse fusion grid for an (h, w) image"""
+    h, w = image_shape[:2]
+    return max(1, -(-h // factor)), max(1, -(-w // factor))
+
+def register_map(evidence, grid_shape):
+    """Resample any full- or block-resolution map onto the fusion grid (float32, area average)"""
+    evidence = np.asarray(evidence, dtype=np.float32)
+    gh, gw = grid_shape
+    if evidence.shape == (gh, gw):
+        return evidence
+    interpolation = cv2.INTER_AREA if evidence.shape[0] >= gh else cv2.INTER_LINEAR
+    return cv2.resize(evidence, (gw, gh), interpolation=interpolation)
+
+def rasterize_points(xy, image_shape, grid_shape, spread=FUSION_POINT_SPREAD):
+    """Point density on the fusion grid: one bincount plus a Gaussian spread (in grid cells)"""
+    gh, gw = grid_shape
+    h, w = image_shape[:2]
+    density = np.zeros(gh * gw, dtype=np.float32)
+    xy = np.asarray(xy, dtype=np.float32).reshape(-1, 2)
+    if len(xy):
+        cols = np.clip((xy[:, 0] * gw / w).astype(np.int64), 0, gw - 1)
+        rows = np.clip((xy[:, 1] * gh / h).astype(np.int64), 0, gh - 1)
+        density = np.bincount(rows * gw + cols, minlength=gh * gw).astype(np.float32)
+    density = density.reshape(gh, gw)
+    if spread > 0 and density.any():
+        density = cv2.GaussianBlur(density, (0, 0), spread)
+    return density
+
+def rasterize_boxes(corners, box_size, image_shape, grid_shape):
+    """Coverage of axis-aligned square boxes (top-left corners) on the fusion grid"""
+    gh, gw = grid_shape
+    h, w = image_shape[:2]
+    coverage = np.zeros((gh + 1, gw + 1), dtype=np.float32)
+    corners = np.asarray(corners, dtype=np.float32).reshape(-1, 2)
+    if len(corners):
+        # Difference-array painting: +1/-1 at box corners, then 2-D cumulative sum
+        c0 = np.clip((corners[:, 0] * gw / w).astype(np.int64), 0, gw)
+        r0 = np.clip((corners[:, 1] * gh / h).astype(np.int64), 0, gh)
+        c1 = np.clip(np.ceil((corners[:, 0] + box_size) * gw / w).astype(np.int64), 0, gw)
+        r1 = np.clip(np.ceil((corners[:, 1] + box_size) * gh / h).astype(np.int64), 0, gh)
+        np.add.at(coverage, (r0, c0), 1)
+        np.add.at(coverage, (r0, c1), -1)
+        np.add.at(coverage, (r1, c0), -1)
+        np.add.at(coverage, (r1, c1), 1)
+        coverage = coverage.cumsum(axis=0).cumsum(axis=1)
+    return np.minimum(coverage[:gh, :gw], 1)
+
+def normalize_evidence(evidence, kind='continuous'):
+    """Map evidence to [0, 1]: masks as-is, continuous maps robustly between median and p99"""
+    evidence = evidence.astype(np.float32, copy=False)
+    if kind == 'mask':
+        return np.clip(evidence, 0, 1)
+    low = np.median(evidence)
+    high = np.percentile(evidence, 99)
+    if high - low < 1e-6:
+        return np.zeros_like(evidence)
+    return np.clip((evidence - low) / (high - low), 0, 1)
+
+# ======================= Evidence Collection =======================
+
+def noise_block_grid(noise_analysis):
+    """Per-block noise deviation (|log Laplacian variance - median|) as a 2-D block grid"""
+    blocks = noise_analysis.get('noise_characteristics')
+    if blocks is None or len(blocks) == 0:
+        return None
+    positions = blocks['position'].astype(np.int64)
+    values = np.log1p(blocks['laplacian_var'].astype(np.float64))
+    grid = np.zeros(positions.max(axis=0) + 1, dtype=np.float32)
+    grid[positions[:, 0], positions[:, 1]] = np.abs(values - np.median(values))
+    return grid
+
+def collect_evidence_maps(analysis_results, image_shape, kmeans_result=None, grid_shape=None):
+    """Register every available detector output on the fusion grid
+
+    Returns {name: (grid map, kind)}; detectors that did not run are simply absent.
+    """
+    grid_shape = grid_shape or fusion_grid_shape(image_shape)
+    evidence = {}
+
+    if analysis_results.get('ela_image') is not None:
+        evidence['ela'] = (register_map(np.array(analysis_results['ela_image']), grid_shape), 'continuous')
+
+    if analysis_results.get('jpeg_ghost') is not None:
+        evidence['ghost'] = (register_map(analysis_results['jpeg_ghost'], grid_shape), 'continuous')
+
+    noise_map = analysis_results.get('noise_map')
+    if noise_map is not None and noise_map.dtype.kind == 'f':
+        # Dense sigma map: deviation of local log-sigma from the image-wide median
+        log_sigma = np.log1p(register_map(noise_map, grid_shape))
+        evidence['noise'] = (np.abs(log_sigma - np.median(log_sigma)), 'continuous')
+    elif analysis_results.get('noise_analysis'):
+        grid = noise_block_grid(analysis_results['noise_analysis'])
+        if grid is not None:
+            evidence['noise'] = (register_map(grid, grid_shape), 'continuous')
+
+    # Double quantization: per-8x8-block probability, all zeros when the file shows no DQ at all
+    dq_map = analysis_results.get('dq_map')
+    if dq_map is not None and dq_map.any():
+        evidence['dq'] = (register_map(dq_map, grid_shape), 'mask')
+
+    if kmeans_result is not None:
+        evidence['kmeans'] = (register_map(kmeans_result['tampering_mask'], grid_shape), 'mask')
+
+    # Copy-move: dense clone masks and rasterised correspondences, merged by maximum
+    copy_move = []
+    for key in ('two_pass_copy_move', 'patchmatch_copy_move'):
+        result = analysis_results.get(key)
+        if result is not None and result.get('clone_mask') is not None:
+            copy_move.append(register_map(result['clone_mask'], grid_shape))
+
+    feature_set = analysis_results.get('sift_keypoints')
+    matches = analysis_results.get('ransac_matches')
+    if feature_set is not None and matches is not None and len(matches):
+        sift_pairs = matches.for_detector('sift').pairs
+        if len(sift_pairs):
+            points = feature_set.xy[sift_pairs.ravel()]
+            copy_move.append(normalize_evidence(rasterize_points(points, image_shape, grid_shape)))
+
+    block_matches = analysis_results.get('block_matches') or []
+    if block_matches:
+        corners = [m['block1'] for m in block_matches] + [m['block2'] for m in block_matches]
+        copy_move.append(rasterize_boxes(corners, BLOCK_SIZE, image_shape, grid_shape))
+
+    if copy_move:
+        evidence['copy_move'] = (np.maximum.reduce(copy_move), 'mask')
+
+    return evidence
+
+# ======================= Fusion =======================
+
+def fuse_evidence(evidence, method=FUSION_METHOD, weights=FUSION_WEIGHTS,
+                  logistic_model=FUSION_LOGISTIC_MODEL):
+    """Combine normalised evidence maps into a tampering probability map on the fusion grid
+
+    'weighted' averages with the given weights (renormalised over the maps present);
+    'logistic' applies sigmoid(bias + sum w_i * m_i) with coefficients from a learned model.
+    """
+    names = [name for name in evidence if (weights.get(name, 0) if method == 'weighted'
+                                           else logistic_model['weights'].get(name, 0))]
+    if not names:
+        shape = next(iter(evidence.values()))[0].shape if evidence else (1, 1)
+        return np.zeros(shape, dtype=np.float32), {}
+
+    normalized = {name: normalize_evidence(*evidence[name]) for name in names}
+    if method == 'logistic':
+        coeffs = {name: float(logistic_model['weights'][name]) for name in names}
+        logit = float(logistic_model['bias']) + sum(coeffs[n] * normalized[n] for n in names)
+        probability = 1.0 / (1.0 + np.exp(-logit))
+    else:
+        total = float(sum(weights[name] for name in names))
+        coeffs = {name: weights[name] / total for name in names}
+        probability = sum(coeffs[n] * normalized[n] for n in names)
+
+    return probability.astype(np.float32), coeffs
+
+def fused_tampering_mask(probability, image_shape, threshold=FUSION_THRESHOLD):
+    """Threshold and clean the fused map on the grid, then upsample only the final mask"""
+    h, w = image_shape[:2]
+    mask = (probability >= threshold).astype(np.uint8)
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
+    return cv2.resize(mask, (w, h), interpolation=cv2.INTER_NEAREST).astype(bool)
+
+def fuse_localization_evidence(analysis_results, image_shape, kmeans_result=None,
+                               method=FUSION_METHOD, threshold=FUSION_THRESHOLD):
+    """Full fusion pass: collect, normalise, combine and threshold"""
+    grid_shape = fusion_grid_shape(image_shape)
+    evidence = collect_evidence_maps(analysis_results, image_shape, kmeans_result, grid_shape)
+    probability, coeffs = fuse_evidence(evidence, method=method)
+    return {
+        'probability_map': probability,
+        'tampering_mask': fused_tampering_mask(probability, image_shape, threshold),
+        'weights': coeffs,
+        'sources': list(evidence.keys()),
+        'grid_factor': FUSION_GRID_FACTOR,
+        'method': method
+    }
+
+def fit_logistic_fusion(samples, max_cells_per_image=20000):
+    """Learn FUSION_LOGISTIC_MODEL coefficients from (evidence, ground-truth mask) pairs
+
+    evidence is a collect_evidence_maps() result; masks are boolean at image resolution.
+    """
+    from sklearn.linear_model import LogisticRegression
+    
+    names = sorted(set.intersection(*[set(evidence) for evidence, _ in samples]))
+    rng = np.random.default_rng(42)
+    X, y = [], []
+    for evidence, truth in samples:
+        grid_shape = evidence[names[0]][0].shape
+        target = register_map(truth, grid_shape).ravel() >= 0.5
+        columns = np.stack([normalize_evidence(*evidence[n]).ravel() for n in names], axis=1)
+        keep = rng.permutation(len(target))[:max_cells_per_image]
+        X.append(columns[keep])
+        y.append(target[keep])
+    
+    model = LogisticRegression(class_weight='balanced', max_iter=1000).fit(np.concatenate(X), np.concatenate(y))
+    return {
+        'bias': float(model.intercept_[0]),
+        'weights': {name: float(c) for name, c in zip(names, model.coef_[0])}
+    }
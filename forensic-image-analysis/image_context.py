@@ -0,0 +1,91 @@
+"""
+Image Context Module for Forensic Image Analysis System
+One object per analysed image holding lazily computed, memoized derived planes
+"""
+
+import numpy as np
+import cv2
+from block_stats import BlockStats
+from config import STAGE_INPUTS
+
+# ======================= Image Context =======================
+
+class ImageContext(BlockStats):
+    """Derived planes of one (preprocessed) image, each computed once on first use
+
+    Standard planes: 'rgb' (uint8 HxWx3), 'gray' (uint8), 'gray_float32', 'lab',
+    'clahe' (CLAHE-enhanced gray, clip 2.0, 8x8 tiles) and 'laplacian' (float64).
+    Stages add their own planes ('ela', 'edge', ...) with add_plane(). Being a
+    BlockStats, the context also answers block mean/var/std queries for any plane.
+    """
+
+    def __init__(self, image_pil):
+        super().__init__()
+        self.image = image_pil if image_pil.mode == 'RGB' else image_pil.convert('RGB')
+        self.add_plane('rgb', lambda: np.asarray(self.image))
+        self.add_plane('gray', lambda: cv2.cvtColor(self.rgb, cv2.COLOR_RGB2GRAY))
+        self.add_plane('gray_float32', lambda: self.gray.astype(np.float32))
+        self.add_plane('lab', lambda: cv2.cvtColor(self.rgb, cv2.COLOR_RGB2LAB))
+        self.add_plane('clahe', lambda: cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8)).apply(self.gray))
+        self.add_plane('laplacian', lambda: cv2.Laplacian(self.gray, cv2.CV_64F))
+
+    def __repr__(self):
+        return f"ImageContext(size={self.size}, planes={list(self._sources)}, built={list(self._planes)})"
+
+    @property
+    def size(self):
+        """(width, height) like PIL"""
+        return self.image.size
+
+    def shape(self, name='rgb'):
+        if name == 'rgb' and name not in self._planes:
+            return self.image.size[::-1]
+        return super().shape(name)
+
+    @property
+    def rgb(self):
+        return self.plane('rgb')
+
+    @property
+    def gray(self):
+        return self.plane('gray')
+
+    @property
+    def lab(self):
+        return self.plane('lab')
+
+def ensure_context(image_pil, context=None):
+    """The caller's shared ImageContext, or a fresh one for image_pil when a stage runs standalone"""
+    return context if context is not None else ImageContext(image_pil)
+
+# ======================= Stage Inputs =======================
+
+class StageInputs:
+    """Raw and denoised ImageContexts of one run, handed to each stage per STAGE_INPUTS
+
+    The denoised context is only built when the first 'denoised' stage asks for it,
+    so a run whose stages all read raw pixels never pays for denoising. Without a
+    denoise function (profile 'none') both kinds share the raw context.
+    """
+
+    def __init__(self, raw_image, denoise=None, stage_inputs=STAGE_INPUTS):
+        self.raw = ImageContext(raw_image)
+        self._denoise = denoise
+        self._denoised = self.raw if denoise is None else None
+        self.stage_inputs = stage_inputs
+
+    @property
+    def denoised(self):
+        if self._denoised is None:
+            self._denoised = ImageContext(self._denoise(self.raw.image))
+        return self._denoised
+
+    def __getitem__(self, stage):
+        """ImageContext a stage should read ('raw' for stages not listed)"""
+        return self.denoised if self.stage_inputs.get(stage, 'raw') == 'denoised' else self.raw
+
+    def release(self, *names):
+        """BlockStats.release on every context built so far"""
+        self.raw.release(*names)
+        if self._denoised is not None and self._denoised is not self.raw:
+            self._denoised.release(*names)
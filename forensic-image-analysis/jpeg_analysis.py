@@ -9,6 +9,9 @@ import os
 from PIL import Image, ImageChops
 from scipy import ndimage
 from utils import detect_outliers_iqr, safe_divide
+from image_context import ensure_context
+from metadata_scan import ZIGZAG_ORDER
+from config import DQ_COEFFICIENTS, DQ_HIST_RANGE, DQ_MAX_PRIMARY_STEP, DQ_MIN_GAIN, DQ_MIN_SAMPLES
 import warnings
 
 warnings.filterwarnings('ignore')
@@ -183,14 +186,13 @@ def detect_compression_inconsistency(quality_responses):
 
 # ======================= JPEG Ghost Analysis =======================
 
-def jpeg_ghost_analysis(image_pil, qualities=range(50, 101, 5)):
+def jpeg_ghost_analysis(image_pil, qualities=range(50, 101, 5), context=None):
     """Perform comprehensive JPEG ghost analysis"""
     print(f"  Performing JPEG ghost analysis with {len(qualities)} qualities...")
     
-    if image_pil.mode != 'RGB':
-        image_pil = image_pil.convert('RGB')
-    
-    original_array = np.array(image_pil)
+    context = ensure_context(image_pil, context)
+    image_pil = context.image
+    original_array = context.rgb
     h, w, c = original_array.shape
     
     ghost_map = np.zeros((h, w))
@@ -327,15 +329,11 @@ def analyze_ghost_patterns(ghost_map, quality_response_map, qualities):
 
 # ======================= Block-wise JPEG Analysis =======================
 
-def analyze_jpeg_blocks(image_pil, block_size=8):
+def analyze_jpeg_blocks(image_pil, block_size=8, context=None):
     """Analyze JPEG 8x8 blocks for compression artifacts"""
     print("  Analyzing JPEG block artifacts...")
     
-    if image_pil.mode != 'RGB':
-        image_pil = image_pil.convert('RGB')
-    
-    image_array = np.array(image_pil)
-    gray_image = cv2.cvtColor(image_array, cv2.COLOR_RGB2GRAY)
+    gray_image = ensure_context(image_pil, context).gray
     
     h, w = gray_image.shape
     blocks_h = h // block_size
@@ -460,7 +458,7 @@ def estimate_quantization_noise(dct_block):
 
 # ======================= Double JPEG Detection =======================
 
-def detect_double_jpeg(image_pil, quality_range=(50, 95, 5)):
+def detect_double_jpeg(image_pil, quality_range=(50, 95, 5), context=None):
     """Detect double JPEG compression"""
     print("  Detecting double JPEG compression...")
     
@@ -468,7 +466,8 @@ def detect_double_jpeg(image_pil, quality_range=(50, 95, 5)):
     qualities = list(range(start_q, end_q + 1, step_q))
     
     # Perform JPEG ghost analysis
-    ghost_map, suspicious_map, ghost_analysis = jpeg_ghost_analysis(image_pil, qualities)
+    context = ensure_context(image_pil, context)
+    ghost_map, suspicious_map, ghost_analysis = jpeg_ghost_analysis(image_pil, qualities, context)
     
     # Additional double compression indicators
     double_compression_score = 0
@@ -500,14 +499,14 @@ def detect_double_jpeg(image_pil, quality_range=(50, 95, 5)):
         indicators.append(f"Low response at qualities: {low_response_qualities}")
     
     # 4. Block-wise analysis
-    block_analysis = analyze_jpeg_blocks(image_pil)
+    block_analysis = analyze_jpeg_blocks(image_pil, context=context)
     
     if block_analysis['blocking_variance'] > 100:  # High variance in blocking artifacts
         double_compression_score += 15
         indicators.append(f"High blocking variance detected: {block_analysis['blocking_variance']:.1f}")
     
     # 5. Frequency domain analysis
-    freq_analysis = analyze_double_compression_frequency(image_pil)
+    freq_analysis = analyze_double_compression_frequency(image_pil, context)
     if freq_analysis['double_compression_indicator'] > 0.5:
         double_compression_score += 20
         indicators.append(f"Frequency domain anomalies: {freq_analysis['double_compression_indicator']:.3f}")
@@ -534,13 +533,9 @@ def detect_double_jpeg(image_pil, quality_range=(50, 95, 5)):
         'is_double_compressed': double_compression_score >= 30
     }
 
-def analyze_double_compression_frequency(image_pil):
+def analyze_double_compression_frequency(image_pil, context=None):
     """Analyze frequency domain for double compression artifacts"""
-    if image_pil.mode != 'RGB':
-        image_pil = image_pil.convert('RGB')
-    
-    image_array = np.array(image_pil)
-    gray_image = cv2.cvtColor(image_array, cv2.COLOR_RGB2GRAY)
+    gray_image = ensure_context(image_pil, context).gray
     
     # DCT analysis
     dct_coeffs = cv2.dct(gray_image.astype(np.float32))
@@ -593,12 +588,103 @@ def analyze_double_compression_frequency(image_pil):
         'histogram_complexity': zero_crossings
     }
 
+# ======================= Double Quantization Map =======================
+
+def block_dct_coefficients(gray, block_size=8):
+    """Orthonormal DCT-II (the JPEG FDCT scaling) of every aligned block, shape (rows, u, cols, v)"""
+    n = np.arange(block_size)
+    basis = np.sqrt(2.0 / block_size) * np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * block_size))
+    basis[0] /= np.sqrt(2.0)
+    rows, cols = gray.shape[0] // block_size, gray.shape[1] // block_size
+    blocks = gray[:rows * block_size, :cols * block_size].astype(np.float64) - 128
+    blocks = blocks.reshape(rows, block_size, cols, block_size)
+    return np.einsum('ui,aibj,vj->aubv', basis, blocks, basis, optimize=True)
+
+def requantization_support(primary_step, step, hist_range):
+    """Mask over indices [-hist_range, hist_range] reachable by quantizing with primary_step, then step"""
+    levels = np.arange(-(hist_range * step // primary_step + 2), hist_range * step // primary_step + 3)
+    index = np.rint(levels * primary_step / step).astype(np.int64)
+    support = np.zeros(2 * hist_range + 1, dtype=bool)
+    support[index[np.abs(index) <= hist_range] + hist_range] = True
+    return support
+
+def estimate_primary_step(hist, step, hist_range, max_step=DQ_MAX_PRIMARY_STEP):
+    """(primary step, support mask, gain) best explaining the gaps of an index histogram
+
+    gain is the share of counts on the reachable indices minus the share a smooth
+    (single-compression) histogram would put there; (None, None, 0) when no
+    primary step larger than the current one gives a positive gain.
+    """
+    smooth = ndimage.gaussian_filter1d(hist, 2)
+    best = (None, None, 0.0)
+    for primary_step in range(int(step) + 1, max_step + 1):
+        support = requantization_support(primary_step, step, hist_range)
+        gain = hist[support].sum() / hist.sum() - smooth[support].sum() / smooth.sum()
+        if gain > best[2]:
+            best = (primary_step, support, gain)
+    return best
+
+def double_quantization_map(image_pil, quantization_table=None, n_coefficients=DQ_COEFFICIENTS,
+                            hist_range=DQ_HIST_RANGE, context=None):
+    """Per-8x8-block probability that a block is NOT double quantized like the rest of the image
+
+    The rounded DCT values of each low-frequency AC coefficient are divided by the
+    file's current luminance quantization step. When the image was compressed before
+    with a coarser step, only some quantization indices are reachable and the
+    histogram shows periodic gaps; the primary step is the one whose reachable set
+    best explains them. Blocks on reachable indices agree with the double-compressed
+    majority, blocks in the gaps were compressed only once (a paste from another
+    source). Per-coefficient likelihoods are combined naive-Bayes style.
+
+    quantization_table is the 8x8 (or 64, natural order) luminance table of the file;
+    without it (PIL's .quantization is tried) the map is all zeros, since the step
+    cannot be told apart from a multiple of it by pixels alone. The image must be
+    the decoded file itself, on its own 8x8 grid. Returns a (rows, cols) float32 map,
+    also all zeros when no coefficient shows gaps (single compression, or a first
+    compression finer than the second).
+    """
+    gray = ensure_context(image_pil, context).gray
+    rows, cols = max(1, gray.shape[0] // 8), max(1, gray.shape[1] // 8)
+    if quantization_table is None:
+        quantization_table = (getattr(image_pil, 'quantization', None) or {}).get(0)
+    if quantization_table is None or gray.shape[0] < 8 or gray.shape[1] < 8:
+        return np.zeros((rows, cols), dtype=np.float32)
+    steps = np.asarray(quantization_table, dtype=np.float64).ravel()
+    coeffs = block_dct_coefficients(gray)
+    log_odds = np.zeros((rows, cols))
+    n_double = 0
+
+    for position in ZIGZAG_ORDER[1:n_coefficients + 1]:
+        u, v = divmod(int(position), 8)
+        index = np.rint(coeffs[:, u, :, v] / steps[position]).astype(np.int64)
+        inside = (np.abs(index) <= hist_range) & (index != 0)  # zero bin is reachable either way
+        hist = np.bincount(index[inside] + hist_range, minlength=2 * hist_range + 1).astype(np.float64)
+        if hist.sum() < DQ_MIN_SAMPLES:
+            continue
+        primary_step, support, gain = estimate_primary_step(hist, steps[position], hist_range)
+        if gain < DQ_MIN_GAIN:
+            continue
+        n_double += 1
+
+        # P(index | double compressed): histogram restricted to the reachable indices;
+        # P(index | single compressed): the smooth histogram a single quantization leaves
+        p_double = np.where(support, hist, 0) / hist[support].sum()
+        smooth = ndimage.gaussian_filter1d(hist, 2)
+        p_single = smooth / smooth.sum()
+        ratio = np.log(np.maximum(p_single, 1e-6) / np.maximum(p_double, 1e-4))
+        log_odds[inside] += ratio[index[inside] + hist_range]
+
+    if n_double == 0:
+        return np.zeros(log_odds.shape, dtype=np.float32)
+    return (1.0 / (1.0 + np.exp(-np.clip(log_odds, -30, 30)))).astype(np.float32)
+
 # ======================= Comprehensive JPEG Analysis =======================
 
-def comprehensive_jpeg_analysis(image_pil):
+def comprehensive_jpeg_analysis(image_pil, context=None):
     """Perform comprehensive JPEG analysis combining all methods"""
     print("🔍 Performing comprehensive JPEG analysis...")
     
+    context = ensure_context(image_pil, context)
     results = {}
     
     # 1. Basic JPEG analysis
@@ -607,18 +693,18 @@ def comprehensive_jpeg_analysis(image_pil):
     
     # 2. JPEG ghost analysis
     print("  - JPEG ghost detection...")
-    ghost_map, suspicious_map, ghost_analysis = jpeg_ghost_analysis(image_pil)
+    ghost_map, suspicious_map, ghost_analysis = jpeg_ghost_analysis(image_pil, context=context)
     results['ghost_map'] = ghost_map
     results['suspicious_map'] = suspicious_map
     results['ghost_analysis'] = ghost_analysis
     
     # 3. Block-wise analysis
     print("  - Block-wise artifact analysis...")
-    results['block_analysis'] = analyze_jpeg_blocks(image_pil)
+    results['block_analysis'] = analyze_jpeg_blocks(image_pil, context=context)
     
     # 4. Double compression detection
     print("  - Double compression detection...")
-    results['double_compression'] = detect_double_jpeg(image_pil)
+    results['double_compression'] = detect_double_jpeg(image_pil, context=context)
     
     # 5. Overall JPEG score calculation
     results['overall_score'] = calculate_overall_jpeg_score(results)
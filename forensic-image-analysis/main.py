@@ -39,21 +39,28 @@ import cv2           # PERBAIKAN: Tambah import cv2
 from PIL import Image
 
 # Import semua modul
-from validation import validate_image_file, extract_enhanced_metadata, advanced_preprocess_image
+from validation import validate_image_file, extract_enhanced_metadata, prepare_stage_inputs, ImageLoader
 from ela_analysis import perform_multi_quality_ela
 from feature_detection import extract_multi_detector_features
-from copy_move_detection import detect_copy_move_advanced, detect_copy_move_blocks, kmeans_tampering_localization
-from advanced_analysis import (analyze_noise_consistency, analyze_frequency_domain, 
+from copy_move_detection import (detect_copy_move_advanced, detect_copy_move_blocks, kmeans_tampering_localization,
+                                 detect_copy_move_two_pass, detect_copy_move_patchmatch)
+from advanced_analysis import (analyze_noise_consistency, estimate_noise_level_map, analyze_frequency_domain, 
                               analyze_texture_consistency, analyze_edge_consistency,
                               analyze_illumination_consistency, perform_statistical_analysis)
 from jpeg_analysis import advanced_jpeg_analysis, jpeg_ghost_analysis
 from classification import classify_manipulation_advanced, prepare_feature_vector
 from visualization import visualize_results_advanced, export_kmeans_visualization
 from export_utils import export_complete_package
+from fusion import fuse_localization_evidence
+from config import COPY_MOVE_TWO_PASS, PATCHMATCH_ENABLED, PREPROCESS_PROFILE
 
 
-def analyze_image_comprehensive_advanced(image_path, output_dir="./results"):
-    """Advanced comprehensive image analysis pipeline"""
+def analyze_image_comprehensive_advanced(image_path, output_dir="./results", kmeans_state=None):
+    """Advanced comprehensive image analysis pipeline
+    
+    Pass the same kmeans_state (copy_move_detection.create_kmeans_state) for every image
+    of a batch to warm-start the localization clustering.
+    """
     print(f"\n{'='*80}")
     print(f"ADVANCED FORENSIC IMAGE ANALYSIS SYSTEM v2.0")
     print(f"Enhanced Detection: Copy-Move, Splicing, Authentic Images")
@@ -67,17 +74,21 @@ def analyze_image_comprehensive_advanced(image_path, output_dir="./results"):
     
     # 1. Validation
     try:
-        validate_image_file(image_path)
+        plan = validate_image_file(image_path)
         print("✅ [1/17] File validation passed")
+        print(f"  {plan['format']} {plan['width']} × {plan['height']}, plan: {plan['decision']}, "
+              f"est. memory {plan['estimated_bytes'] / 1024**2:.0f} MB")
     except Exception as e:
         print(f"❌ Validation error: {e}")
         return None
     
     # 2. Load image
     try:
-        original_image = Image.open(image_path)
+        # Decode JPEG langsung pada skala DCT tereduksi; full resolution hanya bila diminta tahap
+        loader = ImageLoader(image_path, full_resolution_stages=plan['full_resolution_stages'])
+        original_image = loader.working_image()
         print(f"✅ [2/17] Image loaded: {os.path.basename(image_path)}")
-        print(f"  Size: {original_image.size}, Mode: {original_image.mode}")
+        print(f"  Size: {loader.size}, Mode: {loader.mode}")
     except Exception as e:
         print(f"❌ Error loading image: {e}")
         return None
@@ -89,18 +100,24 @@ def analyze_image_comprehensive_advanced(image_path, output_dir="./results"):
     
     # 4. Advanced preprocessing
     print("🔧 [4/17] Advanced preprocessing...")
-    preprocessed, original_preprocessed = advanced_preprocess_image(original_image.copy())
+    # Resize sekali; denoising (PREPROCESS_PROFILE) hanya dijalankan bila ada tahap yang memintanya.
+    # Konversi (gray, LAB, CLAHE, ...) dan integral images dihitung sekali (lazy) per ImageContext
+    inputs = prepare_stage_inputs(original_image)
+    preprocessed = inputs.raw.image
+    print(f"  Preprocessing profile: {PREPROCESS_PROFILE}")
     
     # 5. Multi-quality ELA
     print("📊 [5/17] Multi-quality Error Level Analysis...")
-    ela_image, ela_mean, ela_std, ela_regional, ela_quality_stats, ela_variance = perform_multi_quality_ela(preprocessed.copy())
+    ela_image, ela_mean, ela_std, ela_regional, ela_quality_stats, ela_variance = perform_multi_quality_ela(
+        inputs['ela'].image, context=inputs['ela'])
     print(f"  ELA Stats: μ={ela_mean:.2f}, σ={ela_std:.2f}, Regions={ela_regional['outlier_regions']}")
     
     # 6. Multi-detector feature extraction
     print("🎯 [6/17] Multi-detector feature extraction...")
     feature_sets, roi_mask, gray_enhanced = extract_multi_detector_features(
-        preprocessed.copy(), ela_image, ela_mean, ela_std)
-    total_features = sum(len(kp) for kp, _ in feature_sets.values())
+        inputs['features'].image, ela_image, ela_mean, ela_std,
+        context=inputs['features'], full_res_context=loader.context_for_stage('features'))
+    total_features = sum(len(fs) for fs in feature_sets.values())
     print(f"  Total keypoints: {total_features}")
     
     # 7. Advanced copy-move detection
@@ -109,24 +126,41 @@ def analyze_image_comprehensive_advanced(image_path, output_dir="./results"):
         feature_sets, preprocessed.size)
     print(f"  RANSAC inliers: {ransac_inliers}")
     
+    # Coarse-to-fine search without the ELA ROI restriction
+    two_pass_result = None
+    if COPY_MOVE_TWO_PASS:
+        two_pass_result = detect_copy_move_two_pass(inputs['copy_move_two_pass'].image,
+                                                    context=inputs['copy_move_two_pass'],
+                                                    full_res_context=loader.context_for_stage('copy_move_two_pass'))
+        if two_pass_result['inliers'] > ransac_inliers:
+            ransac_inliers = two_pass_result['inliers']
+            transform = two_pass_result['transform']
+        print(f"  Two-pass clone area: {two_pass_result['clone_percentage']:.1f}%")
+    
     # 8. Enhanced block matching
     print("🧩 [8/17] Enhanced block-based detection...")
-    block_matches = detect_copy_move_blocks(preprocessed)
+    block_matches = detect_copy_move_blocks(inputs['copy_move_blocks'].image, context=inputs['copy_move_blocks'])
     print(f"  Block matches: {len(block_matches)}")
     
+    # Dense field catches clones in low-texture areas the keypoints miss
+    patchmatch_result = None
+    if PATCHMATCH_ENABLED:
+        patchmatch_result = detect_copy_move_patchmatch(inputs['patchmatch'].image, context=inputs['patchmatch'])
+    
     # 9. Advanced noise analysis
     print("📡 [9/17] Advanced noise consistency analysis...")
-    noise_analysis = analyze_noise_consistency(preprocessed)
+    noise_analysis = analyze_noise_consistency(inputs['noise'].image, context=inputs['noise'])
+    noise_map = estimate_noise_level_map(inputs['noise_map'].image, context=inputs['noise_map'])
     print(f"  Noise inconsistency: {noise_analysis['overall_inconsistency']:.3f}")
     
     # 10. Advanced JPEG analysis
     print("📷 [10/17] Advanced JPEG artifact analysis...")
     try:
-        from jpeg_analysis import advanced_jpeg_analysis, jpeg_ghost_analysis
-        jpeg_analysis = advanced_jpeg_analysis(preprocessed)
+        from jpeg_analysis import advanced_jpeg_analysis, jpeg_ghost_analysis, double_quantization_map
+        jpeg_analysis = advanced_jpeg_analysis(inputs['jpeg'].image)
         
         # Robust handling untuk return values dari jpeg_ghost_analysis
-        jpeg_ghost_result = jpeg_ghost_analysis(preprocessed)
+        jpeg_ghost_result = jpeg_ghost_analysis(inputs['jpeg'].image, context=inputs['jpeg'])
         
         if len(jpeg_ghost_result) == 2:
             ghost_map, ghost_suspicious = jpeg_ghost_result
@@ -139,6 +173,21 @@ def analyze_image_comprehensive_advanced(image_path, output_dir="./results"):
         ghost_ratio = np.sum(ghost_suspicious) / ghost_suspicious.size
         print(f"  JPEG anomalies: {ghost_ratio:.1%}")
         
+        # Double quantization needs the file's own 8x8 grid and quantization table; a
+        # reduced decode is off that grid, so use the full-resolution one (fusion
+        # resamples the block map onto its own grid)
+        if inputs['jpeg'].size == loader.size:
+            dq_context = inputs['jpeg']
+        else:
+            dq_context = loader.context_for_stage('jpeg')
+        if dq_context is not None:
+            dq_map = double_quantization_map(dq_context.image, quantization_table=loader.quantization.get(0),
+                                             context=dq_context)
+            print(f"  Single-compressed blocks (DQ): {np.mean(dq_map > 0.5):.1%}")
+        else:
+            dq_map = None
+            print("  ⚠ DQ map skipped: reduced decode is off the 8x8 grid and 'jpeg' is not in FULL_RESOLUTION_STAGES")
+        
     except Exception as e:
         print(f"  ⚠ JPEG analysis failed: {e}")
         # Fallback values
@@ -153,31 +202,34 @@ def analyze_image_comprehensive_advanced(image_path, output_dir="./results"):
         ghost_suspicious = np.zeros((preprocessed.size[1], preprocessed.size[0]), dtype=bool)
         ghost_analysis_details = {}
         ghost_ratio = 0.0
+        dq_map = None
 
     
     # 11. Frequency domain analysis
     print("🌊 [11/17] Frequency domain analysis...")
-    frequency_analysis = analyze_frequency_domain(preprocessed)
+    frequency_analysis = analyze_frequency_domain(inputs['frequency'].image, context=inputs['frequency'])
     print(f"  Frequency inconsistency: {frequency_analysis['frequency_inconsistency']:.3f}")
     
     # 12. Texture consistency analysis
     print("🧵 [12/17] Texture consistency analysis...")
-    texture_analysis = analyze_texture_consistency(preprocessed)
+    texture_analysis = analyze_texture_consistency(inputs['texture'].image, context=inputs['texture'])
     print(f"  Texture inconsistency: {texture_analysis['overall_inconsistency']:.3f}")
     
     # 13. Edge consistency analysis
     print("📐 [13/17] Edge density analysis...")
-    edge_analysis = analyze_edge_consistency(preprocessed)
+    edge_analysis = analyze_edge_consistency(inputs['edge'].image, context=inputs['edge'])
     print(f"  Edge inconsistency: {edge_analysis['edge_inconsistency']:.3f}")
     
     # 14. Illumination analysis
     print("💡 [14/17] Illumination consistency analysis...")
-    illumination_analysis = analyze_illumination_consistency(preprocessed)
+    illumination_analysis = analyze_illumination_consistency(inputs['illumination'].image,
+                                                             context=inputs['illumination'])
     print(f"  Illumination inconsistency: {illumination_analysis['overall_illumination_inconsistency']:.3f}")
+    inputs.release('lab', 'laplacian', 'gray_float32', 'edge', 'illumination_gradient', 'ela_variance')
     
     # 15. Statistical analysis
     print("📈 [15/17] Statistical analysis...")
-    statistical_analysis = perform_statistical_analysis(preprocessed)
+    statistical_analysis = perform_statistical_analysis(inputs['statistics'].image, context=inputs['statistics'])
     print(f"  Overall entropy: {statistical_analysis['overall_entropy']:.3f}")
     
     # Prepare comprehensive results
@@ -190,18 +242,21 @@ def analyze_image_comprehensive_advanced(image_path, output_dir="./results"):
         'ela_quality_stats': ela_quality_stats,
         'ela_variance': ela_variance,
         'feature_sets': feature_sets,
-        'sift_keypoints': feature_sets['sift'][0],
-        'sift_descriptors': feature_sets['sift'][1],
+        'sift_keypoints': feature_sets['sift'],
+        'sift_descriptors': feature_sets['sift'].descriptors,
         'sift_matches': len(ransac_matches),
         'ransac_matches': ransac_matches,
         'ransac_inliers': ransac_inliers,
         'geometric_transform': transform,
+        'two_pass_copy_move': two_pass_result,
         'block_matches': block_matches,
+        'patchmatch_copy_move': patchmatch_result,
         'noise_analysis': noise_analysis,
-        'noise_map': cv2.cvtColor(np.array(preprocessed), cv2.COLOR_RGB2GRAY),
+        'noise_map': noise_map,
         'jpeg_analysis': jpeg_analysis,
         'jpeg_ghost': ghost_map,
         'jpeg_ghost_suspicious_ratio': ghost_ratio,
+        'dq_map': dq_map,
         'frequency_analysis': frequency_analysis,
         'texture_analysis': texture_analysis,
         'edge_analysis': edge_analysis,
@@ -214,7 +269,9 @@ def analyze_image_comprehensive_advanced(image_path, output_dir="./results"):
     
     # 16. Advanced tampering localization
     print("🎯 [16/17] Advanced tampering localization...")
-    localization_results = advanced_tampering_localization(preprocessed, analysis_results)
+    localization_results = advanced_tampering_localization(inputs['localization'].image, analysis_results,
+                                                           kmeans_state, inputs['localization'])
+    inputs.release()
     print(f"  Tampering area: {localization_results['tampering_percentage']:.1f}% of image")
     
     # 17. Advanced classification
@@ -243,37 +300,32 @@ def analyze_image_comprehensive_advanced(image_path, output_dir="./results"):
     
     return analysis_results
 
-def advanced_tampering_localization(image_pil, analysis_results):
+def advanced_tampering_localization(image_pil, analysis_results, kmeans_state=None, context=None):
     """Advanced tampering localization menggunakan multiple methods"""
     print("🎯 Advanced tampering localization...")
     
     ela_image = analysis_results['ela_image']
     
     # 1. K-means based localization
-    kmeans_result = kmeans_tampering_localization(image_pil, ela_image)
+    kmeans_result = kmeans_tampering_localization(image_pil, ela_image, kmeans_state=kmeans_state,
+                                                  context=context)
     
     # 2. Threshold-based localization
     ela_array = np.array(ela_image)
     threshold = analysis_results['ela_mean'] + 2 * analysis_results['ela_std']
     threshold_mask = ela_array > threshold
     
-    # 3. Combined localization
-    combined_mask = np.logical_or(
-        kmeans_result['tampering_mask'],
-        threshold_mask
-    )
-    
-    # Morphological operations untuk clean up
-    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
-    combined_mask = cv2.morphologyEx(combined_mask.astype(np.uint8), cv2.MORPH_CLOSE, kernel)
-    combined_mask = cv2.morphologyEx(combined_mask, cv2.MORPH_OPEN, kernel)
-    
+    # 3. Fused localization: all evidence maps combined on a coarse grid
     h, w = ela_array.shape
+    fusion_result = fuse_localization_evidence(analysis_results, (h, w), kmeans_result)
+    combined_mask = fusion_result['tampering_mask']
+    print(f"  - Fused evidence: {', '.join(fusion_result['sources'])}")
     
     return {
         'kmeans_localization': kmeans_result,
         'threshold_mask': threshold_mask,
-        'combined_tampering_mask': combined_mask.astype(bool),
+        'fusion': fusion_result,
+        'combined_tampering_mask': combined_mask,
         'tampering_percentage': np.sum(combined_mask) / (h * w) * 100
     }
 
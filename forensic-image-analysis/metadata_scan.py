@@ -0,0 +1,213 @@
+"""
+Metadata Scan Module for Forensic Image Analysis System
+Header-only JPEG segment reader (EXIF, XMP, Photoshop/IPTC, DQT, thumbnail) and bulk directory scanning
+"""
+
+import os
+import io
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import exifread
+from config import VALID_EXTENSIONS, METADATA_SCAN_WORKERS
+
+# ======================= JPEG Segment Scan =======================
+
+EXIF_HEADER = b'Exif\x00\x00'
+XMP_HEADER = b'http://ns.adobe.com/xap/1.0/\x00'
+PHOTOSHOP_HEADER = b'Photoshop 3.0\x00'
+
+# Position in natural (row-major) order of each zig-zag coefficient
+ZIGZAG_ORDER = np.array([
+    0, 1, 8, 16, 9, 2, 3, 10, 17, 24, 32, 25, 18, 11, 4, 5,
+    12, 19, 26, 33, 40, 48, 41, 34, 27, 20, 13, 6, 7, 14, 21, 28,
+    35, 42, 49, 56, 57, 50, 43, 36, 29, 22, 15, 23, 30, 37, 44, 51,
+    58, 59, 52, 45, 38, 31, 39, 46, 53, 60, 61, 54, 47, 55, 62, 63
+])
+
+# SOFn markers (C4 = DHT, C8 = JPG, CC = DAC are not frame headers)
+SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+def parse_dqt(payload):
+    """{table_id: (8, 8) uint16 quantization table in natural order} from one DQT segment"""
+    tables = {}
+    pos = 0
+    while pos < len(payload):
+        precision, table_id = payload[pos] >> 4, payload[pos] & 0x0F
+        pos += 1
+        if precision:
+            values = np.frombuffer(payload[pos:pos + 128], dtype='>u2')
+            pos += 128
+        else:
+            values = np.frombuffer(payload[pos:pos + 64], dtype=np.uint8)
+            pos += 64
+        if len(values) < 64:
+            break
+        table = np.zeros(64, dtype=np.uint16)
+        table[ZIGZAG_ORDER] = values
+        tables[table_id] = table.reshape(8, 8)
+    return tables
+
+def parse_photoshop_resources(payload):
+    """{resource_id: bytes} from a Photoshop 3.0 APP13 block (0x0404 = IPTC-NAA record)"""
+    resources = {}
+    pos = 0
+    while pos + 12 <= len(payload) and payload[pos:pos + 4] == b'8BIM':
+        resource_id = struct.unpack('>H', payload[pos + 4:pos + 6])[0]
+        name_len = payload[pos + 6]
+        pos += 7 + name_len + ((name_len + 1) % 2)  # Pascal name padded to even length
+        size = struct.unpack('>I', payload[pos:pos + 4])[0]
+        pos += 4
+        resources[resource_id] = payload[pos:pos + size]
+        pos += size + (size % 2)
+    return resources
+
+def scan_jpeg_segments(stream):
+    """Walk JPEG markers from SOI up to SOS (no entropy-coded data is read)
+
+    Returns {'exif': TIFF bytes, 'xmp': str, 'photoshop': {id: bytes}, 'dqt': {id: table},
+    'frame': {'width', 'height', 'components', 'precision', 'marker'}, 'comments': [...]}
+    or None if the stream is not a JPEG.
+    """
+    if stream.read(2) != b'\xff\xd8':
+        return None
+    segments = {'exif': None, 'xmp': None, 'photoshop': {}, 'dqt': {}, 'frame': None, 'comments': []}
+
+    while True:
+        byte = stream.read(1)
+        if not byte:
+            break
+        if byte != b'\xff':
+            continue  # tolerate garbage between segments
+        marker = stream.read(1)
+        while marker == b'\xff':  # fill bytes
+            marker = stream.read(1)
+        if not marker:
+            break
+        marker = marker[0]
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            continue  # standalone markers have no length
+        if marker in (0xDA, 0xD9):
+            break  # SOS / EOI: header ends here
+
+        length_bytes = stream.read(2)
+        if len(length_bytes) < 2:
+            break
+        length = struct.unpack('>H', length_bytes)[0]
+        if length < 2:
+            break  # corrupt length (it counts its own two bytes); read(-1) would pull in the whole file
+        payload = stream.read(length - 2)
+
+        if marker == 0xE1 and payload.startswith(EXIF_HEADER) and segments['exif'] is None:
+            segments['exif'] = payload[len(EXIF_HEADER):]
+        elif marker == 0xE1 and payload.startswith(XMP_HEADER) and segments['xmp'] is None:
+            segments['xmp'] = payload[len(XMP_HEADER):].decode('utf-8', errors='replace')
+        elif marker == 0xED and payload.startswith(PHOTOSHOP_HEADER):
+            segments['photoshop'].update(parse_photoshop_resources(payload[len(PHOTOSHOP_HEADER):]))
+        elif marker == 0xDB:
+            segments['dqt'].update(parse_dqt(payload))
+        elif marker in SOF_MARKERS and len(payload) >= 6:
+            precision, height, width, components = struct.unpack('>BHHB', payload[:6])
+            segments['frame'] = {'width': width, 'height': height, 'components': components,
+                                 'precision': precision, 'marker': marker}
+        elif marker == 0xFE:
+            segments['comments'].append(payload.decode('latin-1'))
+
+    return segments
+
+def exif_thumbnail(tiff_bytes, tags):
+    """Embedded IFD1 JPEG thumbnail bytes (offsets are relative to the TIFF header)"""
+    if 'Thumbnail JPEGInterchangeFormat' not in tags:
+        return None
+    try:
+        offset = int(tags['Thumbnail JPEGInterchangeFormat'].values[0])
+        length = int(tags['Thumbnail JPEGInterchangeFormatLength'].values[0])
+    except (KeyError, IndexError, ValueError):
+        return None
+    thumbnail = tiff_bytes[offset:offset + length]
+    return thumbnail if thumbnail.startswith(b'\xff\xd8') else None
+
+# ======================= Header Metadata Record =======================
+
+def read_header_metadata(filepath):
+    """One metadata record per file from its header segments and a single stat() call
+
+    JPEGs are scanned marker by marker up to SOS; exifread then parses only the
+    APP1 TIFF payload (details=False: no MakerNote decoding). Other formats fall
+    back to exifread over the file with details=False.
+    """
+    stat = os.stat(filepath)
+    record = {
+        'path': filepath,
+        'filename': os.path.basename(filepath),
+        'file_size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'format': None,
+        'dimensions': None,
+        'tags': {},
+        'xmp': None,
+        'photoshop': {},
+        'dqt': {},
+        'thumbnail': None,
+        'comments': []
+    }
+
+    with open(filepath, 'rb') as f:
+        segments = scan_jpeg_segments(f)
+        if segments is not None:
+            record['format'] = 'JPEG'
+            exif = segments['exif']
+            if exif:
+                record['tags'] = exifread.process_file(io.BytesIO(exif), details=False, strict=False)
+                # exifread already slices IFD1 for bare TIFF input; otherwise cut it ourselves
+                record['thumbnail'] = record['tags'].pop('JPEGThumbnail', None) or exif_thumbnail(exif, record['tags'])
+            if segments['frame']:
+                record['dimensions'] = (segments['frame']['width'], segments['frame']['height'])
+            for key in ('xmp', 'photoshop', 'dqt', 'comments'):
+                record[key] = segments[key]
+        else:
+            f.seek(0)
+            record['tags'] = exifread.process_file(f, details=False, strict=False)
+
+    return record
+
+# ======================= Bulk Directory Scan =======================
+
+def iter_image_files(directory, extensions=VALID_EXTENSIONS, recursive=True):
+    """Image paths under directory, by extension, without loading anything"""
+    if recursive:
+        for root, _, files in os.walk(directory):
+            for name in sorted(files):
+                if os.path.splitext(name)[1].lower() in extensions:
+                    yield os.path.join(root, name)
+    else:
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if os.path.splitext(name)[1].lower() in extensions and os.path.isfile(path):
+                yield path
+
+def scan_metadata_directory(directory, reader=read_header_metadata, max_workers=METADATA_SCAN_WORKERS,
+                            extensions=VALID_EXTENSIONS, recursive=True):
+    """Stream (path, record) pairs for every image in directory, read on a thread pool
+
+    At most max_workers * 4 files are in flight, so memory stays flat for any case
+    size. Results come out in directory order. A file whose reader raises yields
+    (path, {'error': message}) so the scan never stops.
+    """
+    def safe_read(path):
+        try:
+            return reader(path)
+        except Exception as e:
+            return {'error': str(e)}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for path in iter_image_files(directory, extensions, recursive):
+            pending.append((path, executor.submit(safe_read, path)))
+            if len(pending) >= max_workers * 4:
+                path_done, future = pending.popleft()
+                yield path_done, future.result()
+        while pending:
+            path_done, future = pending.popleft()
+            yield path_done, future.result()
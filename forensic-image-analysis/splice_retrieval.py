@@ -0,0 +1,391 @@
+"""
+Splice Source Retrieval Module for Forensic Image Analysis System
+Contains a persistent corpus index of local descriptors for finding the donor image of a spliced region
+"""
+
+import os
+import json
+import time
+import numpy as np
+import cv2
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.decomposition import PCA
+from feature_detection import extract_multi_detector_features
+from config import *
+import warnings
+
+warnings.filterwarnings('ignore')
+
+# ======================= Descriptor Extraction =======================
+
+def load_index_image(image_source, max_dim=INDEX_IMAGE_MAX_DIM):
+    """Open an image (path or PIL) as RGB, downscaled to max_dim for indexing"""
+    image = Image.open(image_source) if isinstance(image_source, str) else image_source
+    image = image.convert('RGB')
+    if max(image.size) > max_dim:
+        image = image.copy()
+        image.thumbnail((max_dim, max_dim), Image.Resampling.LANCZOS)
+    return image
+
+def extract_index_descriptors(image_source):
+    """Whole-image SIFT/ORB descriptors, coordinates normalised by the longest image side"""
+    image = load_index_image(image_source)
+    w, h = image.size
+    feature_sets, _, _ = extract_multi_detector_features(image, None, 0, 0, detectors=('sift', 'orb'))
+
+    result = {}
+    for name, limit in (('sift', INDEX_MAX_SIFT_PER_IMAGE), ('orb', INDEX_MAX_ORB_PER_IMAGE)):
+        fs = feature_sets[name]
+        if fs.descriptors is None or len(fs) == 0:
+            result[name] = (np.zeros((0, 128 if name == 'sift' else 32), dtype=np.float32),
+                            np.zeros((0, 2), dtype=np.float16))
+            continue
+        # Strongest keypoints first, capped per image
+        keep = np.argsort(-fs.response, kind='stable')[:limit]
+        xy = (fs.xy[keep] / np.float32(max(w, h))).astype(np.float16)
+        result[name] = (fs.descriptors[keep], xy)
+    return result
+
+# ======================= Product Quantization =======================
+
+def pq_encode(vectors, codebooks):
+    """Encode (N, D) vectors to (N, M) uint8 codes with M sub-codebooks of shape (256, D/M)"""
+    n_sub, _, sub_dim = codebooks.shape
+    codes = np.empty((len(vectors), n_sub), dtype=np.uint8)
+    for m in range(n_sub):
+        sub = vectors[:, m * sub_dim:(m + 1) * sub_dim]
+        d2 = (np.sum(sub ** 2, axis=1, keepdims=True) - 2 * sub @ codebooks[m].T +
+              np.sum(codebooks[m] ** 2, axis=1)[None, :])
+        codes[:, m] = np.argmin(d2, axis=1)
+    return codes
+
+def pq_distance_tables(queries, codebooks):
+    """Asymmetric distance lookup tables, (Q, M, 256) float32"""
+    n_sub, n_codes, sub_dim = codebooks.shape
+    tables = np.empty((len(queries), n_sub, n_codes), dtype=np.float32)
+    for m in range(n_sub):
+        sub = queries[:, m * sub_dim:(m + 1) * sub_dim]
+        tables[:, m, :] = (np.sum(sub ** 2, axis=1, keepdims=True) - 2 * sub @ codebooks[m].T +
+                           np.sum(codebooks[m] ** 2, axis=1)[None, :])
+    return tables
+
+def nearest_centroids(vectors, centroids, n=1):
+    """Indices of the n nearest centroids for each vector"""
+    d2 = (np.sum(vectors ** 2, axis=1, keepdims=True) - 2 * vectors @ centroids.T +
+          np.sum(centroids ** 2, axis=1)[None, :])
+    if n == 1:
+        return np.argmin(d2, axis=1)
+    n = min(n, centroids.shape[0])
+    return np.argpartition(d2, n - 1, axis=1)[:, :n]
+
+# ======================= Index Building =======================
+
+def build_splice_index(image_paths, index_dir, max_workers=TILE_WORKERS):
+    """Build a memory-mapped donor index over a collection of images
+
+    SIFT descriptors are PCA-compressed to INDEX_PCA_DIMS and stored twice: as float16
+    vectors for re-ranking and as product-quantization codes grouped into inverted
+    lists (IVF) for search. ORB descriptors are kept as packed 32-byte binary codes
+    grouped per image, for Hamming re-ranking of shortlisted donors. Raw 128-d
+    descriptors and the float16 vectors are staged on disk and written to the index
+    in list order chunk by chunk; only the PQ codes, list ids, image ids and
+    positions (~20 bytes per descriptor) are held in memory.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    image_paths = [os.path.abspath(p) for p in image_paths]
+    print(f"📚 Building splice-source index for {len(image_paths)} images...")
+
+    # 1. Extract and stage descriptors
+    staging_sift = os.path.join(index_dir, 'staging_sift.f16')
+    sift_image_ids, sift_xy, orb_codes, orb_xy, orb_counts = [], [], [], [], []
+
+    def extract(path):
+        try:
+            return extract_index_descriptors(path)
+        except Exception as e:
+            print(f"  ⚠ Skipping {path}: {e}")
+            return None
+
+    with open(staging_sift, 'wb') as staging, \
+         ThreadPoolExecutor(max_workers=max_workers or os.cpu_count() or 1) as pool:
+        for image_id, descriptors in enumerate(pool.map(extract, image_paths)):
+            if descriptors is None:
+                orb_counts.append(0)
+                continue
+            sift_desc, xy = descriptors['sift']
+            staging.write(sift_desc.astype(np.float16).tobytes())
+            sift_image_ids.append(np.full(len(sift_desc), image_id, dtype=np.int32))
+            sift_xy.append(xy)
+            orb_desc, oxy = descriptors['orb']
+            orb_codes.append(orb_desc.astype(np.uint8))
+            orb_xy.append(oxy)
+            orb_counts.append(len(orb_desc))
+
+    sift_image_ids = np.concatenate(sift_image_ids) if sift_image_ids else np.zeros(0, np.int32)
+    n_total = len(sift_image_ids)
+    if n_total < 256:
+        raise ValueError(f"Too few SIFT descriptors to build an index: {n_total}")
+    raw = np.memmap(staging_sift, dtype=np.float16, mode='r', shape=(n_total, 128))
+    print(f"  - Staged {n_total} SIFT descriptors")
+
+    # 2. Train PCA, IVF coarse quantizer and PQ codebooks on a sample
+    rng = np.random.default_rng(42)
+    sample_idx = np.sort(rng.choice(n_total, min(n_total, INDEX_TRAIN_SAMPLES), replace=False))
+    sample = raw[sample_idx].astype(np.float32)
+
+    pca = PCA(n_components=INDEX_PCA_DIMS, random_state=42).fit(sample)
+    sample_pca = pca.transform(sample).astype(np.float32)
+
+    n_lists = int(min(INDEX_N_LISTS, max(1, len(sample) // 39)))
+    coarse = MiniBatchKMeans(n_clusters=n_lists, random_state=42, batch_size=4096, n_init=3).fit(sample_pca)
+
+    sub_dim = INDEX_PCA_DIMS // INDEX_PQ_SUBSPACES
+    codebooks = np.zeros((INDEX_PQ_SUBSPACES, 256, sub_dim), dtype=np.float32)
+    for m in range(INDEX_PQ_SUBSPACES):
+        sub = sample_pca[:, m * sub_dim:(m + 1) * sub_dim]
+        km = MiniBatchKMeans(n_clusters=min(256, len(sub)), random_state=42, batch_size=4096, n_init=3).fit(sub)
+        codebooks[m, :len(km.cluster_centers_)] = km.cluster_centers_
+
+    # 3. Encode everything in chunks, staging the float16 vectors on disk
+    staging_pca = os.path.join(index_dir, 'staging_pca.f16')
+    vectors = np.memmap(staging_pca, dtype=np.float16, mode='w+', shape=(n_total, INDEX_PCA_DIMS))
+    codes = np.empty((n_total, INDEX_PQ_SUBSPACES), dtype=np.uint8)
+    list_ids = np.empty(n_total, dtype=np.int32)
+    chunk = 65536
+    for start in range(0, n_total, chunk):
+        projected = pca.transform(raw[start:start + chunk].astype(np.float32)).astype(np.float32)
+        vectors[start:start + chunk] = projected
+        codes[start:start + chunk] = pq_encode(projected, codebooks)
+        list_ids[start:start + chunk] = nearest_centroids(projected, coarse.cluster_centers_)
+    del raw
+    os.remove(staging_sift)
+
+    # 4. Write inverted lists (entries sorted by list id, CSR offsets)
+    order = np.argsort(list_ids, kind='stable')
+    offsets = np.zeros(n_lists + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(list_ids, minlength=n_lists))
+
+    _save_array(index_dir, 'ivf_offsets', offsets)
+    _save_array(index_dir, 'ivf_codes', codes[order])
+    _save_rows_in_order(index_dir, 'ivf_vectors', vectors, order, chunk)
+    del vectors
+    os.remove(staging_pca)
+    _save_array(index_dir, 'ivf_image_ids', sift_image_ids[order])
+    _save_array(index_dir, 'ivf_xy', np.concatenate(sift_xy)[order])
+
+    orb_offsets = np.zeros(len(image_paths) + 1, dtype=np.int64)
+    orb_offsets[1:] = np.cumsum(orb_counts)
+    _save_array(index_dir, 'orb_offsets', orb_offsets)
+    _save_array(index_dir, 'orb_codes', np.concatenate(orb_codes) if orb_codes else np.zeros((0, 32), np.uint8))
+    _save_array(index_dir, 'orb_xy', np.concatenate(orb_xy) if orb_xy else np.zeros((0, 2), np.float16))
+
+    np.savez(os.path.join(index_dir, 'model.npz'),
+             pca_mean=pca.mean_.astype(np.float32),
+             pca_components=pca.components_.astype(np.float32),
+             coarse_centroids=coarse.cluster_centers_.astype(np.float32),
+             pq_codebooks=codebooks)
+    with open(os.path.join(index_dir, 'images.json'), 'w') as f:
+        json.dump({'images': image_paths, 'n_descriptors': int(n_total), 'n_lists': n_lists}, f)
+
+    print(f"  - Index written: {n_total} descriptors in {n_lists} lists → {index_dir}")
+    return SpliceSourceIndex(index_dir)
+
+def _save_array(index_dir, name, array):
+    """Write an array as .npy so it can be memory-mapped on load"""
+    np.save(os.path.join(index_dir, f'{name}.npy'), np.ascontiguousarray(array))
+
+def _save_rows_in_order(index_dir, name, source, order, chunk):
+    """Write source[order] as .npy chunk by chunk, without a sorted copy in memory"""
+    out = np.lib.format.open_memmap(os.path.join(index_dir, f'{name}.npy'), mode='w+',
+                                    dtype=source.dtype, shape=(len(order),) + source.shape[1:])
+    for start in range(0, len(order), chunk):
+        out[start:start + chunk] = source[order[start:start + chunk]]
+    out.flush()
+    del out
+
+# ======================= Index Query =======================
+
+class SpliceSourceIndex:
+    """Memory-mapped donor index built by build_splice_index
+
+    Query cost grows with the length of the probed inverted lists, i.e. with corpus
+    size. Measured on one core with 300 images (120k SIFT descriptors): ~0.33 s median,
+    ~0.7 s p95 per query, mostly descriptor extraction. Larger corpora have not been
+    timed; use benchmark_splice_index on the target collection before relying on it.
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, 'images.json')) as f:
+            self.images = json.load(f)['images']
+
+        model = np.load(os.path.join(index_dir, 'model.npz'))
+        self.pca_mean = model['pca_mean']
+        self.pca_components = model['pca_components']
+        self.coarse_centroids = model['coarse_centroids']
+        self.pq_codebooks = model['pq_codebooks']
+
+        load = lambda name: np.load(os.path.join(index_dir, f'{name}.npy'), mmap_mode='r')
+        self.ivf_offsets = np.array(load('ivf_offsets'))
+        self.ivf_codes = load('ivf_codes')
+        self.ivf_vectors = load('ivf_vectors')
+        self.ivf_image_ids = load('ivf_image_ids')
+        self.ivf_xy = load('ivf_xy')
+        self.orb_offsets = np.array(load('orb_offsets'))
+        self.orb_codes = load('orb_codes')
+        self.orb_xy = load('orb_xy')
+
+    def __len__(self):
+        return len(self.images)
+
+    def query(self, image, top_k=5, nprobe=INDEX_NPROBE, neighbors=4, exclude_path=None):
+        """Candidate donor images for a query image (path or PIL)
+
+        Each query SIFT descriptor scans nprobe inverted lists with PQ asymmetric
+        distances; its nearest entries vote for their images (one vote per image per
+        descriptor). Shortlisted donors are re-ranked with exact float16 PCA distances
+        and packed-ORB Hamming matches, and matched regions are estimated from the
+        RANSAC-consistent correspondences.
+        """
+        query = extract_index_descriptors(image)
+        sift_desc, query_xy = query['sift']
+        if len(sift_desc) == 0:
+            return []
+
+        projected = ((sift_desc.astype(np.float32) - self.pca_mean) @ self.pca_components.T).astype(np.float32)
+        tables = pq_distance_tables(projected, self.pq_codebooks)
+        probes = nearest_centroids(projected, self.coarse_centroids, n=nprobe).reshape(len(projected), -1)
+
+        # Group queries by probed list so each list is read from the memmap once
+        q_all, e_all, d_all = [], [], []
+        probe_query = np.repeat(np.arange(len(projected)), probes.shape[1])
+        probe_list = probes.ravel()
+        order = np.argsort(probe_list, kind='stable')
+        probe_query, probe_list = probe_query[order], probe_list[order]
+        bounds = np.flatnonzero(np.diff(probe_list)) + 1
+        for queries, lists in zip(np.split(probe_query, bounds), np.split(probe_list, bounds)):
+            start, stop = self.ivf_offsets[lists[0]], self.ivf_offsets[lists[0] + 1]
+            if stop == start:
+                continue
+            codes = np.asarray(self.ivf_codes[start:stop])
+            dist = np.zeros((len(queries), stop - start), dtype=np.float32)
+            for m in range(codes.shape[1]):
+                dist += tables[queries, m][:, codes[:, m]]
+            k = min(neighbors, dist.shape[1])
+            nearest = np.argpartition(dist, k - 1, axis=1)[:, :k]
+            q_all.append(np.repeat(queries, k))
+            e_all.append((nearest + start).ravel())
+            d_all.append(np.take_along_axis(dist, nearest, axis=1).ravel())
+
+        if not q_all:
+            return []
+        q_all, e_all, d_all = np.concatenate(q_all), np.concatenate(e_all), np.concatenate(d_all)
+
+        # Keep each query descriptor's overall nearest entries, then one vote per (query, image)
+        order = np.lexsort((d_all, q_all))
+        q_all, e_all, d_all = q_all[order], e_all[order], d_all[order]
+        rank = np.arange(len(q_all)) - np.searchsorted(q_all, q_all)
+        keep = rank < neighbors
+        q_all, e_all = q_all[keep], e_all[keep]
+        image_ids = self.ivf_image_ids[e_all]
+
+        exclude_id = None
+        if exclude_path is not None and os.path.abspath(exclude_path) in self.images:
+            exclude_id = self.images.index(os.path.abspath(exclude_path))
+
+        pair_keys = np.unique(q_all.astype(np.int64) * len(self.images) + image_ids)
+        votes = np.bincount(pair_keys % len(self.images), minlength=len(self.images))
+        if exclude_id is not None:
+            votes[exclude_id] = 0
+        shortlist = np.argsort(-votes, kind='stable')[:max(top_k * 4, top_k)]
+        shortlist = shortlist[votes[shortlist] > 0]
+
+        candidates = []
+        for image_id in shortlist:
+            mask = image_ids == image_id
+            result = self._verify_candidate(projected, query_xy, q_all[mask], e_all[mask],
+                                            query['orb'], int(image_id))
+            result['votes'] = int(votes[image_id])
+            candidates.append(result)
+
+        candidates.sort(key=lambda c: (-c['score'], -c['votes']))
+        return candidates[:top_k]
+
+    def _verify_candidate(self, projected, query_xy, query_idx, entry_idx, query_orb, image_id):
+        """Exact re-ranking and region estimation for one shortlisted donor"""
+        entry_order = np.argsort(entry_idx)
+        entry_sorted = entry_idx[entry_order]
+        donor_vectors = np.asarray(self.ivf_vectors[entry_sorted], dtype=np.float32)
+        donor_xy = np.asarray(self.ivf_xy[entry_sorted], dtype=np.float32)
+        q_sorted = query_idx[entry_order]
+
+        # Exact PCA distances; keep only the closest donor entry per query descriptor
+        exact = np.linalg.norm(projected[q_sorted] - donor_vectors, axis=1)
+        best = np.lexsort((exact, q_sorted))
+        best = best[np.r_[True, np.diff(q_sorted[best]) != 0]]
+        src = query_xy[q_sorted[best]].astype(np.float32)
+        dst = donor_xy[best]
+
+        # A region is only reported for a similarity with enough support and a sane scale;
+        # a degenerate fit (near-zero scale) would collapse the region and inflate the score
+        inliers, scale = 0, None
+        query_region, donor_region = None, None
+        if len(src) >= MIN_INLIERS:
+            M, mask = cv2.estimateAffinePartial2D(src, dst, method=cv2.RANSAC, ransacReprojThreshold=0.02)
+            if M is not None:
+                inl = mask.ravel() == 1
+                fit_scale = float(np.sqrt(abs(np.linalg.det(M[:, :2]))))
+                if np.sum(inl) >= MIN_INLIERS and INDEX_SCALE_RANGE[0] <= fit_scale <= INDEX_SCALE_RANGE[1]:
+                    inliers, scale = int(np.sum(inl)), fit_scale
+                    query_region = tuple(float(v) for v in (*src[inl].min(0), *src[inl].max(0)))
+                    donor_region = tuple(float(v) for v in (*dst[inl].min(0), *dst[inl].max(0)))
+
+        orb_matches = 0
+        query_orb_codes, _ = query_orb
+        start, stop = self.orb_offsets[image_id], self.orb_offsets[image_id + 1]
+        if len(query_orb_codes) > 0 and stop - start >= 2:
+            # Hamming kNN on the packed codes (popcount in OpenCV, not a NumPy XOR table)
+            knn = cv2.BFMatcher(cv2.NORM_HAMMING).knnMatch(query_orb_codes.astype(np.uint8),
+                                                            np.asarray(self.orb_codes[start:stop]), k=2)
+            orb_matches = sum(1 for m in knn if len(m) == 2 and m[0].distance < 50 and
+                              m[0].distance < 0.8 * m[1].distance)
+
+        return {
+            'image_path': self.images[image_id],
+            'image_id': image_id,
+            'sift_inliers': inliers,
+            'orb_matches': orb_matches,
+            'score': float(inliers + 0.5 * orb_matches),
+            'scale': scale,
+            # Regions as (x0, y0, x1, y1) in units of each image's longest side
+            'query_region': query_region,
+            'donor_region': donor_region
+        }
+
+# ======================= Benchmark =======================
+
+def benchmark_splice_index(index, query_images, top_k=5, nprobe=INDEX_NPROBE):
+    """Query latency of an index (SpliceSourceIndex or index dir) on this machine, in ms
+
+    Descriptor extraction is included, since every real query pays for it.
+    Returns corpus size and the median / p95 / max latency over query_images.
+    """
+    if isinstance(index, str):
+        index = SpliceSourceIndex(index)
+    index.query(query_images[0], top_k=top_k, nprobe=nprobe)  # warm-up (memmap pages, SIFT init)
+    timings = []
+    for image in query_images:
+        start = time.perf_counter()
+        index.query(image, top_k=top_k, nprobe=nprobe)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings = np.array(timings)
+    return {
+        'n_images': len(index),
+        'n_descriptors': int(index.ivf_offsets[-1]),
+        'n_queries': len(timings),
+        'median_ms': float(np.median(timings)),
+        'p95_ms': float(np.percentile(timings, 95)),
+        'max_ms': float(timings.max())
+    }
@@ -6,40 +6,205 @@ import os
 import numpy as np
 from PIL import Image, ImageEnhance
 import cv2
-import exifread
 from datetime import datetime
-from config import VALID_EXTENSIONS, MIN_FILE_SIZE, TARGET_MAX_DIM
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from config import (MIN_FILE_SIZE, TARGET_MAX_DIM, PREPROCESS_PROFILE,
+                    JPEG_DRAFT_DECODE, FULL_RESOLUTION_STAGES, STAGE_INPUTS, COPY_MOVE_TWO_PASS,
+                    PATCHMATCH_ENABLED, STAGE_MEMORY_BYTES_PER_PIXEL, FULL_RESOLUTION_BYTES_PER_PIXEL,
+                    PIPELINE_BASE_MEMORY, MEMORY_BUDGET_BYTES, MAX_DECODE_PIXELS, METADATA_SCAN_WORKERS)
+from image_context import ImageContext, StageInputs
+from metadata_scan import read_header_metadata, scan_metadata_directory
+
+# PIL warns above MAX_IMAGE_PIXELS and raises above twice that; keep it in step with our own guard
+Image.MAX_IMAGE_PIXELS = MAX_DECODE_PIXELS
+
+# ======================= Format Sniffing & Planning =======================
+
+# Leading magic bytes -> format (WEBP additionally needs 'WEBP' at offset 8)
+IMAGE_SIGNATURES = [
+    (b'\xff\xd8\xff', 'JPEG'),
+    (b'\x89PNG\r\n\x1a\n', 'PNG'),
+    (b'BM', 'BMP'),
+    (b'II*\x00', 'TIFF'),
+    (b'MM\x00*', 'TIFF'),
+    (b'RIFF', 'WEBP')
+]
+
+FORMAT_EXTENSIONS = {
+    'JPEG': ('.jpg', '.jpeg'), 'PNG': ('.png',), 'BMP': ('.bmp',),
+    'TIFF': ('.tiff', '.tif'), 'WEBP': ('.webp',)
+}
+
+def sniff_image_format(filepath):
+    """Image format from the first bytes of the file, or None if not a supported format"""
+    with open(filepath, 'rb') as f:
+        head = f.read(16)
+    for signature, image_format in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            if image_format == 'WEBP' and head[8:12] != b'WEBP':
+                return None
+            return image_format
+    return None
+
+def probe_image_header(filepath):
+    """Width, height and mode from the header only (PIL opens lazily; no pixel is decoded)"""
+    # Sizes between MAX_DECODE_PIXELS and PIL's error limit are rejected by the plan itself
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+        image = Image.open(filepath)
+    with image:
+        return {'width': image.size[0], 'height': image.size[1], 'mode': image.mode,
+                'bands': len(image.getbands())}
+
+def enabled_stages():
+    """Pipeline stages that will actually run with the current config"""
+    disabled = set()
+    if not COPY_MOVE_TWO_PASS:
+        disabled.add('copy_move_two_pass')
+    if not PATCHMATCH_ENABLED:
+        disabled.add('patchmatch')
+    return [stage for stage in STAGE_INPUTS if stage not in disabled]
+
+def estimate_pipeline_memory(width, height, stages=None, full_resolution_stages=FULL_RESOLUTION_STAGES,
+                             target_max_dim=TARGET_MAX_DIM):
+    """Estimated peak bytes of one analysis from the header dimensions alone"""
+    stages = enabled_stages() if stages is None else stages
+    ratio = min(1.0, target_max_dim / max(width, height))
+    working_pixels = int(width * ratio) * int(height * ratio)
+    estimate = PIPELINE_BASE_MEMORY + working_pixels * sum(STAGE_MEMORY_BYTES_PER_PIXEL.get(s, 0) for s in stages)
+    full_stages = [s for s in full_resolution_stages if s in stages]
+    if ratio < 1.0 and full_stages:
+        estimate += width * height * (3 + sum(FULL_RESOLUTION_BYTES_PER_PIXEL.get(s, 0) for s in full_stages))
+    return int(estimate)
+
+def plan_image_processing(filepath, memory_budget=MEMORY_BUDGET_BYTES, stages=None):
+    """Decide how to process one file before decoding any pixel
+    
+    decision: 'full' (already within TARGET_MAX_DIM), 'tiled' (reduced working decode,
+    full-resolution stages on tiles of the full frame), 'downscale' (working resolution
+    only; the full-frame decode would not fit memory_budget) or 'reject'.
+    """
+    plan = {'path': filepath, 'format': None, 'width': None, 'height': None, 'mode': None,
+            'estimated_bytes': None, 'full_resolution_stages': [], 'decision': 'reject', 'reason': None}
+    
+    image_format = sniff_image_format(filepath)
+    if image_format is None:
+        plan['reason'] = "unrecognised file signature"
+        return plan
+    plan['format'] = image_format
+    plan['extension_matches'] = os.path.splitext(filepath)[1].lower() in FORMAT_EXTENSIONS[image_format]
+    
+    try:
+        plan.update(probe_image_header(filepath))
+    except Image.DecompressionBombError as e:
+        plan['reason'] = f"decompression bomb: {e}"
+        return plan
+    except Exception as e:
+        plan['reason'] = f"unreadable header: {e}"
+        return plan
+    
+    width, height = plan['width'], plan['height']
+    stages = enabled_stages() if stages is None else stages
+    if width * height > MAX_DECODE_PIXELS:
+        plan['reason'] = f"{width} × {height} exceeds MAX_DECODE_PIXELS ({MAX_DECODE_PIXELS})"
+        return plan
+    
+    full_stages = [s for s in FULL_RESOLUTION_STAGES if s in stages]
+    with_full = estimate_pipeline_memory(width, height, stages)
+    working_only = estimate_pipeline_memory(width, height, stages, full_resolution_stages=[])
+    if max(width, height) <= TARGET_MAX_DIM:
+        # Full resolution is the working image itself: no extra decode
+        plan.update(decision='full', estimated_bytes=working_only, full_resolution_stages=full_stages)
+    elif with_full <= memory_budget:
+        plan.update(decision='tiled', estimated_bytes=with_full, full_resolution_stages=full_stages)
+    else:
+        plan.update(decision='downscale', estimated_bytes=working_only)
+    
+    if plan['estimated_bytes'] > memory_budget:
+        plan.update(decision='reject', reason=f"estimated {plan['estimated_bytes'] / 1024**2:.0f} MB exceeds budget")
+    return plan
+
+def plan_batch(paths, memory_budget=MEMORY_BUDGET_BYTES, max_parallel=4, max_workers=METADATA_SCAN_WORKERS):
+    """Plan a batch from headers only and pack it into waves that fit memory_budget
+    
+    Plans are probed on a thread pool; a file that cannot be probed at all (missing,
+    unreadable) becomes a 'reject' plan instead of aborting the batch. Accepted files
+    are packed first-fit by decreasing estimated memory into waves of at most
+    max_parallel analyses whose summed estimate stays within memory_budget.
+    """
+    def safe_plan(path):
+        try:
+            return plan_image_processing(path, memory_budget)
+        except Exception as e:
+            return {'path': path, 'format': None, 'width': None, 'height': None, 'mode': None,
+                    'estimated_bytes': None, 'full_resolution_stages': [], 'decision': 'reject',
+                    'reason': f"probe failed: {e}"}
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        plans = list(executor.map(safe_plan, paths))
+    
+    accepted = sorted((p for p in plans if p['decision'] != 'reject'),
+                      key=lambda p: p['estimated_bytes'], reverse=True)
+    waves = []
+    for plan in accepted:
+        for wave in waves:
+            if len(wave['paths']) < max_parallel and wave['bytes'] + plan['estimated_bytes'] <= memory_budget:
+                wave['paths'].append(plan['path'])
+                wave['bytes'] += plan['estimated_bytes']
+                break
+        else:
+            waves.append({'paths': [plan['path']], 'bytes': plan['estimated_bytes']})
+    
+    return {
+        'plans': plans,
+        'waves': waves,
+        'rejected': [p for p in plans if p['decision'] == 'reject']
+    }
 
 def validate_image_file(filepath):
-    """Enhanced validation with more format support"""
-    ext = os.path.splitext(filepath)[1].lower()
-    if ext not in VALID_EXTENSIONS:
-        raise ValueError(f"Format file tidak didukung: {ext}")
+    """Enhanced validation: magic-byte format, header-only probe and processing plan
     
+    Returns the plan from plan_image_processing; raises before any pixel is decoded
+    if the file is missing, not a supported image, or would not fit in memory.
+    """
     if not os.path.isfile(filepath):
         raise FileNotFoundError(f"File {filepath} tidak ditemukan.")
     
+    plan = plan_image_processing(filepath)
+    if plan['format'] is None:
+        raise ValueError(f"Format file tidak didukung: {os.path.splitext(filepath)[1].lower()} ({plan['reason']})")
+    if not plan.get('extension_matches', True):
+        print(f"⚠ Warning: Ekstensi file tidak sesuai isi (terdeteksi {plan['format']})")
+    if plan['decision'] == 'reject':
+        raise ValueError(f"Gambar ditolak: {plan['reason']}")
+    
     file_size = os.path.getsize(filepath)
     if file_size < MIN_FILE_SIZE:
         print(f"⚠ Warning: File sangat kecil ({file_size} bytes), hasil mungkin kurang akurat")
     
-    return True
+    return plan
 
-def extract_enhanced_metadata(filepath):
-    """Enhanced metadata extraction dengan analisis inkonsistensi yang lebih detail"""
+def extract_enhanced_metadata(filepath, header=None):
+    """Enhanced metadata extraction dengan analisis inkonsistensi yang lebih detail
+    
+    Reads only the header segments (metadata_scan.read_header_metadata) unless an
+    already-read header record is passed in.
+    """
     metadata = {}
     try:
-        with open(filepath, 'rb') as f:
-            tags = exifread.process_file(f, details=False, strict=False)
+        header = header or read_header_metadata(filepath)
+        tags = header['tags']
         
-        metadata['Filename'] = os.path.basename(filepath)
-        metadata['FileSize (bytes)'] = os.path.getsize(filepath)
+        metadata['Filename'] = header['filename']
+        metadata['FileSize (bytes)'] = header['file_size']
         
         try:
             metadata['LastModified'] = datetime.fromtimestamp(
-                os.path.getmtime(filepath)).strftime('%Y-%m-%d %H:%M:%S')
+                header['mtime']).strftime('%Y-%m-%d %H:%M:%S')
         except Exception:
-            metadata['LastModified'] = str(os.path.getmtime(filepath))
+            metadata['LastModified'] = str(header['mtime'])
         
         # Extract comprehensive EXIF tags
         comprehensive_tags = [
@@ -63,6 +228,11 @@ def extract_enhanced_metadata(filepath):
     
     return metadata
 
+def scan_enhanced_metadata(directory, max_workers=None, recursive=True):
+    """Bulk triage: stream (path, extract_enhanced_metadata record) for a whole directory"""
+    kwargs = {'max_workers': max_workers} if max_workers else {}
+    return scan_metadata_directory(directory, reader=extract_enhanced_metadata, recursive=recursive, **kwargs)
+
 def check_enhanced_metadata_consistency(tags):
     """Enhanced metadata consistency check"""
     inconsistencies = []
@@ -118,13 +288,81 @@ def calculate_metadata_authenticity_score(tags):
     
     return max(0, min(100, score))
 
-def advanced_preprocess_image(image_pil, target_max_dim=TARGET_MAX_DIM):
-    """Advanced preprocessing dengan enhancement dan size optimization"""
+class ImageLoader:
+    """Opens an image file lazily: a reduced working decode plus an explicit full-resolution one
+
+    For JPEGs larger than target_max_dim, working_image() lets libjpeg decode straight
+    to the largest 1/2, 1/4 or 1/8 DCT scale that still covers target_max_dim
+    (PIL Image.draft), so only a small exact resize remains. full_resolution()
+    decodes the whole frame, once, for stages listed in FULL_RESOLUTION_STAGES;
+    full_resolution_context() wraps it so its gray/CLAHE planes are also built once.
+    """
+
+    def __init__(self, path, target_max_dim=TARGET_MAX_DIM, full_resolution_stages=FULL_RESOLUTION_STAGES):
+        self.path = path
+        self.target_max_dim = target_max_dim
+        self.full_resolution_stages = full_resolution_stages
+        with Image.open(path) as probe:  # header only
+            self.size, self.format, self.mode = probe.size, probe.format, probe.mode
+            self.quantization = getattr(probe, 'quantization', None) or {}
+        self._working = None
+        self._full = None
+        self._full_context = None
+
+    @property
+    def needs_reduction(self):
+        return max(self.size) > self.target_max_dim
+
+    def _decode(self, draft_size=None):
+        image = Image.open(self.path)
+        if draft_size is not None:
+            image.draft('RGB', draft_size)
+        image.load()
+        return image if image.mode == 'RGB' else image.convert('RGB')
+
+    def working_image(self):
+        """RGB image with longest side >= target_max_dim when possible (reduced JPEG decode)"""
+        if self._working is None:
+            if self._full is not None or not self.needs_reduction:
+                self._working = self.full_resolution()
+            elif JPEG_DRAFT_DECODE and self.format == 'JPEG':
+                ratio = self.target_max_dim / max(self.size)
+                draft_size = (int(np.ceil(self.size[0] * ratio)), int(np.ceil(self.size[1] * ratio)))
+                self._working = self._decode(draft_size)
+                scale = self.size[0] / self._working.size[0]
+                if scale > 1:
+                    print(f"  Draft decode 1/{scale:.0f}: {self._working.size[0]} × {self._working.size[1]}")
+            else:
+                self._working = self.full_resolution()
+        return self._working
+
+    def full_resolution(self):
+        """Full-frame RGB decode (cached)"""
+        if self._full is None:
+            self._full = self._decode()
+        return self._full
+
+    def for_stage(self, stage):
+        """Full-resolution image for stages that ask for it, else None"""
+        return self.full_resolution() if stage in self.full_resolution_stages else None
+
+    def full_resolution_context(self):
+        """ImageContext of the full-resolution decode (cached)"""
+        if self._full_context is None:
+            self._full_context = ImageContext(self.full_resolution())
+        return self._full_context
+
+    def context_for_stage(self, stage):
+        """Full-resolution ImageContext for stages that ask for it, else None"""
+        return self.full_resolution_context() if stage in self.full_resolution_stages else None
+
+def resize_to_target(image_pil, target_max_dim=TARGET_MAX_DIM):
+    """RGB copy no larger than target_max_dim on its longest side (LANCZOS)"""
     if image_pil.mode != 'RGB':
         image_pil = image_pil.convert('RGB')
     
     original_width, original_height = image_pil.size
-    print(f"  Original size: {original_width} × {original_height}")
+    print(f"  Input size: {original_width} × {original_height}")
     
     # More aggressive resizing for very large images
     if original_width > target_max_dim or original_height > target_max_dim:
@@ -132,12 +370,61 @@ def advanced_preprocess_image(image_pil, target_max_dim=TARGET_MAX_DIM):
         new_size = (int(original_width * ratio), int(original_height * ratio))
         image_pil = image_pil.resize(new_size, Image.Resampling.LANCZOS)
         print(f"  Resized to: {new_size[0]} × {new_size[1]} (ratio: {ratio:.3f})")
-    
-    # Light denoising for smaller images only
-    if max(image_pil.size) <= 2000:
-        image_array = np.array(image_pil)
+    return image_pil
+
+def guided_filter(image_array, radius=2, eps=0.0025):
+    """Self-guided edge-preserving filter (He et al.) per channel, box filters only"""
+    image = image_array.astype(np.float32) * (1 / 255.0)
+    ksize = (2 * radius + 1, 2 * radius + 1)
+    mean = cv2.boxFilter(image, -1, ksize)
+    var = cv2.boxFilter(image * image, -1, ksize) - mean * mean
+    a = var / (var + eps)
+    b = mean - a * mean
+    output = cv2.boxFilter(a, -1, ksize) * image + cv2.boxFilter(b, -1, ksize)
+    return np.clip(output * 255 + 0.5, 0, 255).astype(np.uint8)
+
+def denoise_image(image_pil, profile=PREPROCESS_PROFILE):
+    """Apply a preprocessing profile: 'none', 'bilateral', 'guided' or 'nlm'"""
+    if profile == 'none':
+        return image_pil
+    image_array = np.asarray(image_pil)
+    if profile == 'bilateral':
+        denoised = cv2.bilateralFilter(image_array, 5, 20, 5)
+    elif profile == 'guided':
+        denoised = guided_filter(image_array)
+    elif profile == 'nlm':
+        # Light NLM denoising for smaller images only
+        if max(image_pil.size) > 2000:
+            print("  Skipping denoising for large image")
+            return image_pil
         denoised = cv2.fastNlMeansDenoisingColored(image_array, None, 3, 3, 7, 21)
-        return Image.fromarray(denoised), image_pil
     else:
-        print("  Skipping denoising for large image")
-        return image_pil, image_pil
+        raise ValueError(f"Unknown preprocessing profile: {profile}")
+    return Image.fromarray(denoised)
+
+def prepare_stage_inputs(image_pil, target_max_dim=TARGET_MAX_DIM, profile=PREPROCESS_PROFILE):
+    """Resize once and return StageInputs; the profile's denoising runs only if a stage needs it"""
+    resized = resize_to_target(image_pil, target_max_dim)
+    denoise = None if profile == 'none' else (lambda image: denoise_image(image, profile))
+    return StageInputs(resized, denoise)
+
+def advanced_preprocess_image(image_pil, target_max_dim=TARGET_MAX_DIM, profile=PREPROCESS_PROFILE):
+    """Advanced preprocessing dengan enhancement dan size optimization
+
+    Returns (denoised, resized) images for the given profile.
+    """
+    resized = resize_to_target(image_pil, target_max_dim)
+    return denoise_image(resized, profile), resized
+
+def benchmark_preprocess_profiles(image_pil, profiles=('none', 'bilateral', 'guided', 'nlm'), repeats=3):
+    """Cost of each preprocessing profile in ms per megapixel on this machine (see PREPROCESS_PROFILE_COSTS)"""
+    image_pil = resize_to_target(image_pil)
+    megapixels = image_pil.size[0] * image_pil.size[1] / 1e6
+    costs = {}
+    for profile in profiles:
+        denoise_image(image_pil, profile)  # warm-up
+        start = time.perf_counter()
+        for _ in range(repeats):
+            denoise_image(image_pil, profile)
+        costs[profile] = (time.perf_counter() - start) * 1000 / repeats / megapixels
+    return costs
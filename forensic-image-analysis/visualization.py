@@ -10,7 +10,8 @@ import matplotlib.gridspec as gridspec
 from matplotlib.backends.backend_pdf import PdfPages
 from PIL import Image
 from datetime import datetime
-from skimage.filters import sobel
+from advanced_analysis import compute_edge_map
+from fusion import fuse_localization_evidence
 import os
 import io
 import warnings
@@ -94,7 +95,7 @@ def visualize_results_advanced(original_pil, analysis_results, output_filename="
     
     # Noise Analysis
     ax12 = fig.add_subplot(gs[2, 1])
-    ax12.imshow(analysis_results['noise_map'], cmap='gray')
+    ax12.imshow(analysis_results['noise_map'], cmap='inferno')
     ax12.set_title(f"Noise Map\n(Inconsistency: {analysis_results['noise_analysis']['overall_inconsistency']:.3f})", fontsize=11)
     ax12.axis('off')
     
@@ -135,13 +136,13 @@ def create_feature_match_visualization(ax, original_pil, results):
     """Create feature match visualization"""
     img_matches = np.array(original_pil.convert('RGB'))
     
-    if results['sift_keypoints'] and results['ransac_matches']:
-        keypoints = results['sift_keypoints']
-        matches = results['ransac_matches'][:20]  # Limit for clarity
+    if len(results['sift_keypoints']) and len(results['ransac_matches']):
+        keypoint_xy = results['sift_keypoints'].xy.astype(int)
+        pairs = results['ransac_matches'].for_detector('sift').pairs[:20]  # Limit for clarity
         
-        for match in matches:
-            pt1 = tuple(map(int, keypoints[match.queryIdx].pt))
-            pt2 = tuple(map(int, keypoints[match.trainIdx].pt))
+        for query_idx, train_idx in pairs:
+            pt1 = tuple(keypoint_xy[query_idx].tolist())
+            pt2 = tuple(keypoint_xy[train_idx].tolist())
             cv2.line(img_matches, pt1, pt2, (0, 255, 0), 2)
             cv2.circle(img_matches, pt1, 5, (255, 0, 0), -1)
             cv2.circle(img_matches, pt2, 5, (255, 0, 0), -1)
@@ -317,8 +318,10 @@ def create_texture_visualization(ax, results):
 
 def create_edge_visualization(ax, original_pil, results):
     """Create edge analysis visualization"""
-    image_gray = np.array(original_pil.convert('L'))
-    edges = sobel(image_gray)
+    # Reuse the edge map published by analyze_edge_consistency
+    edges = results['edge_analysis'].get('edge_map')
+    if edges is None:
+        edges = compute_edge_map(np.array(original_pil.convert('L')))
     
     ax.imshow(edges, cmap='gray')
     ax.set_title(f"Edge Analysis\n(Inconsistency: {results['edge_analysis']['edge_inconsistency']:.3f})", fontsize=11)
@@ -435,35 +438,16 @@ def create_detailed_report(ax, analysis_results):
             bbox=dict(boxstyle='round', facecolor='lightgray', alpha=0.8))
 
 def create_advanced_combined_heatmap(analysis_results, image_size):
-    """Create advanced combined suspicion heatmap"""
+    """Create advanced combined suspicion heatmap from the localization fusion map"""
     w, h = image_size
-    heatmap = np.zeros((h, w))
-    
-    # ELA contribution (30%)
-    ela_resized = cv2.resize(np.array(analysis_results['ela_image']), (w, h))
-    heatmap += (ela_resized / 255.0) * 0.3
-    
-    # JPEG ghost contribution (25%)
-    ghost_resized = cv2.resize(analysis_results['jpeg_ghost'], (w, h))
-    heatmap += ghost_resized * 0.25
-    
-    # Feature points (20%)
-    if analysis_results['sift_keypoints']:
-        for kp in analysis_results['sift_keypoints'][:100]:  # Limit to prevent overcrowding
-            x, y = int(kp.pt[0]), int(kp.pt[1])
-            if 0 <= x < w and 0 <= y < h:
-                cv2.circle(heatmap, (x, y), 15, 0.2, -1)
-    
-    # Block matches (25%)
-    for match in analysis_results['block_matches'][:30]:
-        x1, y1 = match['block1']
-        x2, y2 = match['block2']
-        cv2.rectangle(heatmap, (x1, y1), (x1+16, y1+16), 0.4, -1)
-        cv2.rectangle(heatmap, (x2, y2), (x2+16, y2+16), 0.4, -1)
-    
-    # Normalize
-    heatmap = np.clip(heatmap, 0, 1)
-    return heatmap
+    fusion_result = analysis_results.get('localization_analysis', {}).get('fusion')
+    if fusion_result is None:
+        ela_shape = np.array(analysis_results['ela_image']).shape[:2]
+        fusion_result = fuse_localization_evidence(analysis_results, ela_shape)
+    
+    # Only the coarse probability map is upsampled
+    heatmap = cv2.resize(fusion_result['probability_map'], (w, h), interpolation=cv2.INTER_LINEAR)
+    return np.clip(heatmap, 0, 1)
 
 def create_summary_report(ax, analysis_results):
     """Create summary report for PDF visualization"""
@@ -672,7 +656,7 @@ def export_visualization_pdf(original_pil, analysis_results, output_filename="fo
         create_quality_response_plot(ax13, analysis_results)
         
         ax14 = fig2.add_subplot(gs2[1, 1])
-        ax14.imshow(analysis_results['noise_map'], cmap='gray')
+        ax14.imshow(analysis_results['noise_map'], cmap='inferno')
         ax14.set_title(f"Noise Map", fontsize=12)
         ax14.axis('off')
         